@@ -0,0 +1,349 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from db import DB_CONFIG, PreparedStatements
+from sqlite_db import SqliteConnection
+from costs import ProductCostCache, calculate_product_costs, with_costs
+from refcache import ReferenceCache
+from replenishment import COST_COLUMN, load_plan
+from material_requirements import PlanItem, calculate_requirements
+from material_index import MaterialIndex
+from pricing import PartnerPriceCache, partner_price, partner_prices
+from snapshot import Snapshot
+from writes import QueuedWrite, WriteQueue
+from instrumentation import InstrumentedConnection, QueryStats
+from repository import (Product, Material, ProductMaterial, ProductType, MaterialType, ProductRepository,
+                        MaterialRepository, ProductMaterialRepository, ProductTypeRepository, MaterialTypeRepository,
+                        PageQuery)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+# products / materials / ProductMaterials rows per scale
+SCALES = {
+    '1k': (1000, 200, 1000),
+    '10k': (10000, 2000, 10000),
+    '100k': (100000, 10000, 100000),
+    '1m': (1000000, 100000, 1000000),
+}
+INSERT_CHUNK = 10000
+PRODUCT_TYPES = [("Обои флизелиновые", 1.5), ("Обои виниловые", 1.2), ("Обои бумажные", 1.0), ("Фотообои", 2.1)]
+MATERIAL_TYPES = [("Бумага", 0.7), ("Краска", 0.5), ("Клей", 0.15), ("Пленка", 0.2), ("Флизелин", 0.4)]
+UNITS = ["м", "л", "кг", "г", "шт"]
+PAGE_SIZE = 500
+PLAN_ORDERS = 5000
+# Share of bill lines that are semi-finished products instead of materials
+COMPONENT_SHARE = 10
+
+def schema_statements(sqlite):
+    with open(SCHEMA_PATH, encoding='utf-8') as f:
+        script = f.read()
+    for statement in script.split(";"):
+        lines = [line for line in statement.splitlines() if line.strip() and not line.strip().startswith("--")]
+        statement = "\n".join(lines).strip()
+        if not statement or statement.upper().startswith(("CREATE DATABASE", "USE ")):
+            continue
+        if sqlite:
+            statement = statement.replace("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY")
+        yield statement
+
+def create_schema(conn, sqlite):
+    cursor = conn.cursor()
+    for table in ("ChangeLog", "ProductMaterials", "Products", "Materials", "ProductTypes", "MaterialTypes"):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    for statement in schema_statements(sqlite):
+        cursor.execute(statement)
+    conn.commit()
+
+def insert_chunked(repository, items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= INSERT_CHUNK:
+            repository.insert_many(batch)
+            repository.conn.commit()
+            batch = []
+    if batch:
+        repository.insert_many(batch)
+        repository.conn.commit()
+
+def generate(conn, products, materials, lines, seed=1):
+    # Synthetic MosaicDB catalog; ids are assigned sequentially from 1 on a freshly created schema
+    rng = random.Random(seed)
+    ProductTypeRepository(conn).insert_many([ProductType(None, name, k) for name, k in PRODUCT_TYPES])
+    MaterialTypeRepository(conn).insert_many([MaterialType(None, name, d) for name, d in MATERIAL_TYPES])
+    conn.commit()
+    insert_chunked(MaterialRepository(conn), (
+        Material(None, f"Материал {i:07d}", rng.randint(1, len(MATERIAL_TYPES)), round(rng.uniform(1, 500), 2),
+                 round(rng.uniform(0, 5000), 2), rng.choice(UNITS), rng.randint(1, 100), round(rng.uniform(0, 1000), 2))
+        for i in range(1, materials + 1)))
+    insert_chunked(ProductRepository(conn), (
+        Product(None, f"{8000000 + i}", rng.randint(1, len(PRODUCT_TYPES)), f"Обои {i:07d}",
+                round(rng.uniform(500, 20000), 2), round(rng.choice([0.53, 0.7, 1.06]), 2))
+        for i in range(1, products + 1)))
+    insert_chunked(ProductMaterialRepository(conn), (
+        ProductMaterial(None, rng.randint(1, products), rng.randint(1, materials), round(rng.uniform(0.1, 20), 2))
+        for _ in range(lines)))
+    # Semi-finished products: a product only contains products with a lower id, so the bills stay acyclic
+    insert_chunked(ProductMaterialRepository(conn), (
+        ProductMaterial(None, product_id, None, round(rng.uniform(0.1, 3), 2), rng.randint(1, product_id - 1))
+        for product_id in (rng.randint(2, products) for _ in range(lines // COMPONENT_SHARE))))
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        'repeat': repeat,
+        'min_ms': round(min(samples), 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'max_ms': round(max(samples), 3),
+    }
+
+def scenarios(conn, products, materials, sample):
+    rng = random.Random(2)
+    product_ids = [rng.randint(1, products) for _ in range(sample)]
+    material_ids = [rng.randint(1, materials) for _ in range(sample)]
+    first_page = PageQuery("", None, False)
+
+    def products_tab_cold():
+        with_costs(conn, ProductRepository(conn).tab_page(first_page, None, PAGE_SIZE), ProductCostCache())
+
+    warm = ProductCostCache()
+    warm.load(conn)
+
+    def products_tab_warm():
+        with_costs(conn, ProductRepository(conn).tab_page(first_page, None, PAGE_SIZE), warm)
+
+    def products_tab_scroll():
+        repository = ProductRepository(conn)
+        last_row = None
+        for _ in range(10):
+            rows = with_costs(conn, repository.tab_page(first_page, last_row, PAGE_SIZE), warm)
+            if not rows:
+                break
+            last_row = rows[-1]
+
+    def products_search():
+        ProductRepository(conn).tab_page(PageQuery("8001", 0, False), None, PAGE_SIZE)
+
+    def materials_tab():
+        MaterialRepository(conn).tab_page(first_page, None, PAGE_SIZE)
+
+    def cost_per_product():
+        # The original load_products pattern: one cost query per product row
+        repository = ProductMaterialRepository(conn)
+        for product_id in product_ids:
+            repository.cost_sums([product_id])
+
+    def cost_grouped():
+        calculate_product_costs(product_ids, conn)
+
+    def cost_catalog():
+        calculate_product_costs(None, conn)
+
+    def cost_cache_build():
+        ProductCostCache().load(conn)
+
+    prices = MaterialRepository(conn).prices(material_ids[:20])
+
+    def cost_rollup_price_change():
+        # A material price edit re-rolls its products and every product they are a semi-finished part of
+        for material_id, price in prices.items():
+            warm.material_price_changed(material_id, price)
+
+    def dialog_open_cold():
+        cache = ReferenceCache()
+        cache.register('material_types', lambda: MaterialTypeRepository(conn).names())
+        cache.register('materials', lambda: MaterialRepository(conn).names())
+        cache.get('material_types')
+        cache.get('materials')
+        MaterialRepository(conn).get(material_ids[0])
+
+    shared = ReferenceCache()
+    shared.register('material_types', lambda: MaterialTypeRepository(conn).names())
+    shared.get('material_types')
+
+    def dialog_open_warm():
+        shared.get('material_types')
+        MaterialRepository(conn).get(material_ids[0])
+
+    def material_save():
+        repository = MaterialRepository(conn)
+        for material_id in material_ids[:20]:
+            material = repository.get(material_id)
+            material.unit_price = round(float(material.unit_price) + 0.01, 2)
+            repository.save(material)
+            conn.commit()
+            repository.tab_rows_by_id([material_id])
+            warm.material_price_changed(material_id, material.unit_price)
+
+    @contextmanager
+    def connection():
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+
+    write_queue = WriteQueue(connection)
+    saved_ids = list(dict.fromkeys(material_ids))[:20]
+
+    def changed_materials():
+        materials = MaterialRepository(conn).get_many(saved_ids)
+        for material in materials.values():
+            material.unit_price = round(float(material.unit_price) + 0.01, 2)
+        return list(materials.values())
+
+    def material_save_each():
+        # The save dialogs one after another: each save is its own transaction with its ChangeLog row
+        for material in changed_materials():
+            write_queue.save(MaterialRepository, material)
+
+    def material_save_coalesced():
+        # The same saves arriving while a transaction is being written: one transaction for all of them
+        entries = [write_queue.submit(QueuedWrite(MaterialRepository, material)) for material in changed_materials()]
+        write_queue.flush()
+        for entry in entries:
+            entry.value()
+
+    def replenishment_plan():
+        plan = load_plan(conn)
+        plan.totals()
+        plan.page(PageQuery("", COST_COLUMN, True), None, PAGE_SIZE)
+
+    orders = [PlanItem(rng.randint(1, products), rng.randint(1, 50), 10) for _ in range(PLAN_ORDERS)]
+
+    def requirements_plan():
+        calculate_requirements(orders, conn).shortages()
+
+    def material_index_build():
+        MaterialIndex(MaterialRepository(conn).index_rows(), MaterialTypeRepository(conn).names())
+
+    material_index = MaterialIndex(MaterialRepository(conn).index_rows(), MaterialTypeRepository(conn).names())
+    typed = [f"{i:07d}"[:length] for i in material_ids[:20] for length in (1, 3, 5)]
+    typed += ["Материал 000"[:length] for length in range(1, 13)]
+
+    def material_typeahead():
+        # One search per keystroke, as the picker issues them
+        for text in typed:
+            material_index.grouped(material_index.search(text))
+
+    pricing_rows = ProductRepository(conn).pricing_inputs()
+    pricing_costs = warm.costs_for([row[0] for row in pricing_rows], conn)
+
+    def partner_prices_per_row():
+        [partner_price(pricing_costs[row[0]], row[2], row[1]) for row in pricing_rows]
+
+    def partner_prices_vectorized():
+        partner_prices([pricing_costs[row[0]] for row in pricing_rows], [row[2] for row in pricing_rows],
+                       [row[1] for row in pricing_rows])
+
+    def partner_price_cache_build():
+        PartnerPriceCache(warm).load(conn)
+
+    snapshot = Snapshot(os.path.join(tempfile.gettempdir(), 'mosaic_bench_snapshot.sqlite3'))
+
+    def snapshot_rebuild():
+        snapshot.rebuild(conn, None)
+
+    snapshot.rebuild(conn, None)
+
+    def snapshot_first_page():
+        # What the window shows at startup before the database has answered
+        snapshot.products_page(first_page, None, PAGE_SIZE)
+
+    return {
+        'products_tab_first_page_cold_cache': products_tab_cold,
+        'products_tab_first_page_warm_cache': products_tab_warm,
+        'products_tab_scroll_10_pages': products_tab_scroll,
+        'products_tab_search': products_search,
+        'materials_tab_first_page': materials_tab,
+        f'cost_per_product_x{sample}': cost_per_product,
+        f'cost_grouped_x{sample}': cost_grouped,
+        'cost_full_catalog': cost_catalog,
+        'cost_cache_build': cost_cache_build,
+        'cost_rollup_price_change_x20': cost_rollup_price_change,
+        'material_dialog_open_cold': dialog_open_cold,
+        'material_dialog_open_warm': dialog_open_warm,
+        'material_save_x20': material_save,
+        'material_save_x20_write_queue_each': material_save_each,
+        'material_save_x20_write_queue_coalesced': material_save_coalesced,
+        'replenishment_plan': replenishment_plan,
+        f'requirements_plan_x{PLAN_ORDERS}': requirements_plan,
+        'material_index_build': material_index_build,
+        'material_typeahead_x72': material_typeahead,
+        'partner_prices_per_row': partner_prices_per_row,
+        'partner_prices_vectorized': partner_prices_vectorized,
+        'partner_price_cache_build': partner_price_cache_build,
+        'snapshot_rebuild': snapshot_rebuild,
+        'snapshot_first_page': snapshot_first_page,
+    }
+
+def connect(args):
+    if args.backend == 'sqlite':
+        return SqliteConnection(args.sqlite_path)
+    import mysql.connector
+    conn = mysql.connector.connect(**dict(DB_CONFIG, database=args.mysql_database))
+    if not args.no_prepared:
+        # As the pool does; compare save scenarios with and without --no-prepared
+        conn.prepared_statements = PreparedStatements(conn)
+    return conn
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочные замеры MosaicDB на синтетических данных")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    parser.add_argument('--backend', choices=['sqlite', 'mysql'], default='sqlite')
+    parser.add_argument('--sqlite-path', default=':memory:')
+    parser.add_argument('--mysql-database', default='MosaicBench', help="отдельная БД: таблицы пересоздаются")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sample', type=int, default=200, help="число продуктов в точечных сценариях")
+    parser.add_argument('--only', nargs='*', help="запустить только сценарии, содержащие эти подстроки")
+    parser.add_argument('--no-prepared', action='store_true', help="MySQL: сохранения без подготовленных запросов")
+    parser.add_argument('--no-generate', action='store_true', help="использовать уже сгенерированные данные")
+    parser.add_argument('--output', default='bench_results.jsonl', help="JSON Lines: одна запись на запуск")
+    parser.add_argument('--query-stats', help="JSON-файл со статистикой запросов сценариев (p50/p95, N+1)")
+    args = parser.parse_args(argv)
+    products, materials, lines = SCALES[args.scale]
+    conn = connect(args)
+    result = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'backend': args.backend,
+        'scale': args.scale,
+        'rows': {'products': products, 'materials': materials, 'product_materials': lines},
+        'scenarios': {},
+    }
+    try:
+        if not args.no_generate:
+            start = time.perf_counter()
+            create_schema(conn, args.backend == 'sqlite')
+            generate(conn, products, materials, lines)
+            result['generate_s'] = round(time.perf_counter() - start, 3)
+            print(f"Данные сгенерированы за {result['generate_s']} с", file=sys.stderr)
+        if args.query_stats:
+            query_stats = QueryStats(enabled=True, slow_ms=float('inf'))
+            conn = InstrumentedConnection(conn, query_stats)
+        for name, fn in scenarios(conn, products, materials, args.sample).items():
+            if args.only and not any(part in name for part in args.only):
+                continue
+            result['scenarios'][name] = stats = timed(fn, args.repeat)
+            print(f"{name:45} median {stats['median_ms']:10.2f} ms  max {stats['max_ms']:10.2f} ms")
+        if args.query_stats:
+            query_stats.dump_json(args.query_stats)
+            for row in query_stats.n_plus_one():
+                print(f"Похоже на N+1: {row['count']} x {row['call_site']}: {row['statement'][:80]}", file=sys.stderr)
+    finally:
+        conn.close()
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
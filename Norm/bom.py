@@ -0,0 +1,94 @@
+from costs import ZERO, CycleError, product_costs, to_decimal
+from repository import ChangeLogRepository, ProductMaterial, ProductMaterialRepository
+
+class BomEditSession:
+    # Changes to one product's bill of materials are staged in memory and written by commit() in a single
+    # transaction: deletes, one version-checked UPDATE batch and one multi-row INSERT instead of a commit per line
+    def __init__(self, product_id, lines=()):
+        self.product_id = product_id
+        self.reset(lines)
+
+    def reset(self, lines):
+        self.original = {line.id: line for line in lines}
+        self.lines = [ProductMaterial(line.id, line.product_id, line.material_id, line.quantity, line.component_id,
+                                      line.version)
+                      for line in lines]
+
+    def add(self, material_id=None, quantity=0):
+        # A line may be staged before its material is picked; diff() leaves out new lines that are still
+        # unpicked or have no quantity, so a cancelled pick never reaches the bill
+        line = ProductMaterial(None, self.product_id, material_id, to_decimal(quantity))
+        self.lines.append(line)
+        return line
+
+    def add_component(self, component_id, quantity):
+        # A semi-finished product as a line; a cycle through it is refused when the bill is written
+        if component_id == self.product_id:
+            raise CycleError([self.product_id])
+        line = ProductMaterial(None, self.product_id, None, to_decimal(quantity), component_id)
+        self.lines.append(line)
+        return line
+
+    def change(self, index, material_id, quantity):
+        # A semi-finished line keeps its product, only the quantity changes
+        line = self.lines[index]
+        if line.component_id is None:
+            line.material_id = material_id
+        line.quantity = to_decimal(quantity)
+
+    def remove(self, index):
+        del self.lines[index]
+
+    def line_cost(self, index, prices, component_costs=None):
+        # prices: {material_id: price}; component_costs: {product_id: rolled-up cost} for semi-finished lines
+        line = self.lines[index]
+        if line.component_id is not None:
+            return to_decimal((component_costs or {}).get(line.component_id, ZERO)) * to_decimal(line.quantity)
+        return to_decimal(prices.get(line.material_id, ZERO)) * to_decimal(line.quantity)
+
+    def cost(self, prices, component_costs=None):
+        # Product cost as currently edited, for display before anything is saved
+        return sum((self.line_cost(i, prices, component_costs) for i in range(len(self.lines))), ZERO)
+
+    def diff(self):
+        kept = {line.id for line in self.lines if line.id}
+        inserts = [line for line in self.lines
+                   if not line.id and (line.material_id is not None or line.component_id is not None) and line.quantity]
+        updates = [line for line in self.lines if line.id and line != self.original[line.id]]
+        deletes = [line_id for line_id in self.original if line_id not in kept]
+        return inserts, updates, deletes
+
+    def is_dirty(self):
+        return any(self.diff())
+
+    def write(self, conn):
+        # The statements of commit() without the COMMIT, for writing together with other saves (writes.WriteQueue);
+        # raises ConflictError if a line was changed meanwhile, CycleError if a semi-finished product in the bill
+        # contains this product, and leaves rolling back to the caller. The lines are not modified, so a failed
+        # transaction can simply be written again.
+        inserts, updates, deletes = self.diff()
+        repository = ProductMaterialRepository(conn)
+        components = {line.component_id for line in self.lines if line.component_id is not None}
+        if components:
+            below = components | {row[3] for row in repository.lines_below(components) if row[3] is not None}
+            if self.product_id in below:
+                raise CycleError([self.product_id])
+        repository.delete_many([self.original[line_id] for line_id in deletes])
+        repository.update_many(updates)
+        if inserts:
+            repository.insert_many(inserts)
+        ChangeLogRepository(conn).record(repository.table, [self.product_id])
+
+    def saved(self, conn, cache=product_costs):
+        # After the commit: reloads the lines with their new ids and versions, returns {product_id: cost}
+        self.reset(ProductMaterialRepository(conn).lines_for(self.product_id))
+        return cache.products_reloaded(conn, [self.product_id])
+
+    def commit(self, conn, cache=product_costs):
+        try:
+            self.write(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return self.saved(conn, cache)
@@ -0,0 +1,100 @@
+import time
+from collections import namedtuple
+from pricing import partner_price_cache, with_prices
+from repository import ChangeLogRepository, INSTANCE_ID, MaterialRepository, ProductRepository
+
+CHANGE_BATCH = 1000
+# A ChangeID missing below later ones belongs to a transaction still in flight (ids are taken at insert,
+# not at commit); after this many seconds it is treated as rolled back and skipped
+GAP_TIMEOUT = 10.0
+CHANGE_LOG_KEEP = 100000
+
+# What the open tabs need: fresh tab rows, new costs and partner prices by product, and which tabs must reload as a whole
+Changes = namedtuple('Changes', 'product_rows material_rows costs prices reload_products reload_materials')
+
+class ChangeFeed:
+    def __init__(self, gap_timeout=GAP_TIMEOUT):
+        self.gap_timeout = gap_timeout
+        self.mark = None
+        self._seen = set()
+        self._blocked_since = None
+
+    def start(self, conn):
+        changes = ChangeLogRepository(conn)
+        changes.prune(CHANGE_LOG_KEEP)
+        conn.commit()
+        self.mark = changes.latest()
+
+    def poll(self, conn):
+        # {table: set of row ids, or None for the whole table} changed by other instances since the last poll
+        if self.mark is None:
+            self.start(conn)
+            return {}
+        changed = {}
+        for change_id, table, row_id, source in ChangeLogRepository(conn).since(self.mark, CHANGE_BATCH):
+            if change_id in self._seen:
+                continue
+            self._seen.add(change_id)
+            if source == INSTANCE_ID:
+                continue
+            if row_id is None:
+                changed[table] = None
+            elif changed.get(table, ()) is not None:
+                changed.setdefault(table, set()).add(row_id)
+        self._advance()
+        return changed
+
+    def _advance(self):
+        # The mark moves over contiguous ids only; later ids already applied are remembered in _seen
+        moved = False
+        while self.mark + 1 in self._seen:
+            self.mark += 1
+            self._seen.discard(self.mark)
+            moved = True
+        if not self._seen or moved:
+            self._blocked_since = None if not self._seen else time.monotonic()
+            return
+        if self._blocked_since is None:
+            self._blocked_since = time.monotonic()
+        elif time.monotonic() - self._blocked_since >= self.gap_timeout:
+            self.mark = min(self._seen) - 1
+            self._advance()
+
+    def fetch(self, conn, prices=partner_price_cache):
+        cache = prices.costs
+        changed = self.poll(conn)
+        if not changed:
+            return None
+        product_rows = []
+        material_rows = []
+        costs = {}
+        reload_products = reload_materials = False
+        if "Materials" in changed:
+            ids = changed["Materials"]
+            if ids is None:
+                reload_materials = reload_products = True
+                cache.invalidate()
+            else:
+                materials = MaterialRepository(conn)
+                material_rows = materials.tab_rows_by_id(ids)
+                for material_id, price in materials.prices(ids).items():
+                    costs.update(cache.material_price_changed(material_id, price))
+        if "ProductMaterials" in changed:
+            ids = changed["ProductMaterials"]
+            if ids is None:
+                reload_products = True
+                cache.invalidate()
+            else:
+                costs.update(cache.products_reloaded(conn, ids))
+        if "Products" in changed:
+            ids = changed["Products"]
+            if ids is None:
+                reload_products = True
+                prices.invalidate()
+            else:
+                prices.products_changed(conn, ids)
+                product_rows = with_prices(conn, ProductRepository(conn).tab_rows_by_id(ids), prices)
+        if reload_products:
+            return Changes([], material_rows, {}, {}, reload_products, reload_materials)
+        changed_prices = prices.prices_for(list(costs), conn) if costs else {}
+        return Changes(product_rows, material_rows, costs, changed_prices, False, reload_materials)
@@ -0,0 +1,222 @@
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+import db
+from repository import ProductMaterialRepository
+
+ZERO = Decimal('0.00')
+# A material line costs price x quantity, four decimals exactly. A semi-finished line adds two more per level of
+# nesting, so rolled-up costs are rounded back to four; pricing.partner_prices relies on that scale.
+COST_SCALE = Decimal('0.0001')
+
+def to_decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+class CycleError(ValueError):
+    # A bill of materials that would contain the product itself through its semi-finished components
+    def __init__(self, product_ids):
+        super().__init__("Продукт входит в собственный состав через полуфабрикаты: "
+                         + ", ".join(map(str, sorted(product_ids))))
+        self.product_ids = product_ids
+
+def topological_order(product_ids, components):
+    # The products ordered so that each comes after every component it contains (Kahn). components(product)
+    # gives its semi-finished components; those outside product_ids are taken as already known. Returns
+    # (order, cyclic): products on a cycle, or containing one, cannot be ordered.
+    product_ids = set(product_ids)
+    waiting = {}
+    parents = {}
+    for product_id in product_ids:
+        inside = {component_id for component_id in components(product_id) if component_id in product_ids}
+        waiting[product_id] = len(inside)
+        for component_id in inside:
+            parents.setdefault(component_id, []).append(product_id)
+    ready = [product_id for product_id, count in waiting.items() if count == 0]
+    order = []
+    while ready:
+        product_id = ready.pop()
+        order.append(product_id)
+        for parent_id in parents.get(product_id, ()):
+            waiting[parent_id] -= 1
+            if waiting[parent_id] == 0:
+                ready.append(parent_id)
+    return order, product_ids - set(order)
+
+def calculate_product_costs(product_ids=None, conn=None):
+    # Rolled-up costs of the whole catalog (or of the given products) from one read of the bills, one query
+    # per level of nesting, instead of a query per product and component
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return {}
+    if conn is None:
+        try:
+            with db.get_connection() as conn:
+                return calculate_product_costs(product_ids, conn)
+        except db.Error as e:
+            print(f"Ошибка расчета стоимости продуктов: {e}")
+            return {}
+    cache = ProductCostCache()
+    cache.load(conn, product_ids)
+    if product_ids is None:
+        return cache.costs()
+    return cache.costs_for(product_ids, conn)
+
+class ProductCostCache:
+    # Materialized cost per product, loaded once in bulk and then kept current by the save paths. A bill line
+    # holds a material (price x quantity) or a semi-finished product (its own rolled-up cost x quantity), so
+    # the bills form a DAG that is costed components first, each product once. _lines holds every
+    # ProductMaterials row; _users (material -> lines) and _parents (semi-finished product -> lines using it)
+    # are the reverse indexes, so a price change re-rolls only the products above the material;
+    # _parts maps product -> bill lines. All updates take absolute values and are safe to apply twice.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._costs = {}
+        self._prices = {}
+        self._lines = {}
+        self._users = {}
+        self._parents = {}
+        self._parts = {}
+        self.cyclic = set()
+
+    def is_loaded(self):
+        return self._loaded
+
+    def load(self, conn, product_ids=None):
+        # The whole catalog, or just the given products with everything below them
+        lines = ProductMaterialRepository(conn)
+        rows = lines.lines_with_prices() if product_ids is None else lines.lines_below(product_ids)
+        with self._lock:
+            self._clear()
+            for pm_id, product_id, material_id, component_id, quantity, price in rows:
+                self._add_line(pm_id, product_id, material_id, component_id, to_decimal(quantity),
+                               None if price is None else to_decimal(price))
+            self._rollup(self._parts)
+            self._loaded = True
+
+    def ensure_loaded(self, conn):
+        with self._lock:
+            if not self._loaded:
+                self.load(conn)
+
+    def _clear(self):
+        self._costs = {}
+        self._prices = {}
+        self._lines = {}
+        self._users = {}
+        self._parents = {}
+        self._parts = {}
+        self.cyclic = set()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+            self._clear()
+
+    def costs(self):
+        with self._lock:
+            return dict(self._costs)
+
+    def costs_for(self, product_ids, conn):
+        with self._lock:
+            self.ensure_loaded(conn)
+            return {product_id: self._costs.get(product_id, ZERO) for product_id in product_ids}
+
+    def _add_line(self, pm_id, product_id, material_id, component_id, quantity, price):
+        self._lines[pm_id] = (product_id, material_id, component_id, quantity)
+        self._parts.setdefault(product_id, set()).add(pm_id)
+        if component_id is None:
+            self._users.setdefault(material_id, set()).add(pm_id)
+            self._prices[material_id] = price
+        else:
+            self._parents.setdefault(component_id, set()).add(pm_id)
+
+    def _drop_line(self, pm_id):
+        product_id, material_id, component_id, _ = self._lines.pop(pm_id)
+        self._parts[product_id].discard(pm_id)
+        index, key = (self._users, material_id) if component_id is None else (self._parents, component_id)
+        index[key].discard(pm_id)
+        if not index[key]:
+            del index[key]
+            if component_id is None:
+                del self._prices[material_id]
+        return product_id
+
+    def _components(self, product_id):
+        return [self._lines[pm_id][2] for pm_id in self._parts.get(product_id, ()) if self._lines[pm_id][2] is not None]
+
+    def _above(self, product_ids):
+        # The products and every product containing one of them, directly or through other components
+        found = set(product_ids)
+        stack = list(found)
+        while stack:
+            for pm_id in self._parents.get(stack.pop(), ()):
+                parent_id = self._lines[pm_id][0]
+                if parent_id not in found:
+                    found.add(parent_id)
+                    stack.append(parent_id)
+        return found
+
+    def _cost(self, product_id):
+        cost = ZERO
+        for pm_id in self._parts.get(product_id, ()):
+            _, material_id, component_id, quantity = self._lines[pm_id]
+            if component_id is None:
+                cost += self._prices[material_id] * quantity
+            else:
+                cost += self._costs.get(component_id, ZERO) * quantity
+        return cost.quantize(COST_SCALE, ROUND_HALF_UP)
+
+    def _rollup(self, product_ids):
+        # Recomputes the products and everything above them in topological order, so each cost is computed once
+        # from component costs that are already final; returns {product_id: cost} for all of them
+        affected = self._above(product_ids)
+        order, cyclic = topological_order(affected, self._components)
+        for product_id in order:
+            self._costs[product_id] = self._cost(product_id)
+        for product_id in cyclic:
+            self._costs[product_id] = ZERO
+        self.cyclic = (self.cyclic - affected) | cyclic
+        if cyclic:
+            print(f"Стоимость не рассчитана, продукт входит в собственный состав: {', '.join(map(str, sorted(cyclic)))}")
+        return {product_id: self._costs[product_id] for product_id in affected}
+
+    def material_price_changed(self, material_id, price):
+        with self._lock:
+            if not self._loaded or material_id not in self._users:
+                return {}
+            self._prices[material_id] = to_decimal(price)
+            return self._rollup({self._lines[pm_id][0] for pm_id in self._users[material_id]})
+
+    def products_reloaded(self, conn, product_ids):
+        # Bill of materials rewritten as a batch: replace the lines of these products from the database; the
+        # products above them are re-rolled as well and returned with the rest
+        with self._lock:
+            if not self._loaded:
+                return {}
+            product_ids = set(product_ids)
+            for product_id in product_ids:
+                for pm_id in list(self._parts.get(product_id, ())):
+                    self._drop_line(pm_id)
+            for pm_id, product_id, material_id, component_id, quantity, price in ProductMaterialRepository(conn).lines_with_prices(product_ids):
+                self._add_line(pm_id, product_id, material_id, component_id, to_decimal(quantity),
+                               None if price is None else to_decimal(price))
+            return self._rollup(product_ids)
+
+product_costs = ProductCostCache()
+
+def nested_costs(conn, cache=product_costs):
+    # {ProductID: cost} for the products with semi-finished lines only, for ProductRepository.iter_with_costs to
+    # stream the rest with their costs summed in SQL. Only those products and what is below them are held in
+    # memory, nothing at all without nesting; a cache already loaded is used as it is.
+    product_ids = {product_id for product_id, _ in ProductMaterialRepository(conn).component_links()}
+    if not product_ids:
+        return {}
+    if cache.is_loaded():
+        return cache.costs_for(product_ids, conn)
+    return calculate_product_costs(product_ids, conn)
+
+def with_costs(conn, rows, cache=product_costs):
+    # Products tab rows get the computed cost appended as the last column
+    costs = cache.costs_for([row[0] for row in rows], conn)
+    return [row + (costs.get(row[0], ZERO),) for row in rows]
@@ -0,0 +1,200 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from instrumentation import InstrumentedConnection, query_stats, startup
+
+DB_CONFIG = {
+    'host': 'localhost',
+    'port': 3306,
+    'user': 'root',
+    'password': '',
+    'database': 'MosaicDB'
+}
+POOL_SIZE = int(os.environ.get('MOSAIC_DB_POOL_SIZE', 5))
+CHECKOUT_TIMEOUT = 30.0
+# Connections idle for less than this are handed out without a ping round trip
+PING_AFTER_IDLE = 5.0
+# Server-side prepared statements kept per connection; the least recently used one is closed beyond this
+PREPARED_PER_CONNECTION = 32
+
+def driver():
+    # mysql.connector is a noticeable share of startup: it is loaded on first use, normally on a worker thread
+    import mysql.connector
+    startup.mark('mysql_driver')
+    return mysql.connector
+
+def __getattr__(name):
+    # db.Error, db.IntegrityError, db.PoolError and db.errorcode load the driver on first access, so other
+    # modules can name its exceptions in except clauses without importing it at startup
+    if name == 'errorcode':
+        from mysql.connector import errorcode
+        return errorcode
+    if name in ('Error', 'IntegrityError', 'PoolError'):
+        return getattr(driver(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class PreparedStatements:
+    # Prepared cursors of one connection by statement text: the server parses a statement once per
+    # connection, later executions send only the parameters in the binary protocol.
+    def __init__(self, conn, limit=PREPARED_PER_CONNECTION):
+        self.conn = conn
+        self.limit = limit
+        self._cursors = OrderedDict()
+
+    def cursor(self, statement):
+        # Returns (statement, cursor). A prepared cursor prepares again unless it is given the very string
+        # object it was prepared with, so callers execute the returned statement, not their own copy.
+        entry = self._cursors.pop(statement, None)
+        if entry is None:
+            if len(self._cursors) >= self.limit:
+                _, (_, oldest) = self._cursors.popitem(last=False)
+                try:
+                    oldest.close()
+                except driver().Error:
+                    pass
+            entry = (statement, self.conn.cursor(prepared=True))
+        self._cursors[statement] = entry
+        return entry
+
+    def clear(self):
+        # After a reconnect the server no longer knows the statements
+        self._cursors.clear()
+
+class ConnectionPool:
+    def __init__(self, size=POOL_SIZE, timeout=CHECKOUT_TIMEOUT, ping_after_idle=PING_AFTER_IDLE, **config):
+        self.size = size
+        self.timeout = timeout
+        self.ping_after_idle = ping_after_idle
+        self.config = config
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.discarded = 0
+
+    def _connect(self):
+        conn = driver().connect(**self.config)
+        conn.prepared_statements = PreparedStatements(conn)
+        startup.mark('first_connection')
+        with self._lock:
+            self.connects += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._open -= 1
+            self.discarded += 1
+        try:
+            conn.close()
+        except driver().Error:
+            pass
+
+    def _check(self, conn, released_at):
+        if time.monotonic() - released_at < self.ping_after_idle:
+            return conn
+        try:
+            conn.ping(reconnect=False)
+        except driver().Error:
+            # Stale connection (server restart, wait_timeout): reconnect in place
+            try:
+                conn.reconnect(attempts=2, delay=0)
+            except driver().Error:
+                self._discard(conn)
+                raise
+            conn.prepared_statements.clear()
+            with self._lock:
+                self.reconnects += 1
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            self.checkouts += 1
+        try:
+            conn, released_at = self._idle.get_nowait()
+            return self._check(conn, released_at)
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._open < self.size
+            if can_open:
+                self._open += 1
+        if can_open:
+            try:
+                return self._connect()
+            except driver().Error:
+                with self._lock:
+                    self._open -= 1
+                raise
+        start = time.perf_counter()
+        try:
+            conn, released_at = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise driver().PoolError(f"Нет свободных подключений к базе данных за {self.timeout} с")
+        finally:
+            with self._lock:
+                self.waits += 1
+                self.wait_time += time.perf_counter() - start
+        return self._check(conn, released_at)
+
+    def release(self, conn):
+        try:
+            if conn.unread_result:
+                conn.consume_results()
+            if conn.in_transaction:
+                conn.rollback()
+        except driver().Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        conn = self.acquire()
+        query_stats.record_acquire((time.perf_counter() - start) * 1000)
+        proxy = InstrumentedConnection(conn, query_stats) if query_stats.enabled else conn
+        try:
+            yield proxy
+        finally:
+            if proxy is not conn:
+                proxy.finish()
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._open -= 1
+            try:
+                conn.close()
+            except driver().Error:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': self._idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'discarded': self.discarded,
+            }
+
+pool = ConnectionPool(**DB_CONFIG)
+
+def get_connection():
+    return pool.connection()
@@ -0,0 +1,73 @@
+import argparse
+import csv
+import sys
+import time
+from decimal import Decimal
+from db import get_connection
+from costs import nested_costs
+from repository import ProductRepository
+
+FETCH_SIZE = 1000
+HEADER = ["Артикул", "Тип", "Наименование", "Мин. стоимость для партнера", "Ширина рулона", "Стоимость"]
+CENT = Decimal('0.01')
+
+def stream_products(conn):
+    costs = nested_costs(conn)
+    for article, type_name, name, min_cost, roll_width, cost in ProductRepository(conn).iter_with_costs(FETCH_SIZE, costs):
+        yield article, type_name, name, min_cost, roll_width, Decimal(cost).quantize(CENT)
+
+class CsvSink:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.file, delimiter=';')
+
+    def write(self, row):
+        self.writer.writerow([f"{value:.2f}" if isinstance(value, Decimal) else value for value in row])
+
+    def close(self):
+        self.file.close()
+
+class XlsxSink:
+    def __init__(self, path):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise RuntimeError("Для экспорта в XLSX установите пакет openpyxl")
+        self.path = path
+        # write_only workbooks flush rows to a temporary file instead of keeping cells in memory
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("Продукты")
+
+    def write(self, row):
+        self.sheet.append([float(value) if isinstance(value, Decimal) else value for value in row])
+
+    def close(self):
+        self.workbook.save(self.path)
+
+def export_products(path, progress=None):
+    sink = XlsxSink(path) if path.lower().endswith('.xlsx') else CsvSink(path)
+    count = 0
+    try:
+        sink.write(HEADER)
+        with get_connection() as conn:
+            for row in stream_products(conn):
+                sink.write(row)
+                count += 1
+                if progress and count % FETCH_SIZE == 0:
+                    progress(count)
+    finally:
+        sink.close()
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Экспорт продуктов со стоимостью в CSV/XLSX")
+    parser.add_argument('path', help="файл .csv или .xlsx")
+    args = parser.parse_args(argv)
+    started = time.perf_counter()
+    count = export_products(args.path, progress=lambda n: print(f"\r{n} строк", end="", file=sys.stderr))
+    print(file=sys.stderr)
+    print(f"Выгружено {count} продуктов за {time.perf_counter() - started:.1f} с")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from db import get_connection
+from repository import (Product, Material, ProductMaterial, ProductRepository, MaterialRepository,
+                        ProductMaterialRepository, ProductTypeRepository, MaterialTypeRepository, ChangeLogRepository)
+
+BATCH_SIZE = 5000
+
+# Accepted header spellings per target column: schema names, the captions used in the app and the Excel sheets
+HEADERS = {
+    'products': {
+        'Article': ["Article", "Артикул"],
+        'ProductType': ["ProductType", "TypeName", "Тип", "Тип продукта", "Тип продукции"],
+        'Name': ["Name", "Наименование", "Наименование продукции"],
+        'MinCostForPartner': ["MinCostForPartner", "Мин. стоимость для партнера", "Минимальная стоимость для партнера"],
+        'RollWidth': ["RollWidth", "Ширина рулона"],
+    },
+    'materials': {
+        'Name': ["Name", "Наименование", "Наименование материала"],
+        'MaterialType': ["MaterialType", "TypeName", "Тип", "Тип материала"],
+        'UnitPrice': ["UnitPrice", "Цена единицы", "Цена единицы материала"],
+        'StockQuantity': ["StockQuantity", "Количество на складе"],
+        'Unit': ["Unit", "Единица измерения"],
+        'QuantityPerPackage': ["QuantityPerPackage", "Количество в упаковке"],
+        'MinQuantity': ["MinQuantity", "Минимальное количество"],
+    },
+    'product_materials': {
+        'Article': ["Article", "Артикул", "Продукция"],
+        'Material': ["Material", "Материал", "Наименование материала"],
+        'Quantity': ["Quantity", "Количество", "Необходимое количество материала"],
+        'Component': ["Component", "Полуфабрикат", "Артикул полуфабриката"],
+    },
+}
+
+# Columns a file may leave out; they read as empty
+OPTIONAL_HEADERS = {
+    'product_materials': {'Component'},
+}
+
+REPOSITORIES = {
+    'products': ProductRepository,
+    'materials': MaterialRepository,
+    'product_materials': ProductMaterialRepository,
+}
+
+class RowError(ValueError):
+    pass
+
+class ImportReport:
+    def __init__(self, table, path):
+        self.table = table
+        self.path = path
+        self.read = 0
+        self.inserted = 0
+        self.rejected = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def rows_per_second(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (f"{self.table}: прочитано {self.read}, загружено {self.inserted}, отклонено {len(self.rejected)} "
+                f"за {self.elapsed:.1f} с ({self.rows_per_second():.0f} строк/с)")
+
+def iter_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+def iter_xlsx(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("Для импорта XLSX установите пакет openpyxl")
+    # read_only streams the sheet instead of building it in memory
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield ["" if value is None else value for value in row]
+    finally:
+        workbook.close()
+
+def iter_records(path, table):
+    rows = iter_xlsx(path) if path.lower().endswith(('.xlsx', '.xlsm')) else iter_csv(path)
+    header = [str(cell).strip().lower() for cell in next(rows, [])]
+    positions = {}
+    for column, names in HEADERS[table].items():
+        for name in names:
+            if name.lower() in header:
+                positions[column] = header.index(name.lower())
+                break
+        else:
+            if column in OPTIONAL_HEADERS.get(table, ()):
+                continue
+            raise RuntimeError(f"В файле нет столбца {names[0]} ({', '.join(names[1:])})")
+    for line, row in enumerate(rows, 2):
+        if not any(str(cell).strip() for cell in row):
+            continue
+        yield line, {column: (row[i] if i < len(row) else "") for column, i in positions.items()}
+
+def text(value, column):
+    value = str(value).strip()
+    if not value:
+        raise RowError(f"пустое поле {column}")
+    return value
+
+def number(value, column, integer=False, positive=False):
+    try:
+        value = Decimal(str(value).strip().replace(" ", "").replace(",", "."))
+    except InvalidOperation:
+        raise RowError(f"{column}: не число")
+    if value < 0 or (positive and value == 0):
+        raise RowError(f"{column}: недопустимое значение {value}")
+    if integer:
+        if value != value.to_integral_value():
+            raise RowError(f"{column}: ожидается целое число")
+        return int(value)
+    return value.quantize(Decimal('0.01'))
+
+def lookup(mapping, value, what):
+    key = text(value, what).lower()
+    if key not in mapping:
+        raise RowError(f"{what} '{value}' не найден")
+    return mapping[key]
+
+def load_map(pairs):
+    return {str(name).strip().lower(): row_id for row_id, name in pairs}
+
+def build_converter(conn, table):
+    if table == 'products':
+        types = load_map(ProductTypeRepository(conn).names())
+        # Article is unique: a repeat is rejected as a row instead of failing the whole batch INSERT
+        articles = load_map(ProductRepository(conn).names())
+
+        def convert_product(r):
+            product = Product(None, text(r['Article'], "Article"), lookup(types, r['ProductType'], "тип продукта"),
+                              text(r['Name'], "Name"), number(r['MinCostForPartner'], "MinCostForPartner"),
+                              number(r['RollWidth'], "RollWidth"))
+            key = product.article.strip().lower()
+            if key in articles:
+                raise RowError(f"артикул '{product.article}' уже есть")
+            articles[key] = None
+            return product
+        return convert_product
+    if table == 'materials':
+        types = load_map(MaterialTypeRepository(conn).names())
+        return lambda r: Material(None, text(r['Name'], "Name"), lookup(types, r['MaterialType'], "тип материала"),
+                                  number(r['UnitPrice'], "UnitPrice"), number(r['StockQuantity'], "StockQuantity"),
+                                  text(r['Unit'], "Unit"), number(r['QuantityPerPackage'], "QuantityPerPackage", True, True),
+                                  number(r['MinQuantity'], "MinQuantity"))
+    products = load_map(ProductRepository(conn).names())
+    materials = load_map(MaterialRepository(conn).names())
+    # Semi-finished links already in the catalog plus the ones accepted from the file, to refuse cycles
+    components = {}
+    for product_id, component_id in ProductMaterialRepository(conn).component_links():
+        components.setdefault(product_id, set()).add(component_id)
+
+    def reaches(start, target):
+        stack, seen = [start], set()
+        while stack:
+            product_id = stack.pop()
+            if product_id == target:
+                return True
+            if product_id not in seen:
+                seen.add(product_id)
+                stack.extend(components.get(product_id, ()))
+        return False
+
+    def convert_line(r):
+        product_id = lookup(products, r['Article'], "продукт")
+        quantity = number(r['Quantity'], "Quantity")
+        material, component = str(r['Material']).strip(), str(r.get('Component', "")).strip()
+        if bool(material) == bool(component):
+            raise RowError("укажите либо материал, либо полуфабрикат")
+        if material:
+            return ProductMaterial(None, product_id, lookup(materials, material, "материал"), quantity)
+        component_id = lookup(products, component, "полуфабрикат")
+        if reaches(component_id, product_id):
+            raise RowError(f"полуфабрикат '{component}' содержит сам продукт (цикл в составе)")
+        components.setdefault(product_id, set()).add(component_id)
+        return ProductMaterial(None, product_id, None, quantity, component_id)
+    return convert_line
+
+def import_file(table, path, batch_size=BATCH_SIZE, progress=None):
+    report = ImportReport(table, path)
+    with get_connection() as conn:
+        repository = REPOSITORIES[table](conn)
+        changes = ChangeLogRepository(conn)
+        convert = build_converter(conn, table)
+        batch = []
+
+        def flush():
+            # One multi-row INSERT and one commit per chunk; other instances reload the table
+            repository.insert_many(batch)
+            changes.record(repository.table)
+            conn.commit()
+            report.inserted += len(batch)
+            batch.clear()
+            report.elapsed = time.perf_counter() - report.started
+            if progress:
+                progress(report)
+
+        for line, record in iter_records(path, table):
+            report.read += 1
+            try:
+                batch.append(convert(record))
+            except RowError as e:
+                report.rejected.append((line, str(e)))
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+def write_rejects(report, path):
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(["Строка", "Причина"])
+        writer.writerows(report.rejected)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Массовая загрузка данных в MosaicDB из CSV/XLSX")
+    parser.add_argument('table', choices=sorted(HEADERS))
+    parser.add_argument('path')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--rejects', help="CSV-файл для отклонённых строк")
+    args = parser.parse_args(argv)
+    report = import_file(args.table, args.path, args.batch_size,
+                         progress=lambda r: print(f"\r{r.inserted} строк, {r.rows_per_second():.0f} строк/с", end="", file=sys.stderr))
+    print(file=sys.stderr)
+    print(report.summary())
+    for line, reason in report.rejected[:20]:
+        print(f"  строка {line}: {reason}")
+    if args.rejects and report.rejected:
+        write_rejects(report, args.rejects)
+        print(f"Отклонённые строки записаны в {os.path.abspath(args.rejects)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,349 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('MOSAIC_DB_INSTRUMENT', '1') != '0'
+SLOW_QUERY_MS = float(os.environ.get('MOSAIC_SLOW_QUERY_MS', 200))
+# The same SELECT from the same call site this many times within the window looks like a query per row.
+# Writes are left out: a COMMIT, SAVEPOINT or ChangeLog INSERT per save is what a busy save path looks like.
+N_PLUS_ONE_CALLS = 20
+N_PLUS_ONE_WINDOW = 1.0
+SAMPLES_PER_STATEMENT = 1000
+# From the start of the process to the window on screen; a longer start is reported
+STARTUP_BUDGET_MS = float(os.environ.get('MOSAIC_STARTUP_BUDGET_MS', 1500))
+# Frames in these files are skipped when looking for the code that issued a query
+DATA_LAYER_FILES = {'db.py', 'repository.py', 'instrumentation.py', 'contextlib.py'}
+
+def normalize(statement):
+    statement = re.sub(r"\s+", " ", statement.strip())
+    return re.sub(r"IN \((?:%s, )*%s\)", "IN (...)", statement)
+
+def call_site():
+    frame = sys._getframe(2)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in DATA_LAYER_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}:{frame.f_lineno}"
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+class StatementStats:
+    __slots__ = ('statement', 'call_site', 'count', 'rows', 'total_ms', 'samples', 'recent', 'n_plus_one', 'slow',
+                 'read')
+
+    def __init__(self, statement, site):
+        self.statement = statement
+        self.call_site = site
+        self.count = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.samples = deque(maxlen=SAMPLES_PER_STATEMENT)
+        self.recent = deque(maxlen=N_PLUS_ONE_CALLS)
+        self.n_plus_one = False
+        self.slow = 0
+        self.read = statement.lstrip()[:6].upper() == "SELECT"
+
+    def as_dict(self):
+        samples = list(self.samples)
+        return {
+            'statement': self.statement,
+            'call_site': self.call_site,
+            'count': self.count,
+            'rows': self.rows,
+            'total_ms': round(self.total_ms, 3),
+            'p50_ms': round(percentile(samples, 0.5), 3),
+            'p95_ms': round(percentile(samples, 0.95), 3),
+            'max_ms': round(max(samples, default=0.0), 3),
+            'slow': self.slow,
+            'n_plus_one': self.n_plus_one,
+        }
+
+class QueryStats:
+    def __init__(self, enabled=ENABLED, slow_ms=SLOW_QUERY_MS):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._statements = {}
+        self._acquire = deque(maxlen=SAMPLES_PER_STATEMENT)
+        self.slow_queries = deque(maxlen=100)
+
+    def record(self, statement, site, elapsed_ms, rows):
+        now = time.monotonic()
+        key = (statement, site)
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                entry = self._statements[key] = StatementStats(statement, site)
+            entry.count += 1
+            entry.rows += rows
+            entry.total_ms += elapsed_ms
+            entry.samples.append(elapsed_ms)
+            if entry.read:
+                entry.recent.append(now)
+                if len(entry.recent) == N_PLUS_ONE_CALLS and now - entry.recent[0] <= N_PLUS_ONE_WINDOW:
+                    entry.n_plus_one = True
+            if elapsed_ms >= self.slow_ms:
+                entry.slow += 1
+                self.slow_queries.append((time.time(), elapsed_ms, rows, site, statement))
+        if elapsed_ms >= self.slow_ms:
+            print(f"Медленный запрос {elapsed_ms:.1f} мс ({rows} строк) из {site}: {statement}")
+
+    def record_acquire(self, elapsed_ms):
+        with self._lock:
+            self._acquire.append(elapsed_ms)
+
+    def statements(self):
+        # Aggregates sorted by total time, heaviest first
+        with self._lock:
+            rows = [entry.as_dict() for entry in self._statements.values()]
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+    def n_plus_one(self):
+        return [row for row in self.statements() if row['n_plus_one']]
+
+    def acquire_stats(self):
+        with self._lock:
+            samples = list(self._acquire)
+        return {
+            'count': len(samples),
+            'p50_ms': round(percentile(samples, 0.5), 3),
+            'p95_ms': round(percentile(samples, 0.95), 3),
+            'max_ms': round(max(samples, default=0.0), 3),
+        }
+
+    def snapshot(self):
+        return {
+            'statements': self.statements(),
+            'acquire': self.acquire_stats(),
+            'slow_queries': [
+                {'at': at, 'ms': round(ms, 3), 'rows': rows, 'call_site': site, 'statement': statement}
+                for at, ms, rows, site, statement in list(self.slow_queries)
+            ],
+        }
+
+    def dump_json(self, path, extra=None):
+        data = self.snapshot()
+        if extra:
+            data.update(extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._acquire.clear()
+            self.slow_queries.clear()
+
+class InstrumentedCursor:
+    # Times a statement from execute until its result set is read to the end (or the cursor is reused),
+    # so unbuffered reads are counted in full
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._pending = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _finish(self):
+        if self._pending is not None:
+            statement, site, start, rows = self._pending
+            self._pending = None
+            self._stats.record(statement, site, (time.perf_counter() - start) * 1000, rows)
+
+    def _run(self, method, statement, params):
+        self._finish()
+        site = call_site()
+        start = time.perf_counter()
+        result = method(statement, params)
+        if self._cursor.description is None:
+            rows = max(self._cursor.rowcount, 0)
+            self._stats.record(normalize(statement), site, (time.perf_counter() - start) * 1000, rows)
+        else:
+            self._pending = (normalize(statement), site, start, 0)
+        return result
+
+    def execute(self, statement, params=()):
+        return self._run(self._cursor.execute, statement, params)
+
+    def executemany(self, statement, seq_params):
+        return self._run(self._cursor.executemany, statement, seq_params)
+
+    def _add_rows(self, count):
+        if self._pending is not None:
+            statement, site, start, rows = self._pending
+            self._pending = (statement, site, start, rows + count)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is None:
+            self._finish()
+        else:
+            self._add_rows(1)
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._cursor.fetchmany(size)
+        self._add_rows(len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._add_rows(len(rows))
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        return self._cursor.close()
+
+class InstrumentedConnection:
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+        self._cursors = []
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return self.track(self._conn.cursor(*args, **kwargs))
+
+    def track(self, cursor):
+        # Also for cursors that outlive the checkout (db.PreparedStatements): only the wrapper is per checkout
+        cursor = InstrumentedCursor(cursor, self._stats)
+        self._cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        site = call_site()
+        start = time.perf_counter()
+        self._conn.commit()
+        self._stats.record("COMMIT", site, (time.perf_counter() - start) * 1000, 0)
+
+    def finish(self):
+        for cursor in self._cursors:
+            cursor._finish()
+        self._cursors.clear()
+
+class ExplainConnection:
+    # Wraps a connection for the index check (migrations.py --check): every SELECT, UPDATE and DELETE is
+    # EXPLAINed with its real parameters. SELECTs also run so the next call gets real ids; writes never do.
+    # Statements under full_scan() read the whole catalog on purpose and are only explained.
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = {}
+        self.scanning = False
+
+    def cursor(self, **kwargs):
+        return ExplainCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.conn.rollback()
+
+    @contextmanager
+    def full_scan(self):
+        self.scanning = True
+        try:
+            yield
+        finally:
+            self.scanning = False
+
+    def explain(self, statement, params):
+        key = normalize(statement)
+        if key in self.plans:
+            return
+        cursor = self.conn.cursor(dictionary=True)
+        cursor.execute("EXPLAIN " + statement, params)
+        self.plans[key] = (call_site(), self.scanning, cursor.fetchall())
+
+class ExplainCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = None
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        params = tuple(params)
+        verb = query.lstrip().split(None, 1)[0].upper()
+        if verb in ("SELECT", "UPDATE", "DELETE"):
+            self.connection.explain(query, params)
+        if verb == "SELECT" and not self.connection.scanning:
+            self.cursor = self.connection.conn.cursor()
+            self.cursor.execute(query, params)
+        else:
+            self.cursor = None
+            self.rowcount = 1
+
+    def executemany(self, query, rows):
+        rows = list(rows)
+        if rows:
+            self.execute(query, rows[0])
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return self.cursor.fetchone() if self.cursor else None
+
+    def fetchall(self):
+        return self.cursor.fetchall() if self.cursor else []
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size) if self.cursor else []
+
+class StartupTimer:
+    # Milestones of one application start, in ms since this module was imported (main.py imports it first).
+    # Only the first occurrence of a milestone counts, so later reloads and reconnects do not move it.
+    def __init__(self, budget_ms=STARTUP_BUDGET_MS):
+        self.budget_ms = budget_ms
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._marks = {}
+
+    def mark(self, name):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        with self._lock:
+            self._marks.setdefault(name, elapsed)
+
+    def elapsed(self, name):
+        with self._lock:
+            return self._marks.get(name)
+
+    def as_dict(self):
+        with self._lock:
+            marks = sorted(self._marks.items(), key=lambda item: item[1])
+        return {'budget_ms': self.budget_ms, 'marks': {name: round(ms, 1) for name, ms in marks}}
+
+    def over_budget(self, name='window_shown'):
+        elapsed = self.elapsed(name)
+        return elapsed is not None and elapsed > self.budget_ms
+
+    def report(self):
+        lines = [f"Запуск (бюджет {self.budget_ms:.0f} мс до показа окна):"]
+        previous = 0.0
+        for name, ms in self.as_dict()['marks'].items():
+            lines.append(f"  {name:<20} {ms:8.1f} мс  (+{ms - previous:.1f})")
+            previous = ms
+        return "\n".join(lines)
+
+query_stats = QueryStats()
+startup = StartupTimer()
@@ -1,49 +1,71 @@
+import os
 import sys
+# Imported first: its clock is the zero of the startup timing report
+from instrumentation import query_stats, startup
+import sqlite3
+from decimal import InvalidOperation
+from functools import lru_cache
 from PySide6.QtWidgets import (QApplication, QMainWindow, QTabWidget, QTableWidget, QTableWidgetItem, QPushButton,
                                QVBoxLayout, QWidget, QDialog, QFormLayout, QLineEdit, QComboBox, QLabel, QMessageBox,
-                               QHBoxLayout)
-from PySide6.QtGui import QIcon, QFont, QPixmap, QDoubleValidator, QIntValidator
-from PySide6.QtCore import Qt
-import mysql.connector
-from mysql.connector import Error
-
-def create_connection():
-    try:
-        connection = mysql.connector.connect(
-            host='localhost',
-            port=3306,
-            user='root',
-            password='',
-            database='MosaicDB'
-        )
-        return connection
-    except Error as e:
-        print(f"Ошибка подключения к MySQL: {e}")
-        return None
+                               QHBoxLayout, QTableView, QInputDialog, QFileDialog, QStyledItemDelegate,
+                               QCompleter)
+from PySide6.QtGui import QIcon, QFont, QPixmap, QDoubleValidator, QIntValidator, QStandardItemModel, QStandardItem
+from PySide6.QtCore import Qt, QModelIndex, QTimer
+import db
+from db import get_connection, pool
+from table_models import LazyTableModel, format_2f
+from workers import runner
+from refcache import reference_cache
+from costs import CycleError, product_costs, to_decimal
+from pricing import partner_price_cache, with_prices
+from importer import import_file
+from repository import (ConflictError, Product, Material, ProductRepository, MaterialRepository,
+                        ProductMaterialRepository)
+from changefeed import ChangeFeed
+from snapshot import Snapshot
+from bom import BomEditSession
+from writes import write_queue
+from exporter import export_products
+from replenishment import COLUMNS as PLAN_COLUMNS, COST_COLUMN as PLAN_COST_COLUMN, HUNDREDTHS, load_plan
+
+# Columns of the computed cost and partner price in the Products tab
+PRODUCT_COST_COLUMN = 5
+PRODUCT_PRICE_COLUMN = 6
+SEARCH_DELAY_MS = 300
+DIAGNOSTICS_REFRESH_MS = 2000
+CHANGE_POLL_MS = 2000
+RECONNECT_MS = 30000
+LOGO_PATH = 'Наш декор.png'
+STARTUP_REPORT = os.environ.get('MOSAIC_STARTUP_REPORT', '0') != '0'
+
+def prices_loaded():
+    return product_costs.is_loaded() and partner_price_cache.is_loaded()
+
+@lru_cache(maxsize=None)
+def app_icon():
+    # Every window and dialog shares one decoded icon instead of reading the PNG again
+    return QIcon(LOGO_PATH)
+
+@lru_cache(maxsize=None)
+def logo_pixmap(size):
+    return QPixmap(LOGO_PATH).scaled(size, size, Qt.KeepAspectRatio)
 
 class AddEditMaterialDialog(QDialog):
     def __init__(self, parent=None, material_id=None):
         super().__init__(parent)
         self.setWindowTitle("Добавить материал" if material_id is None else "Редактировать материал")
-        self.setWindowIcon(QIcon('Наш декор.png'))
+        self.setWindowIcon(app_icon())
         self.material_id = material_id
+        self.loaded_price = None
+        self.loaded_version = None
+        self.saved_row = None
+        self.changed_costs = {}
+        self.changed_prices = {}
 
         layout = QFormLayout()
         self.name_edit = QLineEdit()
         layout.addRow("Наименование:", self.name_edit)
         self.type_combo = QComboBox()
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT MaterialTypeID, TypeName FROM MaterialTypes")
-                types = cursor.fetchall()
-                for type_id, type_name in types:
-                    self.type_combo.addItem(type_name, type_id)
-            except Error as e:
-                print(f"Ошибка загрузки типов материалов: {e}")
-            finally:
-                conn.close()
         layout.addRow("Тип материала:", self.type_combo)
         self.unit_price_edit = QLineEdit()
         self.unit_price_edit.setValidator(QDoubleValidator(0.0, 1000000.0, 2))
@@ -64,32 +86,44 @@ class AddEditMaterialDialog(QDialog):
         self.save_button.clicked.connect(self.save_material)
         layout.addRow(self.save_button)
         self.setLayout(layout)
-        if material_id:
-            self.load_material()
+        types = reference_cache.peek('material_types')
+        if types is not None and not material_id:
+            self.show_material((types, None))
+        else:
+            self.save_button.setEnabled(False)
+            runner.submit(self.load_material, key=id(self), on_result=self.show_material,
+                          on_error=lambda message: print(f"Ошибка загрузки материала: {message}"))
+
+    def done(self, result):
+        runner.cancel(id(self))
+        super().done(result)
 
     def load_material(self):
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT Name, MaterialTypeID, UnitPrice, StockQuantity, Unit, QuantityPerPackage, MinQuantity "
-                               "FROM Materials WHERE MaterialID = %s", (self.material_id,))
-                row = cursor.fetchone()
-                if row:
-                    name, type_id, unit_price, stock_qty, unit, qty_per_pkg, min_qty = row
-                    self.name_edit.setText(name)
-                    index = self.type_combo.findData(type_id)
-                    if index >= 0:
-                        self.type_combo.setCurrentIndex(index)
-                    self.unit_price_edit.setText(str(unit_price))
-                    self.stock_qty_edit.setText(str(stock_qty))
-                    self.unit_edit.setText(unit)
-                    self.qty_per_pkg_edit.setText(str(qty_per_pkg))
-                    self.min_qty_edit.setText(str(min_qty))
-            except Error as e:
-                print(f"Ошибка загрузки материала: {e}")
-            finally:
-                conn.close()
+        types = reference_cache.get('material_types')
+        row = None
+        if self.material_id:
+            with get_connection() as conn:
+                row = MaterialRepository(conn).get(self.material_id)
+        return types, row
+
+    def show_material(self, result):
+        types, row = result
+        self.type_combo.clear()
+        for type_id, type_name in types:
+            self.type_combo.addItem(type_name, type_id)
+        if row:
+            self.name_edit.setText(row.name)
+            index = self.type_combo.findData(row.type_id)
+            if index >= 0:
+                self.type_combo.setCurrentIndex(index)
+            self.unit_price_edit.setText(str(row.unit_price))
+            self.loaded_price = float(row.unit_price)
+            self.loaded_version = row.version
+            self.stock_qty_edit.setText(str(row.stock_quantity))
+            self.unit_edit.setText(row.unit)
+            self.qty_per_pkg_edit.setText(str(row.quantity_per_package))
+            self.min_qty_edit.setText(str(row.min_quantity))
+        self.save_button.setEnabled(True)
 
     def save_material(self):
         if not all([self.name_edit.text(), self.unit_price_edit.text(), self.stock_qty_edit.text(),
@@ -106,48 +140,57 @@ class AddEditMaterialDialog(QDialog):
         if unit_price < 0 or stock_qty < 0 or min_qty < 0:
             QMessageBox.warning(self, "Ошибка", "Цена, количество на складе и минимальное количество не могут быть отрицательными!")
             return
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                if self.material_id:
-                    query = ("UPDATE Materials SET Name=%s, MaterialTypeID=%s, UnitPrice=%s, StockQuantity=%s, "
-                             "Unit=%s, QuantityPerPackage=%s, MinQuantity=%s WHERE MaterialID=%s")
-                    cursor.execute(query, (name, type_id, unit_price, stock_qty, unit, qty_per_pkg, min_qty, self.material_id))
-                else:
-                    query = ("INSERT INTO Materials (Name, MaterialTypeID, UnitPrice, StockQuantity, Unit, QuantityPerPackage, "
-                             "MinQuantity) VALUES (%s, %s, %s, %s, %s, %s, %s)")
-                    cursor.execute(query, (name, type_id, unit_price, stock_qty, unit, qty_per_pkg, min_qty))
-                conn.commit()
-                self.accept()
-            except Error as e:
-                QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить материал: {e}")
-            finally:
-                conn.close()
+        self.save_button.setEnabled(False)
+        material = Material(self.material_id, name, type_id, unit_price, stock_qty, unit, qty_per_pkg, min_qty,
+                            self.loaded_version)
+        runner.submit(self.write_material, material, on_result=self.saved, on_error=self.save_failed)
+
+    def write_material(self, material):
+        # Returns the saved Materials tab row and, after a price change, the new costs of dependent products;
+        # None if someone else saved the material after it was loaded
+        try:
+            material_id = write_queue.save(MaterialRepository, material)
+        except ConflictError:
+            return None
+        with get_connection() as conn:
+            rows = MaterialRepository(conn).tab_rows_by_id([material_id])
+            costs = prices = {}
+            if self.material_id and material.unit_price != self.loaded_price:
+                costs = product_costs.material_price_changed(material_id, material.unit_price)
+                prices = partner_price_cache.prices_for(list(costs), conn) if costs else {}
+        reference_cache.invalidate('material_prices', 'material_index')
+        return (rows[0] if rows else None), costs, prices
+
+    def saved(self, result):
+        if result is None:
+            QMessageBox.warning(self, "Конфликт", "Материал изменен другим пользователем. "
+                                                  "Загружены актуальные данные, внесите изменения заново.")
+            runner.submit(self.load_material, key=id(self), on_result=self.show_material,
+                          on_error=lambda message: print(f"Ошибка загрузки материала: {message}"))
+            return
+        self.saved_row, self.changed_costs, self.changed_prices = result
+        self.accept()
+
+    def save_failed(self, message):
+        self.save_button.setEnabled(True)
+        QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить материал: {message}")
 
 class AddEditProductDialog(QDialog):
     def __init__(self, parent=None, product_id=None):
         super().__init__(parent)
         self.setWindowTitle("Добавить продукт" if product_id is None else "Редактировать продукт")
-        self.setWindowIcon(QIcon('Наш декор.png'))
+        self.setWindowIcon(app_icon())
         self.product_id = product_id
+        self.loaded_version = None
+        self.saved_row = None
+        # New costs and partner prices after bill of materials saves: this product and the ones using it
+        self.changed_costs = {}
+        self.changed_prices = {}
 
         layout = QFormLayout()
         self.article_edit = QLineEdit()
         layout.addRow("Артикул:", self.article_edit)
         self.type_combo = QComboBox()
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT ProductTypeID, TypeName FROM ProductTypes")
-                types = cursor.fetchall()
-                for type_id, type_name in types:
-                    self.type_combo.addItem(type_name, type_id)
-            except Error as e:
-                print(f"Ошибка загрузки типов продуктов: {e}")
-            finally:
-                conn.close()
         layout.addRow("Тип продукта:", self.type_combo)
         self.name_edit = QLineEdit()
         layout.addRow("Наименование:", self.name_edit)
@@ -166,34 +209,50 @@ class AddEditProductDialog(QDialog):
         self.save_button.clicked.connect(self.save_product)
         layout.addRow(self.save_button)
         self.setLayout(layout)
-        if product_id:
-            self.load_product()
+        types = reference_cache.peek('product_types')
+        if types is not None and not product_id:
+            self.show_product((types, None))
+        else:
+            self.save_button.setEnabled(False)
+            runner.submit(self.load_product, key=id(self), on_result=self.show_product,
+                          on_error=lambda message: print(f"Ошибка загрузки продукта: {message}"))
+
+    def done(self, result):
+        runner.cancel(id(self))
+        super().done(result)
 
     def load_product(self):
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT Article, ProductTypeID, Name, MinCostForPartner, RollWidth "
-                               "FROM Products WHERE ProductID = %s", (self.product_id,))
-                row = cursor.fetchone()
-                if row:
-                    article, type_id, name, min_cost, roll_width = row
-                    self.article_edit.setText(article)
-                    index = self.type_combo.findData(type_id)
-                    if index >= 0:
-                        self.type_combo.setCurrentIndex(index)
-                    self.name_edit.setText(name)
-                    self.min_cost_edit.setText(str(min_cost))
-                    self.roll_width_edit.setText(str(roll_width))
-            except Error as e:
-                print(f"Ошибка загрузки продукта: {e}")
-            finally:
-                conn.close()
+        types = reference_cache.get('product_types')
+        row = None
+        if self.product_id:
+            with get_connection() as conn:
+                row = ProductRepository(conn).get(self.product_id)
+        return types, row
+
+    def show_product(self, result):
+        types, row = result
+        self.type_combo.clear()
+        for type_id, type_name in types:
+            self.type_combo.addItem(type_name, type_id)
+        if row:
+            self.article_edit.setText(row.article)
+            index = self.type_combo.findData(row.type_id)
+            if index >= 0:
+                self.type_combo.setCurrentIndex(index)
+            self.name_edit.setText(row.name)
+            self.min_cost_edit.setText(str(row.min_cost))
+            self.roll_width_edit.setText(str(row.roll_width))
+            self.loaded_version = row.version
+        self.save_button.setEnabled(True)
 
     def manage_materials(self):
+        if not self.product_id:
+            QMessageBox.information(self, "Информация", "Сначала сохраните продукт.")
+            return
         dialog = ManageProductMaterialsDialog(self.product_id, self)
         dialog.exec()
+        self.changed_costs.update(dialog.changed_costs)
+        self.changed_prices.update(dialog.changed_prices)
 
     def save_product(self):
         if not all([self.article_edit.text(), self.name_edit.text(), self.min_cost_edit.text(), self.roll_width_edit.text()]):
@@ -207,236 +266,487 @@ class AddEditProductDialog(QDialog):
         if min_cost < 0 or roll_width < 0:
             QMessageBox.warning(self, "Ошибка", "Мин. стоимость и ширина рулона не могут быть отрицательными!")
             return
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                if self.product_id:
-                    query = ("UPDATE Products SET Article=%s, ProductTypeID=%s, Name=%s, MinCostForPartner=%s, RollWidth=%s "
-                             "WHERE ProductID=%s")
-                    cursor.execute(query, (article, type_id, name, min_cost, roll_width, self.product_id))
-                else:
-                    query = ("INSERT INTO Products (Article, ProductTypeID, Name, MinCostForPartner, RollWidth) "
-                             "VALUES (%s, %s, %s, %s, %s)")
-                    cursor.execute(query, (article, type_id, name, min_cost, roll_width))
-                    self.product_id = cursor.lastrowid
-                conn.commit()
-                self.accept()
-            except Error as e:
-                QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить продукт: {e}")
-            finally:
-                conn.close()
+        self.save_button.setEnabled(False)
+        product = Product(self.product_id, article, type_id, name, min_cost, roll_width, self.loaded_version)
+        runner.submit(self.write_product, product, on_result=self.saved, on_error=self.save_failed)
+
+    def write_product(self, product):
+        try:
+            product_id = write_queue.save(ProductRepository, product)
+        except ConflictError:
+            return None
+        except db.IntegrityError as e:
+            if e.errno == db.errorcode.ER_DUP_ENTRY:
+                raise ValueError(f"Артикул {product.article} уже используется другим продуктом")
+            raise
+        with get_connection() as conn:
+            rows = ProductRepository(conn).tab_rows_by_id([product_id])
+            if prices_loaded():
+                partner_price_cache.products_changed(conn, [product_id])
+                rows = with_prices(conn, rows)
+            else:
+                # Priced by the window once the caches are loaded, as the pages are
+                rows = [row + (None, None) for row in rows]
+            return product_id, (rows[0] if rows else None)
+
+    def saved(self, result):
+        if result is None:
+            QMessageBox.warning(self, "Конфликт", "Продукт изменен другим пользователем. "
+                                                  "Загружены актуальные данные, внесите изменения заново.")
+            runner.submit(self.load_product, key=id(self), on_result=self.show_product,
+                          on_error=lambda message: print(f"Ошибка загрузки продукта: {message}"))
+            return
+        self.product_id, self.saved_row = result
+        self.accept()
+
+    def save_failed(self, message):
+        self.save_button.setEnabled(True)
+        QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить продукт: {message}")
+
+class MaterialPicker(QLineEdit):
+    # Typeahead over the cached MaterialIndex: each keystroke shows the first matches grouped by material type
+    def __init__(self, material_index, parent=None):
+        super().__init__(parent)
+        self.material_index = material_index
+        self.material_id = None
+        self.setPlaceholderText("Начните вводить наименование материала")
+        self.matches = QStandardItemModel(self)
+        self.completer = QCompleter(self.matches, self)
+        self.completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.completer.setWidget(self)
+        self.completer.activated[QModelIndex].connect(self.pick)
+        self.textEdited.connect(self.update_matches)
+
+    def set_material(self, material_id):
+        self.material_id = material_id
+        self.setText(self.material_index.name(material_id) or "")
+
+    def update_matches(self, text):
+        self.material_id = None
+        self.matches.clear()
+        for type_name, materials in self.material_index.grouped(self.material_index.search(text)):
+            for material_id, name in materials:
+                item = QStandardItem(f"{name} — {type_name}" if type_name else name)
+                item.setData(material_id, Qt.UserRole)
+                self.matches.appendRow(item)
+        if self.matches.rowCount():
+            self.completer.complete()
+        else:
+            self.completer.popup().hide()
+
+    def pick(self, index):
+        self.set_material(index.data(Qt.UserRole))
+
+class MaterialDelegate(QStyledItemDelegate):
+    # The cell keeps the material id in UserRole; text typed without picking must match a name exactly
+    def __init__(self, material_index, parent=None):
+        super().__init__(parent)
+        self.material_index = material_index
+
+    def createEditor(self, parent, option, index):
+        return MaterialPicker(self.material_index, parent)
+
+    def setEditorData(self, editor, index):
+        editor.set_material(index.data(Qt.UserRole))
+
+    def setModelData(self, editor, model, index):
+        material_id = editor.material_id if editor.material_id is not None else self.material_index.find(editor.text())
+        if material_id is None:
+            return
+        model.setData(index, self.material_index.name(material_id), Qt.DisplayRole)
+        model.setData(index, material_id, Qt.UserRole)
+
+class QuantityDelegate(QStyledItemDelegate):
+    def createEditor(self, parent, option, index):
+        editor = QLineEdit(parent)
+        editor.setValidator(QDoubleValidator(0.0, 1000000.0, 2))
+        return editor
 
 class ManageProductMaterialsDialog(QDialog):
+    # Inline grid over a BomEditSession: rows are edited in place, the cost follows every change
+    # and Сохранить writes the difference in one transaction
     def __init__(self, product_id, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Управление материалами продукта")
-        self.setWindowIcon(QIcon('Наш декор.png'))
+        self.setWindowIcon(app_icon())
+        self.resize(600, 400)
         self.product_id = product_id
+        self.changed_costs = {}
+        self.changed_prices = {}
+        self.session = BomEditSession(product_id)
+        self.material_index = None
+        self.prices = {}
+        # Semi-finished products in the bill: {product_id: article} and {product_id: rolled-up cost}
+        self.component_names = {}
+        self.component_costs = {}
 
         self.table = QTableWidget()
-        self.table.setColumnCount(2)
-        self.table.setHorizontalHeaderLabels(["Материал", "Количество"])
+        self.table.setColumnCount(3)
+        self.table.setHorizontalHeaderLabels(["Материал", "Количество", "Стоимость"])
+        self.table.setItemDelegateForColumn(1, QuantityDelegate(self.table))
+        self.table.itemChanged.connect(self.line_edited)
+        self.cost_label = QLabel()
         self.add_button = QPushButton("Добавить материал")
         self.add_button.setStyleSheet("background-color: #2D6033; color: white;")
         self.add_button.clicked.connect(self.add_material)
-        self.edit_button = QPushButton("Редактировать материал")
-        self.edit_button.setStyleSheet("background-color: #2D6033; color: white;")
-        self.edit_button.clicked.connect(self.edit_material)
+        self.add_component_button = QPushButton("Добавить полуфабрикат")
+        self.add_component_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.add_component_button.clicked.connect(self.add_component)
         self.remove_button = QPushButton("Удалить материал")
         self.remove_button.setStyleSheet("background-color: #2D6033; color: white;")
         self.remove_button.clicked.connect(self.remove_material)
+        self.save_button = QPushButton("Сохранить")
+        self.save_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.save_button.clicked.connect(self.save_materials)
+        self.cancel_button = QPushButton("Отмена")
+        self.cancel_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.cancel_button.clicked.connect(self.reject)
         layout = QVBoxLayout()
         layout.addWidget(self.table)
+        layout.addWidget(self.cost_label)
         buttons_layout = QHBoxLayout()
         buttons_layout.addWidget(self.add_button)
-        buttons_layout.addWidget(self.edit_button)
+        buttons_layout.addWidget(self.add_component_button)
         buttons_layout.addWidget(self.remove_button)
         layout.addLayout(buttons_layout)
+        save_layout = QHBoxLayout()
+        save_layout.addWidget(self.save_button)
+        save_layout.addWidget(self.cancel_button)
+        layout.addLayout(save_layout)
         self.setLayout(layout)
         self.load_materials()
 
+    def done(self, result):
+        runner.cancel(id(self))
+        super().done(result)
+
+    def reject(self):
+        if self.session.is_dirty():
+            reply = QMessageBox.question(self, "Подтверждение", "Отменить несохраненные изменения?",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if reply != QMessageBox.Yes:
+                return
+        super().reject()
+
     def load_materials(self):
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                query = ("SELECT pm.ProductMaterialID, m.Name, pm.Quantity "
-                         "FROM ProductMaterials pm JOIN Materials m ON pm.MaterialID = m.MaterialID "
-                         "WHERE pm.ProductID = %s")
-                cursor.execute(query, (self.product_id,))
-                rows = cursor.fetchall()
-                self.table.setRowCount(len(rows))
-                for i, (pm_id, material_name, quantity) in enumerate(rows):
-                    item = QTableWidgetItem(material_name)
-                    item.setData(Qt.UserRole, pm_id)
-                    self.table.setItem(i, 0, item)
-                    self.table.setItem(i, 1, QTableWidgetItem(str(quantity)))
-            except Error as e:
-                print(f"Ошибка загрузки материалов продукта: {e}")
-            finally:
-                conn.close()
+        self.save_button.setEnabled(False)
+        self.add_button.setEnabled(False)
+        self.add_component_button.setEnabled(False)
+        runner.submit(self.fetch_materials, key=id(self), on_result=self.show_materials,
+                      on_error=lambda message: print(f"Ошибка загрузки материалов продукта: {message}"))
+
+    def fetch_materials(self):
+        material_index = reference_cache.get('material_index')
+        prices = reference_cache.get('material_prices')
+        with get_connection() as conn:
+            lines = ProductMaterialRepository(conn).lines_for(self.product_id)
+            component_ids = [line.component_id for line in lines if line.component_id is not None]
+            names = {product.id: product.article for product in ProductRepository(conn).get_many(component_ids).values()}
+            costs = product_costs.costs_for(component_ids, conn) if component_ids else {}
+            return lines, material_index, prices, names, costs
+
+    def show_materials(self, result):
+        lines, self.material_index, self.prices, self.component_names, self.component_costs = result
+        self.table.setItemDelegateForColumn(0, MaterialDelegate(self.material_index, self.table))
+        self.session.reset(lines)
+        self.show_lines()
+        self.save_button.setEnabled(True)
+        self.add_button.setEnabled(True)
+        self.add_component_button.setEnabled(True)
+
+    def show_lines(self):
+        self.table.blockSignals(True)
+        self.table.setRowCount(len(self.session.lines))
+        for i, line in enumerate(self.session.lines):
+            if line.component_id is not None:
+                # Semi-finished product: its own bill is edited from its own dialog
+                item = QTableWidgetItem(f"{self.component_names.get(line.component_id, line.component_id)} (полуфабрикат)")
+                item.setData(Qt.UserRole, line.component_id)
+                item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+            else:
+                item = QTableWidgetItem(self.material_index.name(line.material_id) or str(line.material_id or ""))
+                item.setData(Qt.UserRole, line.material_id)
+            self.table.setItem(i, 0, item)
+            self.table.setItem(i, 1, QTableWidgetItem(str(line.quantity)))
+            cost_item = QTableWidgetItem()
+            cost_item.setFlags(cost_item.flags() & ~Qt.ItemIsEditable)
+            self.table.setItem(i, 2, cost_item)
+            self.show_line_cost(i)
+        self.table.blockSignals(False)
+        self.show_cost()
+
+    def show_line_cost(self, row):
+        self.table.item(row, 2).setText(f"{self.session.line_cost(row, self.prices, self.component_costs):.2f}")
+
+    def show_cost(self):
+        self.cost_label.setText(f"Себестоимость продукта: {self.session.cost(self.prices, self.component_costs):.2f} р")
+
+    def line_edited(self, item):
+        row = item.row()
+        if item.column() == 2 or self.table.item(row, 2) is None:
+            return
+        line = self.session.lines[row]
+        try:
+            quantity = to_decimal(self.table.item(row, 1).text().replace(",", "."))
+        except InvalidOperation:
+            quantity = None
+        if quantity is None or quantity < 0:
+            self.table.blockSignals(True)
+            self.table.item(row, 1).setText(str(line.quantity))
+            self.table.blockSignals(False)
+            return
+        self.session.change(row, self.table.item(row, 0).data(Qt.UserRole), quantity)
+        self.table.blockSignals(True)
+        self.show_line_cost(row)
+        self.table.blockSignals(False)
+        self.show_cost()
 
     def add_material(self):
-        dialog = AddEditProductMaterialDialog(self.product_id, self)
-        if dialog.exec():
-            self.load_materials()
+        if not self.material_index:
+            QMessageBox.information(self, "Информация", "Справочник материалов пуст.")
+            return
+        self.session.add()
+        self.show_lines()
+        row = len(self.session.lines) - 1
+        self.table.setCurrentCell(row, 0)
+        self.table.editItem(self.table.item(row, 0))
 
-    def edit_material(self):
-        row = self.table.currentRow()
-        if row >= 0:
-            pm_id = self.table.item(row, 0).data(Qt.UserRole)
-            dialog = AddEditProductMaterialDialog(self.product_id, self, pm_id)
-            if dialog.exec():
-                self.load_materials()
-        else:
-            QMessageBox.information(self, "Информация", "Выберите материал для редактирования.")
+    def add_component(self):
+        article, ok = QInputDialog.getText(self, "Добавить полуфабрикат", "Артикул продукта-полуфабриката:")
+        if not ok or not article.strip():
+            return
+        runner.submit(self.fetch_component, article.strip(), key=id(self), on_result=self.component_found,
+                      on_error=lambda message: QMessageBox.critical(self, "Ошибка", f"Не удалось найти продукт: {message}"))
+
+    def fetch_component(self, article):
+        with get_connection() as conn:
+            product = ProductRepository(conn).find_article(article)
+            if product is None:
+                return article, None, None
+            return article, product, product_costs.costs_for([product[0]], conn)[product[0]]
+
+    def component_found(self, result):
+        article, product, cost = result
+        if product is None:
+            QMessageBox.warning(self, "Ошибка", f"Продукт с артикулом {article} не найден.")
+            return
+        try:
+            self.session.add_component(product[0], 0)
+        except CycleError:
+            QMessageBox.warning(self, "Ошибка", "Продукт не может входить в собственный состав.")
+            return
+        self.component_names[product[0]] = product[1]
+        self.component_costs[product[0]] = cost
+        self.show_lines()
+        row = len(self.session.lines) - 1
+        self.table.setCurrentCell(row, 1)
+        self.table.editItem(self.table.item(row, 1))
 
     def remove_material(self):
         row = self.table.currentRow()
         if row >= 0:
-            pm_id = self.table.item(row, 0).data(Qt.UserRole)
-            reply = QMessageBox.question(self, "Подтверждение", "Вы уверены, что хотите удалить этот материал?",
-                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-            if reply == QMessageBox.Yes:
-                conn = create_connection()
-                if conn:
-                    try:
-                        cursor = conn.cursor()
-                        cursor.execute("DELETE FROM ProductMaterials WHERE ProductMaterialID = %s", (pm_id,))
-                        conn.commit()
-                        self.load_materials()
-                    except Error as e:
-                        QMessageBox.critical(self, "Ошибка", f"Не удалось удалить материал: {e}")
-                    finally:
-                        conn.close()
-
-class AddEditProductMaterialDialog(QDialog):
-    def __init__(self, product_id, parent=None, pm_id=None):
+            self.session.remove(row)
+            self.show_lines()
+        else:
+            QMessageBox.information(self, "Информация", "Выберите материал для удаления.")
+
+    def save_materials(self):
+        if not self.session.is_dirty():
+            self.accept()
+            return
+        self.save_button.setEnabled(False)
+        runner.submit(self.write_materials, on_result=self.saved, on_error=self.save_failed)
+
+    def write_materials(self):
+        # Returns the new costs and partner prices of the product and of every product containing it as a
+        # semi-finished component; None if someone else changed the bill after it was loaded
+        try:
+            write_queue.run(self.session.write, self.session.lines)
+        except ConflictError:
+            return None
+        with get_connection() as conn:
+            costs = self.session.saved(conn)
+            prices = partner_price_cache.prices_for(list(costs), conn) if costs else {}
+        return costs, prices
+
+    def saved(self, result):
+        if result is None:
+            QMessageBox.warning(self, "Конфликт", "Материалы продукта изменены другим пользователем. "
+                                                  "Загружены актуальные данные, внесите изменения заново.")
+            self.load_materials()
+            return
+        self.changed_costs, self.changed_prices = result
+        self.accept()
+
+    def save_failed(self, message):
+        self.save_button.setEnabled(True)
+        QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить материалы продукта: {message}")
+
+class ReplenishmentDialog(QDialog):
+    def __init__(self, parent=None):
         super().__init__(parent)
-        self.setWindowTitle("Добавить материал продукта" if pm_id is None else "Редактировать материал продукта")
-        self.setWindowIcon(QIcon('Наш декор.png'))
-        self.product_id = product_id
-        self.pm_id = pm_id
+        self.setWindowTitle("Планирование закупок")
+        self.setWindowIcon(app_icon())
+        self.resize(1000, 600)
+        self.plan = None
 
-        layout = QFormLayout()
-        self.material_combo = QComboBox()
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT MaterialID, Name FROM Materials")
-                materials = cursor.fetchall()
-                for material_id, material_name in materials:
-                    self.material_combo.addItem(material_name, material_id)
-            except Error as e:
-                print(f"Ошибка загрузки материалов: {e}")
-            finally:
-                conn.close()
-        layout.addRow("Материал:", self.material_combo)
-        self.quantity_edit = QLineEdit()
-        self.quantity_edit.setValidator(QDoubleValidator(0.0, 1000000.0, 2))
-        layout.addRow("Количество:", self.quantity_edit)
-        self.save_button = QPushButton("Сохранить")
+        self.totals_label = QLabel("Загрузка данных...")
+        self.model = LazyTableModel(
+            ["Тип", "Наименование", "Единица измерения", "Количество на складе", "Минимальное количество",
+             "Количество в упаковке", "Нехватка", "Упаковок", "Количество к заказу", "Цена единицы", "Стоимость партии"],
+            self.fetch_page, [format_2f if i in HUNDREDTHS else None for i in range(len(PLAN_COLUMNS))],
+            sortable=range(len(PLAN_COLUMNS)), parent=self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        # Most expensive purchases first
+        self.table.horizontalHeader().setSortIndicator(PLAN_COST_COLUMN, Qt.DescendingOrder)
+        self.table.setSortingEnabled(True)
+        self.refresh_button = QPushButton("Пересчитать")
+        self.refresh_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.refresh_button.clicked.connect(self.refresh)
+        layout = QVBoxLayout()
+        layout.addWidget(self.totals_label)
+        layout.addWidget(self.table)
+        layout.addWidget(self.refresh_button)
+        self.setLayout(layout)
+        self.refresh()
+
+    def done(self, result):
+        runner.cancel(id(self))
+        super().done(result)
+
+    def refresh(self):
+        self.refresh_button.setEnabled(False)
+        runner.submit(load_plan, key=id(self), on_result=self.show_plan, on_error=self.plan_failed)
+
+    def fetch_page(self, query, last_row, limit):
+        return self.plan.page(query, last_row, limit) if self.plan is not None else []
+
+    def show_plan(self, plan):
+        self.plan = plan
+        self.refresh_button.setEnabled(True)
+        totals = plan.totals()
+        self.totals_label.setText(f"Материалов к закупке: {totals['materials']}, упаковок: {totals['packages']}, "
+                                  f"стоимость: {totals['cost']:.2f} р")
+        self.model.reload()
+
+    def plan_failed(self, message):
+        self.refresh_button.setEnabled(True)
+        self.totals_label.setText("")
+        QMessageBox.critical(self, "Ошибка", f"Не удалось рассчитать закупки: {message}")
+
+class DiagnosticsDialog(QDialog):
+    COLUMNS = [("Запрос", 'statement'), ("Откуда", 'call_site'), ("Вызовов", 'count'), ("Строк", 'rows'),
+               ("Всего, мс", 'total_ms'), ("p50, мс", 'p50_ms'), ("p95, мс", 'p95_ms'), ("Макс., мс", 'max_ms'),
+               ("Медленных", 'slow')]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Диагностика запросов")
+        self.setWindowIcon(app_icon())
+        self.resize(1000, 500)
+
+        self.summary_label = QLabel()
+        self.table = QTableWidget()
+        self.table.setColumnCount(len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels([caption for caption, _ in self.COLUMNS])
+        self.refresh_button = QPushButton("Обновить")
+        self.refresh_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.refresh_button.clicked.connect(self.refresh)
+        self.save_button = QPushButton("Сохранить в JSON...")
         self.save_button.setStyleSheet("background-color: #2D6033; color: white;")
-        self.save_button.clicked.connect(self.save_product_material)
-        layout.addRow(self.save_button)
+        self.save_button.clicked.connect(self.save)
+        self.reset_button = QPushButton("Сбросить")
+        self.reset_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.reset_button.clicked.connect(self.reset)
+        layout = QVBoxLayout()
+        layout.addWidget(self.summary_label)
+        layout.addWidget(self.table)
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(self.refresh_button)
+        buttons_layout.addWidget(self.save_button)
+        buttons_layout.addWidget(self.reset_button)
+        layout.addLayout(buttons_layout)
         self.setLayout(layout)
-        if pm_id:
-            self.load_product_material()
+        self.refresh()
 
-    def load_product_material(self):
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT MaterialID, Quantity FROM ProductMaterials WHERE ProductMaterialID = %s", (self.pm_id,))
-                row = cursor.fetchone()
-                if row:
-                    material_id, quantity = row
-                    index = self.material_combo.findData(material_id)
-                    if index >= 0:
-                        self.material_combo.setCurrentIndex(index)
-                    self.quantity_edit.setText(str(quantity))
-            except Error as e:
-                print(f"Ошибка загрузки материала продукта: {e}")
-            finally:
-                conn.close()
-
-    def save_product_material(self):
-        if not self.quantity_edit.text():
-            QMessageBox.warning(self, "Ошибка", "Введите количество!")
-            return
-        material_id = self.material_combo.currentData()
-        quantity = float(self.quantity_edit.text())
-        if quantity < 0:
-            QMessageBox.warning(self, "Ошибка", "Количество не может быть отрицательным!")
-            return
-        conn = create_connection()
-        if conn:
+    def refresh(self):
+        rows = query_stats.statements()
+        acquire = query_stats.acquire_stats()
+        suspects = sum(1 for row in rows if row['n_plus_one'])
+        self.summary_label.setText(
+            f"Получение подключения: {acquire['count']} раз, p50 {acquire['p50_ms']} мс, p95 {acquire['p95_ms']} мс, "
+            f"макс. {acquire['max_ms']} мс. Похоже на N+1: {suspects}")
+        self.summary_label.setToolTip(startup.report())
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, (_, field) in enumerate(self.COLUMNS):
+                item = QTableWidgetItem(str(row[field]))
+                if row['n_plus_one']:
+                    # Same statement from one place many times in a row: a query per item instead of one batch
+                    item.setBackground(Qt.yellow)
+                    item.setToolTip("Похоже на N+1: запрос повторяется для каждой строки")
+                self.table.setItem(i, j, item)
+
+    def save(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Диагностика запросов", "query_stats.json", "JSON (*.json)")
+        if path:
             try:
-                cursor = conn.cursor()
-                if self.pm_id:
-                    query = "UPDATE ProductMaterials SET MaterialID=%s, Quantity=%s WHERE ProductMaterialID=%s"
-                    cursor.execute(query, (material_id, quantity, self.pm_id))
-                else:
-                    query = "INSERT INTO ProductMaterials (ProductID, MaterialID, Quantity) VALUES (%s, %s, %s)"
-                    cursor.execute(query, (self.product_id, material_id, quantity))
-                conn.commit()
-                self.accept()
-            except Error as e:
-                QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить материал продукта: {e}")
-            finally:
-                conn.close()
+                query_stats.dump_json(path, {'pool': pool.stats(), 'startup': startup.as_dict()})
+            except OSError as e:
+                QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить файл: {e}")
+
+    def reset(self):
+        query_stats.reset()
+        self.refresh()
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Наш Декор")
         self.setGeometry(100, 100, 800, 600)
-        self.setWindowIcon(QIcon('Наш декор.png'))
+        self.setWindowIcon(app_icon())
         self.setStyleSheet("background-color: #FFFFFF;")
 
         self.tab_widget = QTabWidget()
         # Products tab
         self.products_tab = QWidget()
         self.products_layout = QVBoxLayout()
-        self.products_table = QTableWidget()
-        self.products_table.setColumnCount(6)
-        self.products_table.setHorizontalHeaderLabels(["Артикул", "Тип", "Наименование", "Мин. стоимость для партнера", "Ширина рулона", "Стоимость"])
+        self.products_model = LazyTableModel(
+            ["Артикул", "Тип", "Наименование", "Мин. стоимость для партнера", "Ширина рулона", "Стоимость",
+             "Цена для партнера"],
+            self.fetch_products_page, [None, None, None, format_2f, format_2f, format_2f, format_2f], runner=runner,
+            sortable=ProductRepository.SORT_COLUMNS, parent=self)
+        self.products_table = QTableView()
+        self.products_table.setModel(self.products_model)
+        self.products_table.setSelectionBehavior(QTableView.SelectRows)
+        self.products_table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.products_table.setSortingEnabled(True)
+        self.products_search = self.create_search_edit("Поиск по артикулу или наименованию", self.products_model)
         self.add_product_button = QPushButton("Добавить продукт")
         self.add_product_button.setStyleSheet("background-color: #2D6033; color: white;")
         self.add_product_button.clicked.connect(self.add_product)
         self.edit_product_button = QPushButton("Редактировать продукт")
         self.edit_product_button.setStyleSheet("background-color: #2D6033; color: white;")
         self.edit_product_button.clicked.connect(self.edit_product)
+        self.products_layout.addWidget(self.products_search)
         self.products_layout.addWidget(self.products_table)
         self.products_layout.addWidget(self.add_product_button)
         self.products_layout.addWidget(self.edit_product_button)
         self.products_tab.setLayout(self.products_layout)
-        # Materials tab
+        # Materials tab: built on first selection, most sessions start and often stay on products
         self.materials_tab = QWidget()
         self.materials_layout = QVBoxLayout()
-        self.materials_table = QTableWidget()
-        self.materials_table.setColumnCount(7)
-        self.materials_table.setHorizontalHeaderLabels(["Тип", "Наименование", "Цена единицы", "Количество на складе", "Единица измерения", "Количество в упаковке", "Минимальное количество"])
-        self.add_material_button = QPushButton("Добавить материал")
-        self.add_material_button.setStyleSheet("background-color: #2D6033; color: white;")
-        self.add_material_button.clicked.connect(self.add_material)
-        self.edit_material_button = QPushButton("Редактировать материал")
-        self.edit_material_button.setStyleSheet("background-color: #2D6033; color: white;")
-        self.edit_material_button.clicked.connect(self.edit_material)
-        self.materials_layout.addWidget(self.materials_table)
-        self.materials_layout.addWidget(self.add_material_button)
-        self.materials_layout.addWidget(self.edit_material_button)
         self.materials_tab.setLayout(self.materials_layout)
+        self.materials_model = None
         # Add tabs
         self.tab_widget.addTab(self.products_tab, "Продукты")
         self.tab_widget.addTab(self.materials_tab, "Материалы")
+        self.tab_widget.currentChanged.connect(self.tab_changed)
         # Logo
         logo_label = QLabel()
-        pixmap = QPixmap('Наш декор.png')
-        logo_label.setPixmap(pixmap.scaled(100, 100, Qt.KeepAspectRatio))
+        logo_label.setPixmap(logo_pixmap(100))
         logo_label.setAlignment(Qt.AlignCenter)
         # Main layout
         main_layout = QVBoxLayout()
@@ -445,108 +755,393 @@ class MainWindow(QMainWindow):
         central_widget = QWidget()
         central_widget.setLayout(main_layout)
         self.setCentralWidget(central_widget)
-        # Load data
-        self.load_products()
-        self.load_materials()
+        # Menu
+        file_menu = self.menuBar().addMenu("Файл")
+        self.import_action = file_menu.addAction("Импорт данных...")
+        self.import_action.triggered.connect(self.import_data)
+        self.export_action = file_menu.addAction("Экспорт продуктов...")
+        self.export_action.triggered.connect(self.export_data)
+        tools_menu = self.menuBar().addMenu("Сервис")
+        diagnostics_action = tools_menu.addAction("Диагностика запросов...")
+        diagnostics_action.triggered.connect(self.show_diagnostics)
+        # Loading state
+        self.loading_label = QLabel("Загрузка данных...")
+        self.statusBar().addWidget(self.loading_label)
+        self.loading_label.setVisible(runner.is_busy())
+        runner.busy_changed.connect(self.loading_label.setVisible)
+        self.offline_label = QLabel()
+        self.offline_label.setStyleSheet("color: #B00020;")
+        self.offline_label.setVisible(False)
+        self.statusBar().addWidget(self.offline_label)
+        self.slow_queries_label = QLabel()
+        self.statusBar().addPermanentWidget(self.slow_queries_label)
+        self.diagnostics_timer = QTimer(self)
+        self.diagnostics_timer.timeout.connect(self.update_slow_queries)
+        self.diagnostics_timer.start(DIAGNOSTICS_REFRESH_MS)
+        self.update_slow_queries()
+        # Changes saved by other workstations
+        self.change_feed = ChangeFeed()
+        self.polling_changes = False
+        self.change_timer = QTimer(self)
+        self.change_timer.timeout.connect(self.poll_changes)
+        # Local snapshot: rows on screen before MySQL answers, read-only browsing when it does not answer.
+        # Polling for changes starts once the snapshot has been reconciled with the database.
+        self.snapshot = Snapshot()
+        self.snapshot_info = self.snapshot.info()
+        self.use_snapshot = self.snapshot_info is not None
+        self.read_only = False
+        self.reconnect_timer = QTimer(self)
+        self.reconnect_timer.setSingleShot(True)
+        self.reconnect_timer.timeout.connect(self.reconcile_snapshot)
         self.products_table.doubleClicked.connect(self.edit_product)
+        self.products_model.rowsInserted.connect(self.products_shown)
+        # Cost and partner price need the whole catalog in the caches: pages are shown without them and the
+        # columns are filled in once the caches have been loaded in the background
+        self.unpriced = set()
+        self.warming_prices = False
+        self.products_model.rowsInserted.connect(self.products_inserted)
+
+    def start(self):
+        # Runs once the window is on screen: data is requested only after the first frame
+        startup.mark('window_shown')
+        if startup.over_budget():
+            print(f"Окно показано через {startup.elapsed('window_shown'):.0f} мс, бюджет {startup.budget_ms:.0f} мс",
+                  file=sys.stderr)
+        self.load_products()
+        self.reconcile_snapshot()
+
+    def products_inserted(self, parent, first, last):
+        rows = (self.products_model.row(position) for position in range(first, last + 1))
+        self.price_products([row[0] for row in rows if row[PRODUCT_COST_COLUMN + 1] is None])
+
+    def price_products(self, ids):
+        if not ids:
+            return
+        if prices_loaded():
+            self.fill_prices(ids)
+            return
+        self.unpriced.update(ids)
+        if not self.warming_prices:
+            self.warming_prices = True
+            runner.submit(self.warm_prices, quiet=True, on_result=self.prices_warmed, on_error=self.warm_failed)
+
+    def warm_prices(self):
+        with get_connection() as conn:
+            partner_price_cache.load(conn)
+
+    def prices_warmed(self, result):
+        self.warming_prices = False
+        ids, self.unpriced = list(self.unpriced), set()
+        if ids:
+            self.fill_prices(ids)
+
+    def warm_failed(self, message):
+        self.warming_prices = False
+        print(f"Ошибка расчета стоимости продуктов: {message}")
+
+    def fill_prices(self, ids):
+        def fetch():
+            with get_connection() as conn:
+                return product_costs.costs_for(ids, conn), partner_price_cache.prices_for(ids, conn)
+        runner.submit(fetch, quiet=True, on_result=self.prices_filled, on_error=self.warm_failed)
+
+    def prices_filled(self, result):
+        costs, prices = result
+        self.products_model.update_column(PRODUCT_COST_COLUMN, costs)
+        self.products_model.update_column(PRODUCT_PRICE_COLUMN, prices)
+
+    def products_shown(self):
+        # The first page of products on screen ends the startup timing
+        self.products_model.rowsInserted.disconnect(self.products_shown)
+        startup.mark('first_page')
+        if STARTUP_REPORT or startup.over_budget():
+            print(startup.report(), file=sys.stderr)
+
+    def tab_changed(self, index):
+        if self.tab_widget.widget(index) is self.materials_tab and self.materials_model is None:
+            self.build_materials_tab()
+
+    def build_materials_tab(self):
+        self.materials_model = LazyTableModel(
+            ["Тип", "Наименование", "Цена единицы", "Количество на складе", "Единица измерения", "Количество в упаковке", "Минимальное количество"],
+            self.fetch_materials_page, [None, None, format_2f, format_2f, None, None, format_2f], runner=runner,
+            sortable=MaterialRepository.SORT_COLUMNS, parent=self)
+        self.materials_table = QTableView()
+        self.materials_table.setModel(self.materials_model)
+        self.materials_table.setSelectionBehavior(QTableView.SelectRows)
+        self.materials_table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.materials_table.setSortingEnabled(True)
+        self.materials_search = self.create_search_edit("Поиск по наименованию", self.materials_model)
+        self.add_material_button = QPushButton("Добавить материал")
+        self.add_material_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.add_material_button.clicked.connect(self.add_material)
+        self.edit_material_button = QPushButton("Редактировать материал")
+        self.edit_material_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.edit_material_button.clicked.connect(self.edit_material)
+        self.replenishment_button = QPushButton("Планирование закупок")
+        self.replenishment_button.setStyleSheet("background-color: #2D6033; color: white;")
+        self.replenishment_button.clicked.connect(self.show_replenishment)
+        self.materials_layout.addWidget(self.materials_search)
+        self.materials_layout.addWidget(self.materials_table)
+        self.materials_layout.addWidget(self.add_material_button)
+        self.materials_layout.addWidget(self.edit_material_button)
+        self.materials_layout.addWidget(self.replenishment_button)
         self.materials_table.doubleClicked.connect(self.edit_material)
+        for widget in (self.add_material_button, self.edit_material_button, self.replenishment_button):
+            widget.setEnabled(not self.read_only)
+        self.load_materials()
+
+    def create_search_edit(self, placeholder, model):
+        edit = QLineEdit()
+        edit.setPlaceholderText(placeholder)
+        # Debounce typing: query once the user pauses
+        timer = QTimer(edit)
+        timer.setSingleShot(True)
+        timer.setInterval(SEARCH_DELAY_MS)
+        timer.timeout.connect(lambda: model.set_search(edit.text()))
+        edit.textChanged.connect(timer.start)
+        return edit
 
     def load_products(self):
-        conn = create_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                query = ("SELECT p.ProductID, p.Article, pt.TypeName, p.Name, p.MinCostForPartner, p.RollWidth "
-                         "FROM Products p JOIN ProductTypes pt ON p.ProductTypeID = pt.ProductTypeID")
-                cursor.execute(query)
-                rows = cursor.fetchall()
-                self.products_table.setRowCount(len(rows))
-                for i, (product_id, article, type_name, name, min_cost, roll_width) in enumerate(rows):
-                    cost = self.calculate_product_cost(product_id)
-                    item = QTableWidgetItem(article)
-                    item.setData(Qt.UserRole, product_id)
-                    self.products_table.setItem(i, 0, item)
-                    self.products_table.setItem(i, 1, QTableWidgetItem(type_name))
-                    self.products_table.setItem(i, 2, QTableWidgetItem(name))
-                    self.products_table.setItem(i, 3, QTableWidgetItem(f"{min_cost:.2f}"))
-                    self.products_table.setItem(i, 4, QTableWidgetItem(f"{roll_width:.2f}"))
-                    self.products_table.setItem(i, 5, QTableWidgetItem(f"{cost:.2f}"))
-            except Error as e:
-                print(f"Ошибка загрузки продуктов: {e}")
-            finally:
-                conn.close()
-
-    def calculate_product_cost(self, product_id):
-        conn = create_connection()
-        if conn:
+        self.products_model.reload()
+
+    def fetch_products_page(self, query, last_row, limit):
+        if self.use_snapshot:
             try:
-                cursor = conn.cursor()
-                query = ("SELECT SUM(m.UnitPrice * pm.Quantity) "
-                         "FROM ProductMaterials pm JOIN Materials m ON pm.MaterialID = m.MaterialID "
-                         "WHERE pm.ProductID = %s")
-                cursor.execute(query, (product_id,))
-                cost = cursor.fetchone()[0]
-                return cost if cost is not None else 0.0
-            except Error as e:
-                print(f"Ошибка расчета стоимости продукта: {e}")
-                return 0.0
-            finally:
-                conn.close()
-        return 0.0
+                return self.snapshot.products_page(query, last_row, limit)
+            except sqlite3.Error as e:
+                print(f"Ошибка чтения снимка данных: {e}")
+                return None
+        try:
+            with get_connection() as conn:
+                rows = ProductRepository(conn).tab_page(query, last_row, limit)
+                if prices_loaded():
+                    return with_prices(conn, rows)
+        except db.Error as e:
+            print(f"Ошибка загрузки продуктов: {e}")
+            return None
+        # Not waiting for the catalog-wide caches keeps the first page as fast as the catalog is small
+        return [row + (None, None) for row in rows]
 
     def load_materials(self):
-        conn = create_connection()
-        if conn:
+        if self.materials_model is not None:
+            self.materials_model.reload()
+
+    def fetch_materials_page(self, query, last_row, limit):
+        if self.use_snapshot:
             try:
-                cursor = conn.cursor()
-                query = ("SELECT m.MaterialID, mt.TypeName, m.Name, m.UnitPrice, m.StockQuantity, m.Unit, m.QuantityPerPackage, m.MinQuantity "
-                         "FROM Materials m JOIN MaterialTypes mt ON m.MaterialTypeID = mt.MaterialTypeID")
-                cursor.execute(query)
-                rows = cursor.fetchall()
-                self.materials_table.setRowCount(len(rows))
-                for i, (material_id, type_name, name, unit_price, stock_qty, stock_qty_unit, qty_per_pkg, min_qty) in enumerate(rows):
-                    item = QTableWidgetItem(type_name)
-                    item.setData(Qt.UserRole, material_id)
-                    self.materials_table.setItem(i, 0, item)
-                    self.materials_table.setItem(i, 1, QTableWidgetItem(name))
-                    self.materials_table.setItem(i, 2, QTableWidgetItem(f"{unit_price:.2f}"))
-                    self.materials_table.setItem(i, 3, QTableWidgetItem(f"{stock_qty:.2f}"))
-                    self.materials_table.setItem(i, 4, QTableWidgetItem(stock_qty_unit))
-                    self.materials_table.setItem(i, 5, QTableWidgetItem(str(qty_per_pkg)))
-                    self.materials_table.setItem(i, 6, QTableWidgetItem(f"{min_qty:.2f}"))
-            except Error as e:
-                print(f"Ошибка загрузки материалов: {e}")
-            finally:
-                conn.close()
+                return self.snapshot.materials_page(query, last_row, limit)
+            except sqlite3.Error as e:
+                print(f"Ошибка чтения снимка данных: {e}")
+                return None
+        try:
+            with get_connection() as conn:
+                return MaterialRepository(conn).tab_page(query, last_row, limit)
+        except db.Error as e:
+            print(f"Ошибка загрузки материалов: {e}")
+            return None
+
+    def apply_product_dialog(self, dialog, accepted):
+        # The change feed skips this instance's own changes, so the products above a saved bill are updated here
+        self.products_model.update_column(PRODUCT_COST_COLUMN, dialog.changed_costs)
+        self.products_model.update_column(PRODUCT_PRICE_COLUMN, dialog.changed_prices)
+        if accepted and dialog.saved_row:
+            count = self.products_model.rowCount()
+            self.products_model.upsert_row(dialog.saved_row)
+            # A row appended goes through products_inserted; one replaced in place is priced here
+            if dialog.saved_row[PRODUCT_COST_COLUMN + 1] is None and self.products_model.rowCount() == count:
+                self.price_products([dialog.saved_row[0]])
+
+    def apply_material_dialog(self, dialog):
+        if dialog.saved_row:
+            self.materials_model.upsert_row(dialog.saved_row)
+        self.products_model.update_column(PRODUCT_COST_COLUMN, dialog.changed_costs)
+        self.products_model.update_column(PRODUCT_PRICE_COLUMN, dialog.changed_prices)
 
     def add_product(self):
         dialog = AddEditProductDialog(self)
-        if dialog.exec():
-            self.load_products()
+        self.apply_product_dialog(dialog, dialog.exec())
 
-    def edit_product(self, index):
+    def edit_product(self, index=None):
+        if self.read_only:
+            return
+        if not isinstance(index, QModelIndex):
+            index = self.products_table.currentIndex()
         row = index.row()
-        product_id = self.products_table.item(row, 0).data(Qt.UserRole)
-        dialog = AddEditProductDialog(self, product_id)
-        if dialog.exec():
-            self.load_products()
+        if row >= 0:
+            product_id = self.products_model.row_id(row)
+            dialog = AddEditProductDialog(self, product_id)
+            self.apply_product_dialog(dialog, dialog.exec())
+        else:
+            QMessageBox.information(self, "Информация", "Выберите продукт для редактирования.")
 
     def add_material(self):
         dialog = AddEditMaterialDialog(self)
         if dialog.exec():
-            self.load_materials()
+            self.apply_material_dialog(dialog)
 
-    def edit_material(self, index):
+    def edit_material(self, index=None):
+        if self.read_only:
+            return
+        if not isinstance(index, QModelIndex):
+            index = self.materials_table.currentIndex()
         row = index.row()
-        material_id = self.materials_table.item(row, 0).data(Qt.UserRole)
-        dialog = AddEditMaterialDialog(self, material_id)
-        if dialog.exec():
+        if row >= 0:
+            material_id = self.materials_model.row_id(row)
+            dialog = AddEditMaterialDialog(self, material_id)
+            if dialog.exec():
+                self.apply_material_dialog(dialog)
+        else:
+            QMessageBox.information(self, "Информация", "Выберите материал для редактирования.")
+
+    def import_data(self):
+        tables = {"Продукты": 'products', "Материалы": 'materials', "Материалы продуктов": 'product_materials'}
+        table, ok = QInputDialog.getItem(self, "Импорт данных", "Таблица:", list(tables), 0, False)
+        if not ok:
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Импорт данных", "", "Таблицы (*.csv *.xlsx)")
+        if not path:
+            return
+        runner.submit(import_file, tables[table], path, on_result=self.imported,
+                      on_error=lambda message: QMessageBox.critical(self, "Ошибка", f"Не удалось импортировать данные: {message}"))
+
+    def imported(self, report):
+        reference_cache.invalidate()
+        product_costs.invalidate()
+        partner_price_cache.invalidate()
+        self.load_products()
+        self.load_materials()
+        message = report.summary()
+        if report.rejected:
+            message += "\n" + "\n".join(f"Строка {line}: {reason}" for line, reason in report.rejected[:10])
+        QMessageBox.information(self, "Импорт данных", message)
+
+    def export_data(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Экспорт продуктов", "products.csv", "CSV (*.csv);;Excel (*.xlsx)")
+        if not path:
+            return
+        runner.submit(export_products, path,
+                      on_result=lambda count: QMessageBox.information(self, "Экспорт продуктов", f"Выгружено продуктов: {count}"),
+                      on_error=lambda message: QMessageBox.critical(self, "Ошибка", f"Не удалось выгрузить продукты: {message}"))
+
+    def poll_changes(self):
+        # Never two polls at once: a dropped result would lose changes the feed has already passed
+        if self.polling_changes:
+            return
+        self.polling_changes = True
+        runner.submit(self.fetch_changes, quiet=True, on_result=self.apply_changes, on_error=self.changes_failed)
+
+    def fetch_changes(self):
+        with get_connection() as conn:
+            return self.change_feed.fetch(conn)
+
+    def apply_changes(self, changes):
+        self.polling_changes = False
+        if changes is not None:
+            self.show_changes(changes)
+
+    def show_changes(self, changes):
+        if changes.material_rows or changes.reload_materials:
+            reference_cache.invalidate('material_prices', 'material_index')
+        if changes.reload_materials:
             self.load_materials()
+        if self.materials_model is not None:
+            for row in changes.material_rows:
+                self.materials_model.upsert_row(row)
+        if changes.reload_products:
+            self.load_products()
+            return
+        for row in changes.product_rows:
+            self.products_model.upsert_row(row)
+        self.products_model.update_column(PRODUCT_COST_COLUMN, changes.costs)
+        self.products_model.update_column(PRODUCT_PRICE_COLUMN, changes.prices)
 
-if __name__ == "__main__":
+    def changes_failed(self, message):
+        # Typically a database without the ChangeLog table: stop polling instead of failing every few seconds
+        self.polling_changes = False
+        self.change_timer.stop()
+        print(f"Ошибка получения изменений, синхронизация отключена: {message}")
+
+    def reconcile_snapshot(self):
+        runner.submit(self.fetch_snapshot_changes, quiet=True, on_result=self.snapshot_reconciled)
+
+    def fetch_snapshot_changes(self):
+        # (connected, Changes or None); a snapshot that cannot be written must not keep the window offline
+        try:
+            with get_connection() as conn:
+                # The feed's mark is taken before the snapshot reads the log, so nothing committed in between is missed
+                try:
+                    if self.change_feed.mark is None:
+                        self.change_feed.start(conn)
+                except db.Error as e:
+                    print(f"Ошибка получения изменений: {e}")
+                try:
+                    return True, self.snapshot.reconcile(conn)
+                except (db.Error, sqlite3.Error, OSError) as e:
+                    print(f"Ошибка обновления снимка данных: {e}")
+                    return True, None
+        except db.Error as e:
+            print(f"Ошибка подключения к базе данных: {e}")
+            return False, None
+
+    def snapshot_reconciled(self, result):
+        connected, changes = result
+        if not connected:
+            self.set_read_only(True)
+            self.reconnect_timer.start(RECONNECT_MS)
+            return
+        # From here on pages come from MySQL; rows already shown from the snapshot get what changed since it was saved
+        was_offline = self.read_only
+        from_snapshot = self.use_snapshot
+        self.use_snapshot = False
+        self.set_read_only(False)
+        if not self.change_timer.isActive():
+            self.change_timer.start(CHANGE_POLL_MS)
+        if was_offline or (from_snapshot and changes is None):
+            self.load_products()
+            self.load_materials()
+        elif from_snapshot:
+            self.show_changes(changes)
+
+    def set_read_only(self, read_only):
+        self.read_only = read_only
+        widgets = [self.add_product_button, self.edit_product_button, self.import_action, self.export_action]
+        if self.materials_model is not None:
+            widgets += [self.add_material_button, self.edit_material_button, self.replenishment_button]
+        for widget in widgets:
+            widget.setEnabled(not read_only)
+        if self.snapshot_info:
+            self.offline_label.setText(f"Нет подключения к базе данных. Данные на {self.snapshot_info['saved_at']}, только просмотр")
+        else:
+            self.offline_label.setText("Нет подключения к базе данных")
+        self.offline_label.setVisible(read_only)
+
+    def update_slow_queries(self):
+        count = len(query_stats.slow_queries)
+        self.slow_queries_label.setVisible(count > 0)
+        if count:
+            _, ms, _, site, statement = query_stats.slow_queries[-1]
+            self.slow_queries_label.setText(f"Медленных запросов: {count}, последний {ms:.0f} мс")
+            self.slow_queries_label.setToolTip(f"{site}\n{statement}")
+
+    def show_replenishment(self):
+        ReplenishmentDialog(self).exec()
+
+    def show_diagnostics(self):
+        DiagnosticsDialog(self).exec()
+
+def main():
+    startup.mark('imports')
     app = QApplication(sys.argv)
     font = QFont("Gabriola")
     app.setFont(font)
+    app.aboutToQuit.connect(pool.close_all)
+    startup.mark('application')
     window = MainWindow()
+    startup.mark('window_built')
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    QTimer.singleShot(0, window.start)
+    return app.exec()
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
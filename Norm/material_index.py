@@ -0,0 +1,89 @@
+import bisect
+from array import array
+
+SEARCH_LIMIT = 50
+
+class MaterialIndex:
+    # Keystroke search over Materials.Name. Prefix matches come from bisect over the sorted names
+    # (and over the sorted words for one or two letters), substring matches from trigram postings;
+    # every source stops at the limit, so a query costs about the same on 100 or 100k materials.
+    def __init__(self, rows, type_names=()):
+        # rows: (MaterialID, Name, MaterialTypeID)
+        rows = sorted(rows, key=lambda row: (str(row[1]).lower(), row[0]))
+        self.ids = [row[0] for row in rows]
+        self.names = [str(row[1]) for row in rows]
+        self.keys = [name.lower() for name in self.names]
+        self.type_ids = [row[2] for row in rows]
+        self.type_names = dict(type_names)
+        self.positions = {material_id: i for i, material_id in enumerate(self.ids)}
+        self.by_type = {}
+        self.trigrams = {}
+        self.words = sorted((word, position) for position, key in enumerate(self.keys) for word in key.split()[1:])
+        for position, key in enumerate(self.keys):
+            self.by_type.setdefault(self.type_ids[position], array('i')).append(position)
+            for gram in {key[i:i + 3] for i in range(len(key) - 2)}:
+                self.trigrams.setdefault(gram, array('i')).append(position)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def name(self, material_id):
+        position = self.positions.get(material_id)
+        return None if position is None else self.names[position]
+
+    def find(self, text):
+        # Exact name (case-insensitive) -> MaterialID, for text typed without picking a match
+        key = text.strip().lower()
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return self.ids[position]
+        return None
+
+    def _prefix(self, key):
+        position = bisect.bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position].startswith(key):
+            yield position
+            position += 1
+
+    def _word_prefix(self, key):
+        i = bisect.bisect_left(self.words, (key,))
+        while i < len(self.words) and self.words[i][0].startswith(key):
+            yield self.words[i][1]
+            i += 1
+
+    def _substring(self, key):
+        postings = [self.trigrams.get(key[i:i + 3]) for i in range(len(key) - 2)]
+        if not postings or None in postings:
+            return
+        for position in min(postings, key=len):
+            if key in self.keys[position]:
+                yield position
+
+    def search(self, text, type_id=None, limit=SEARCH_LIMIT):
+        # [(MaterialID, Name, MaterialTypeID)]: names starting with text first, then names containing it
+        key = text.strip().lower()
+        if not key:
+            sources = [self.by_type.get(type_id, ()) if type_id is not None else range(len(self.ids))]
+        else:
+            sources = [self._prefix(key), self._substring(key) if len(key) >= 3 else self._word_prefix(key)]
+        found = []
+        seen = set()
+        for source in sources:
+            for position in source:
+                if position in seen or (type_id is not None and self.type_ids[position] != type_id):
+                    continue
+                seen.add(position)
+                found.append(position)
+                if len(found) >= limit:
+                    break
+            if len(found) >= limit:
+                break
+        return [(self.ids[p], self.names[p], self.type_ids[p]) for p in found]
+
+    def grouped(self, matches):
+        # [(type name, [(MaterialID, Name), ...])] in type name order, keeping the match order inside a group
+        groups = {}
+        for material_id, name, type_id in matches:
+            groups.setdefault(type_id, []).append((material_id, name))
+        return sorted(((self.type_names.get(type_id, ""), materials) for type_id, materials in groups.items()),
+                      key=lambda group: group[0])
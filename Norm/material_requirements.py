@@ -0,0 +1,170 @@
+import argparse
+import csv
+import sys
+from collections import namedtuple
+from decimal import Decimal
+from db import get_connection
+from costs import CycleError, topological_order
+from importer import iter_csv, load_map, lookup, number, RowError
+from repository import MaterialRepository, ProductRepository, ProductMaterialRepository
+
+# One production order: rolls of a product, each roll_length metres long; the width is Products.RollWidth
+PlanItem = namedtuple('PlanItem', 'product_id rolls roll_length')
+# Requirement row: (MaterialID, Name, Unit, required, StockQuantity, shortage)
+PLAN_HEADERS = {
+    'Article': ["Article", "Артикул"],
+    'Rolls': ["Rolls", "Рулонов", "Количество рулонов"],
+    'RollLength': ["RollLength", "Длина рулона"],
+}
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("Для расчета потребности в материалах установите пакет numpy")
+    return numpy
+
+def hundredths_up(np, values):
+    # Round up to DECIMAL(10,2); the epsilon keeps float noise from adding a cent to exact values
+    return np.ceil(values * 100 - 1e-6).astype(np.int64)
+
+class MaterialRequirements:
+    def __init__(self, material_ids, names, units, required, stock):
+        self.np = np = _numpy()
+        self.material_ids = material_ids
+        self.names = names
+        self.units = units
+        self.required = required
+        self.stock = stock
+        self.shortage = np.maximum(required - stock, 0)
+
+    def __len__(self):
+        return len(self.material_ids)
+
+    def _row(self, i):
+        return (int(self.material_ids[i]), self.names[i], self.units[i], Decimal(int(self.required[i])).scaleb(-2),
+                Decimal(int(self.stock[i])).scaleb(-2), Decimal(int(self.shortage[i])).scaleb(-2))
+
+    def rows(self):
+        return [self._row(i) for i in range(len(self))]
+
+    def shortages(self):
+        return [self._row(i) for i in self.np.flatnonzero(self.shortage > 0)]
+
+def flatten(rows, product_ids):
+    # {product_id: {material_id: quantity per unit of product}} with semi-finished components replaced by their
+    # own materials, quantities multiplied along the way. Components come first in topological order, so each
+    # is flattened once however many products contain it.
+    # rows: lines_below() rows (ProductMaterialID, ProductID, MaterialID, ComponentProductID, Quantity, UnitPrice)
+    parts = {}
+    for _, product_id, material_id, component_id, quantity, _ in rows:
+        parts.setdefault(product_id, []).append((material_id, component_id, float(quantity)))
+    order, cyclic = topological_order(parts, lambda product_id: [line[1] for line in parts[product_id] if line[1] is not None])
+    if cyclic:
+        raise CycleError(cyclic)
+    flat = {}
+    for product_id in order:
+        materials = {}
+        for material_id, component_id, quantity in parts[product_id]:
+            if component_id is None:
+                materials[material_id] = materials.get(material_id, 0.0) + quantity
+                continue
+            for inner_id, inner_quantity in flat.get(component_id, {}).items():
+                materials[inner_id] = materials.get(inner_id, 0.0) + inner_quantity * quantity
+        flat[product_id] = materials
+    return {product_id: flat.get(product_id, {}) for product_id in product_ids}
+
+def requirement_lines(conn, product_ids):
+    # explode() input for the products, with semi-finished components already flattened into materials
+    flat = flatten(ProductMaterialRepository(conn).lines_below(product_ids), product_ids)
+    products = ProductRepository(conn).requirement_inputs(product_ids)
+    materials = MaterialRepository(conn).requirement_inputs({material_id for quantities in flat.values() for material_id in quantities})
+    return [(product_id, material_id, quantity) + products[product_id] + materials[material_id]
+            for product_id, quantities in flat.items() if product_id in products
+            for material_id, quantity in quantities.items() if material_id in materials]
+
+def explode(plan, lines):
+    # Material needed per bill line = Quantity (per m2 of product) x RollWidth x metres planned
+    # x ProductTypes.Coefficient x (1 + MaterialTypes.DefectPercentage / 100), summed per material.
+    # lines: (ProductID, MaterialID, Quantity, RollWidth, Coefficient, DefectPercentage, Name, Unit, StockQuantity)
+    np = _numpy()
+    empty = np.array([], dtype=np.int64)
+    if not plan or not lines:
+        return MaterialRequirements(empty, [], [], empty, empty)
+    plan_ids = np.array([item.product_id for item in plan], dtype=np.int64)
+    metres = np.array([float(item.rolls) * float(item.roll_length) for item in plan], dtype=np.float64)
+    if (metres < 0).any():
+        raise ValueError("Количество рулонов и длина рулона не могут быть отрицательными")
+    # Several orders of one product add up
+    planned, inverse = np.unique(plan_ids, return_inverse=True)
+    planned_metres = np.bincount(inverse, weights=metres)
+
+    product_ids, material_ids, quantity, width, coefficient, defect, names, units, stock = zip(*lines)
+    product_ids = np.array(product_ids, dtype=np.int64)
+    line_metres = planned_metres[np.searchsorted(planned, product_ids)]
+    need = (np.array(quantity, dtype=np.float64) * np.array(width, dtype=np.float64) * line_metres
+            * np.array(coefficient, dtype=np.float64) * (1 + np.array(defect, dtype=np.float64) / 100))
+
+    materials, first, inverse = np.unique(np.array(material_ids, dtype=np.int64), return_index=True, return_inverse=True)
+    required = hundredths_up(np, np.bincount(inverse, weights=need))
+    stock = np.rint(np.array(stock, dtype=np.float64)[first] * 100).astype(np.int64)
+    return MaterialRequirements(materials, [names[i] for i in first], [units[i] for i in first], required, stock)
+
+def calculate_requirements(plan, conn=None):
+    plan = [item if isinstance(item, PlanItem) else PlanItem(*item) for item in plan]
+    if conn is None:
+        with get_connection() as conn:
+            return calculate_requirements(plan, conn)
+    product_ids = sorted({item.product_id for item in plan})
+    return explode(plan, requirement_lines(conn, product_ids))
+
+def read_plan(conn, path):
+    rows = iter_csv(path)
+    header = [cell.strip().lower() for cell in next(rows, [])]
+    positions = {}
+    for column, names in PLAN_HEADERS.items():
+        found = [header.index(name.lower()) for name in names if name.lower() in header]
+        if not found:
+            raise RuntimeError(f"В файле нет столбца {names[0]} ({', '.join(names[1:])})")
+        positions[column] = found[0]
+    products = load_map(ProductRepository(conn).names())
+    plan = []
+    rejected = []
+    for line, row in enumerate(rows, 2):
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            values = {column: row[i] if i < len(row) else "" for column, i in positions.items()}
+            plan.append(PlanItem(lookup(products, values['Article'], "продукт"), number(values['Rolls'], "Rolls", True),
+                                 number(values['RollLength'], "RollLength", positive=True)))
+        except RowError as e:
+            rejected.append((line, str(e)))
+    return plan, rejected
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Потребность в материалах для плана производства")
+    parser.add_argument('plan', help="CSV: Артикул; Количество рулонов; Длина рулона")
+    parser.add_argument('--shortages', action='store_true', help="показать только материалы, которых не хватает")
+    parser.add_argument('--output', help="CSV-файл для результата")
+    args = parser.parse_args(argv)
+    with get_connection() as conn:
+        plan, rejected = read_plan(conn, args.plan)
+        requirements = calculate_requirements(plan, conn)
+    for line, reason in rejected[:20]:
+        print(f"  строка {line}: {reason}", file=sys.stderr)
+    rows = requirements.shortages() if args.shortages else requirements.rows()
+    header = ["Код", "Материал", "Единица измерения", "Требуется", "На складе", "Не хватает"]
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(header)
+            writer.writerows(rows)
+    else:
+        for material_id, name, unit, required, stock, shortage in rows:
+            print(f"{material_id:8} {name:40} {required:12.2f} {stock:12.2f} {shortage:12.2f} {unit}")
+    print(f"Заказов: {len(plan)}, материалов: {len(requirements)}, не хватает: {len(requirements.shortages())}",
+          file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
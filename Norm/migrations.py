@@ -0,0 +1,335 @@
+import argparse
+import sys
+from contextlib import contextmanager
+from mysql.connector import Error
+from db import DB_CONFIG
+from instrumentation import ExplainConnection
+from repository import (ChangeLogRepository, MaterialRepository, MaterialTypeRepository, PageQuery,
+                        ProductMaterialRepository, ProductRepository, ProductTypeRepository)
+
+LOCK_NAME = "MosaicDB.migrations"
+LOCK_TIMEOUT = 30
+# A full scan of a table this small (the type lists) costs less than an index lookup
+SMALL_TABLE_ROWS = 100
+CHECK_PAGE_SIZE = 500
+CHECK_SAMPLE = 20
+# Tab row position of the text the tab search is checked with: Article for products, Name for materials
+SEARCH_SAMPLE = {"Products": 1, "Materials": 2}
+
+class SchemaEditor:
+    # DDL that is skipped when its result is already there. MySQL DDL commits implicitly, so a migration
+    # interrupted halfway is simply run again; databases created from schema.sql before versions were
+    # recorded are adopted the same way.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _count(self, query, params):
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+    def execute(self, statement, params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(statement, params)
+        return cursor
+
+    def has_table(self, table):
+        return self._count("SELECT COUNT(*) FROM information_schema.TABLES "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,)) > 0
+
+    def has_column(self, table, column):
+        return self._count("SELECT COUNT(*) FROM information_schema.COLUMNS "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s", (table, column)) > 0
+
+    def index(self, table, name):
+        # (unique, [columns]) or None
+        rows = self.execute("SELECT NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS "
+                            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s "
+                            "ORDER BY SEQ_IN_INDEX", (table, name)).fetchall()
+        if not rows:
+            return None
+        return not rows[0][0], [row[1] for row in rows]
+
+    def has_constraint(self, table, name):
+        return self._count("SELECT COUNT(*) FROM information_schema.TABLE_CONSTRAINTS "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_NAME = %s", (table, name)) > 0
+
+    def create_table(self, table, definition):
+        if not self.has_table(table):
+            self.execute(f"CREATE TABLE {table} ({definition})")
+
+    def add_column(self, table, column, definition):
+        if not self.has_column(table, column):
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def add_constraint(self, table, name, definition):
+        if not self.has_constraint(table, name):
+            self.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+
+    def create_index(self, table, name, columns, unique=False):
+        existing = self.index(table, name)
+        if existing == (unique, list(columns)):
+            return
+        if existing:
+            self.drop_index(table, name)
+        self.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({', '.join(columns)})")
+
+    def drop_index(self, table, name):
+        if self.index(table, name):
+            self.execute(f"DROP INDEX {name} ON {table}")
+
+def create_catalog(editor):
+    # The tables as first delivered (Textnorm.txt)
+    editor.create_table("ProductTypes", "ProductTypeID INT AUTO_INCREMENT PRIMARY KEY, TypeName VARCHAR(255) NOT NULL, "
+                                        "Coefficient DECIMAL(10,2) NOT NULL")
+    editor.create_table("Products", "ProductID INT AUTO_INCREMENT PRIMARY KEY, Article VARCHAR(255) NOT NULL, "
+                                    "ProductTypeID INT, Name VARCHAR(255) NOT NULL, "
+                                    "MinCostForPartner DECIMAL(10,2) NOT NULL CHECK (MinCostForPartner >= 0), "
+                                    "RollWidth DECIMAL(5,2) NOT NULL CHECK (RollWidth >= 0), "
+                                    "FOREIGN KEY (ProductTypeID) REFERENCES ProductTypes(ProductTypeID)")
+    editor.create_table("MaterialTypes", "MaterialTypeID INT AUTO_INCREMENT PRIMARY KEY, TypeName VARCHAR(255) NOT NULL, "
+                                         "DefectPercentage DECIMAL(5,2) NOT NULL "
+                                         "CHECK (DefectPercentage >= 0 AND DefectPercentage <= 100)")
+    editor.create_table("Materials", "MaterialID INT AUTO_INCREMENT PRIMARY KEY, Name VARCHAR(255) NOT NULL, "
+                                     "MaterialTypeID INT, UnitPrice DECIMAL(10,2) NOT NULL CHECK (UnitPrice >= 0), "
+                                     "StockQuantity DECIMAL(10,2) NOT NULL CHECK (StockQuantity >= 0), "
+                                     "Unit VARCHAR(50) NOT NULL, QuantityPerPackage INT NOT NULL CHECK (QuantityPerPackage > 0), "
+                                     "MinQuantity DECIMAL(10,2) NOT NULL CHECK (MinQuantity >= 0), "
+                                     "FOREIGN KEY (MaterialTypeID) REFERENCES MaterialTypes(MaterialTypeID)")
+    editor.create_table("ProductMaterials", "ProductMaterialID INT AUTO_INCREMENT PRIMARY KEY, ProductID INT, MaterialID INT, "
+                                            "Quantity DECIMAL(10,2) NOT NULL CHECK (Quantity >= 0), "
+                                            "FOREIGN KEY (ProductID) REFERENCES Products(ProductID), "
+                                            "FOREIGN KEY (MaterialID) REFERENCES Materials(MaterialID)")
+
+def add_tab_indexes(editor):
+    # Prefix search and keyset ORDER BY col, id on the Products and Materials tabs
+    for column in ("Article", "Name", "ProductTypeID", "MinCostForPartner", "RollWidth"):
+        editor.create_index("Products", f"IX_Products_{column}", [column])
+    for column in ("Name", "MaterialTypeID", "UnitPrice", "StockQuantity"):
+        editor.create_index("Materials", f"IX_Materials_{column}", [column])
+
+def add_row_versions(editor):
+    # Optimistic locking on the tables edited from several workstations
+    for table in ("Products", "Materials", "ProductMaterials"):
+        editor.add_column(table, "RowVersion", "INT NOT NULL DEFAULT 1")
+
+def add_change_log(editor):
+    editor.create_table("ChangeLog", "ChangeID INT AUTO_INCREMENT PRIMARY KEY, TableName VARCHAR(64) NOT NULL, "
+                                     "RowID INT NULL, Source CHAR(32) NOT NULL, "
+                                     "ChangedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+
+def add_unique_article_and_covering_indexes(editor):
+    duplicates = editor.execute("SELECT Article, COUNT(*) FROM Products GROUP BY Article HAVING COUNT(*) > 1 "
+                                "ORDER BY Article LIMIT 10").fetchall()
+    if duplicates:
+        listed = ", ".join(f"{article} ({count})" for article, count in duplicates)
+        raise RuntimeError(f"Артикулы продуктов повторяются: {listed}. Исправьте их и запустите обновление снова")
+    editor.create_index("Products", "UX_Products_Article", ["Article"], unique=True)
+    editor.drop_index("Products", "IX_Products_Article")
+    # Bill of materials by product (dialog, cost SUM, cost cache) and products by material (price changes),
+    # both answered from the index without touching the rows
+    editor.create_index("ProductMaterials", "IX_ProductMaterials_Product", ["ProductID", "MaterialID", "Quantity"])
+    editor.create_index("ProductMaterials", "IX_ProductMaterials_Material", ["MaterialID", "ProductID", "Quantity"])
+    # The remaining sortable Materials tab columns
+    for column in ("Unit", "QuantityPerPackage", "MinQuantity"):
+        editor.create_index("Materials", f"IX_Materials_{column}", [column])
+
+def add_semi_finished_components(editor):
+    # A bill line is either a material or a semi-finished product (another product), never both
+    editor.add_column("ProductMaterials", "ComponentProductID", "INT NULL AFTER MaterialID")
+    editor.add_constraint("ProductMaterials", "FK_ProductMaterials_Component",
+                          "FOREIGN KEY (ComponentProductID) REFERENCES Products(ProductID)")
+    if not editor.has_constraint("ProductMaterials", "CK_ProductMaterials_Line"):
+        empty = editor.execute("SELECT COUNT(*) FROM ProductMaterials "
+                               "WHERE MaterialID IS NULL AND ComponentProductID IS NULL").fetchone()[0]
+        if empty:
+            raise RuntimeError(f"Строк состава без материала: {empty}. Исправьте их и запустите обновление снова")
+        editor.add_constraint("ProductMaterials", "CK_ProductMaterials_Line",
+                              "CHECK ((MaterialID IS NULL) <> (ComponentProductID IS NULL))")
+    editor.create_index("ProductMaterials", "IX_ProductMaterials_Component", ["ComponentProductID", "ProductID", "Quantity"])
+
+# (version, description, step); versions are never renumbered or edited once shipped, only appended
+MIGRATIONS = [
+    (1, "Таблицы каталога", create_catalog),
+    (2, "Индексы поиска и сортировки вкладок", add_tab_indexes),
+    (3, "Версии строк для оптимистической блокировки", add_row_versions),
+    (4, "Журнал изменений", add_change_log),
+    (5, "Уникальный артикул и покрывающие индексы", add_unique_article_and_covering_indexes),
+    (6, "Полуфабрикаты в составе продукта", add_semi_finished_components),
+]
+
+def applied_versions(conn):
+    editor = SchemaEditor(conn)
+    if not editor.has_table("SchemaVersion"):
+        return {}
+    return dict(editor.execute("SELECT Version, AppliedAt FROM SchemaVersion").fetchall())
+
+def pending_migrations(conn):
+    applied = applied_versions(conn)
+    return [(version, description) for version, description, _ in MIGRATIONS if version not in applied]
+
+@contextmanager
+def migration_lock(editor):
+    # Two workstations upgrading at once would run the same DDL twice
+    if editor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT)).fetchone()[0] != 1:
+        raise RuntimeError("Схема базы данных уже обновляется с другого рабочего места")
+    try:
+        yield
+    finally:
+        editor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,)).fetchall()
+
+def migrate(conn, target=None, progress=None):
+    # Applies the pending migrations up to target (all by default) in order; returns [(version, description)]
+    editor = SchemaEditor(conn)
+    applied = []
+    with migration_lock(editor):
+        editor.create_table("SchemaVersion", "Version INT PRIMARY KEY, Description VARCHAR(255) NOT NULL, "
+                                             "AppliedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        done = applied_versions(conn)
+        for version, description, step in MIGRATIONS:
+            if version in done or (target is not None and version > target):
+                continue
+            if progress:
+                progress(version, description)
+            step(editor)
+            editor.execute("INSERT INTO SchemaVersion (Version, Description) VALUES (%s, %s)", (version, description))
+            conn.commit()
+            applied.append((version, description))
+    return applied
+
+def plan_problems(plan, scanning):
+    # Table accesses that read a whole large table without an index
+    if scanning:
+        return []
+    return [row for row in plan if row.get('type') == 'ALL' and int(row.get('rows') or 0) > SMALL_TABLE_ROWS]
+
+def app_workload(conn):
+    # The repository calls behind main.py and the modules it uses (tabs, dialogs, bill of materials,
+    # cost cache, change feed, snapshot), with ids and search text taken from the data itself
+    products = ProductRepository(conn)
+    materials = MaterialRepository(conn)
+    lines = ProductMaterialRepository(conn)
+    changes = ChangeLogRepository(conn)
+    first_rows = {}
+    for repository in (products, materials):
+        for sort_column in [None] + list(repository.SORT_COLUMNS):
+            for descending in ((False,) if sort_column is None else (False, True)):
+                query = PageQuery("", sort_column, descending)
+                rows = repository.tab_page(query, None, CHECK_PAGE_SIZE)
+                if rows:
+                    repository.tab_page(query, rows[-1], CHECK_PAGE_SIZE)
+                    first_rows.setdefault(repository.table, rows)
+        rows = first_rows.get(repository.table)
+        if rows:
+            search = str(rows[0][SEARCH_SAMPLE[repository.table]])[:3]
+            repository.tab_page(PageQuery(search, None, False), None, CHECK_PAGE_SIZE)
+    product_ids = [row[0] for row in first_rows.get("Products", [])[:CHECK_SAMPLE]]
+    material_ids = [row[0] for row in first_rows.get("Materials", [])[:CHECK_SAMPLE]]
+    if product_ids:
+        products.tab_rows_by_id(product_ids)
+        product = products.get(product_ids[0])
+        products.versions(product_ids)
+        products.pricing_inputs(product_ids)
+        products.requirement_inputs(product_ids)
+        products.find_article(product.article)
+        products.update_many([product])
+        bill = lines.lines_for(product_ids[0])
+        lines.for_product(product_ids[0])
+        lines.cost_sums(product_ids)
+        lines.lines_with_prices(product_ids)
+        lines.lines_below(product_ids)
+        lines.products_above(product_ids)
+        if bill:
+            lines.update_many(bill)
+            lines.delete_many(bill)
+    if material_ids:
+        materials.tab_rows_by_id(material_ids)
+        material = materials.get(material_ids[0])
+        materials.versions(material_ids)
+        materials.update_many([material])
+        materials.prices(material_ids)
+        materials.requirement_inputs(material_ids)
+        lines.products_using(material_ids)
+    latest = changes.latest()
+    changes.earliest()
+    changes.since(max(latest - 1000, 0), 1000)
+    changes.prune(100000)
+    with conn.full_scan():
+        ProductTypeRepository(conn).names()
+        MaterialTypeRepository(conn).names()
+        products.names()
+        products.pricing_inputs()
+        materials.names()
+        materials.prices()
+        materials.index_rows()
+        materials.stock_levels()
+        materials.tab_rows()
+        lines.cost_sums()
+        lines.lines_with_prices()
+        lines.component_links()
+        list(products.iter_with_costs(CHECK_PAGE_SIZE, {}))
+        list(products.iter_with_costs(CHECK_PAGE_SIZE, {}, with_id=True))
+
+def check_indexes(conn):
+    # [(statement, call site, expected full scan, plan, problem rows)]
+    explain = ExplainConnection(conn)
+    try:
+        app_workload(explain)
+    finally:
+        conn.rollback()
+    return [(statement, site, scanning, plan, plan_problems(plan, scanning))
+            for statement, (site, scanning, plan) in explain.plans.items()]
+
+def describe(plan):
+    return ", ".join(f"{row.get('table')}:{row.get('type')}" + (f"({row.get('key')})" if row.get('key') else "")
+                     for row in plan)
+
+def connect(database):
+    import mysql.connector
+    config = {key: value for key, value in DB_CONFIG.items() if key != 'database'}
+    conn = mysql.connector.connect(**config)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+    cursor.execute(f"USE `{database}`")
+    return conn
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Создание и обновление схемы MosaicDB")
+    parser.add_argument('--database', default=DB_CONFIG['database'])
+    parser.add_argument('--status', action='store_true', help="показать примененные и ожидающие версии")
+    parser.add_argument('--target', type=int, help="обновить только до этой версии")
+    parser.add_argument('--check', action='store_true',
+                        help="проверить через EXPLAIN, что запросы приложения используют индексы "
+                             "(нужны данные реального объема, например из bench.py --backend mysql)")
+    args = parser.parse_args(argv)
+    try:
+        conn = connect(args.database)
+    except Error as e:
+        print(f"Ошибка подключения к базе данных: {e}", file=sys.stderr)
+        return 2
+    try:
+        if args.status:
+            applied = applied_versions(conn)
+            for version, description, _ in MIGRATIONS:
+                state = f"применена {applied[version]}" if version in applied else "ожидает"
+                print(f"{version:3} {description:50} {state}")
+            return 0
+        if args.check:
+            failed = 0
+            for statement, site, scanning, plan, problems in check_indexes(conn):
+                state = "полный просмотр" if scanning else ("БЕЗ ИНДЕКСА" if problems else "ok")
+                failed += bool(problems)
+                print(f"{state:16} {site}  {describe(plan)}\n                 {statement[:160]}")
+            print(f"Запросов без индекса: {failed}")
+            return 1 if failed else 0
+        applied = migrate(conn, args.target, progress=lambda version, description: print(f"{version}: {description}..."))
+        print(f"Применено миграций: {len(applied)}. Схема базы данных актуальна")
+        return 0
+    except (Error, RuntimeError) as e:
+        print(f"Ошибка обновления схемы: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
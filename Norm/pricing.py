@@ -0,0 +1,146 @@
+import argparse
+import csv
+import sys
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+import db
+from costs import ZERO, calculate_product_costs, product_costs, to_decimal, with_costs
+from repository import ProductRepository
+
+CENT = Decimal('0.01')
+
+def partner_price(cost, coefficient, min_cost):
+    # Material cost x type coefficient, not below MinCostForPartner, rounded half up to hundredths, never negative
+    price = max(to_decimal(cost) * to_decimal(coefficient), to_decimal(min_cost))
+    return max(price, ZERO).quantize(CENT, ROUND_HALF_UP)
+
+def partner_prices(costs, coefficients, min_costs):
+    # partner_price over whole columns in one numpy pass. Integers throughout: cost in 1/10000 (costs.COST_SCALE,
+    # which the cost cache rounds rolled-up costs to), coefficient and min cost in hundredths, so the result is exact.
+    try:
+        import numpy as np
+    except ImportError:
+        return [partner_price(*values) for values in zip(costs, coefficients, min_costs)]
+    cost = np.rint(np.array(costs, dtype=np.float64) * 10000).astype(np.int64)
+    coefficient = np.rint(np.array(coefficients, dtype=np.float64) * 100).astype(np.int64)
+    min_cost = np.rint(np.array(min_costs, dtype=np.float64) * 100).astype(np.int64)
+    # 1/1000000 -> hundredths, half up
+    price = (cost * coefficient + 5000) // 10000
+    price = np.maximum(np.maximum(price, min_cost), 0)
+    return [Decimal(value).scaleb(-2) for value in price.tolist()]
+
+def calculate_partner_prices(product_ids=None, conn=None):
+    # {ProductID: partner price} for the whole catalog or the given products, straight from the database
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return {}
+    if conn is None:
+        try:
+            with db.get_connection() as conn:
+                return calculate_partner_prices(product_ids, conn)
+        except db.Error as e:
+            print(f"Ошибка расчета цен для партнеров: {e}")
+            return {}
+    inputs = ProductRepository(conn).pricing_inputs(product_ids)
+    costs = calculate_product_costs(product_ids, conn)
+    prices = partner_prices([costs.get(row[0]) or ZERO for row in inputs], [row[2] for row in inputs],
+                            [row[1] for row in inputs])
+    return {row[0]: price for row, price in zip(inputs, prices)}
+
+class PartnerPriceCache:
+    # Partner price per product, computed for the whole catalog in one vectorized pass on first use. Each price
+    # keeps the inputs it came from (product RowVersion, min cost, type coefficient, material cost): a cost that
+    # moved is noticed on lookup and a saved product is re-read by products_changed(), so only those are recomputed.
+    def __init__(self, costs=product_costs):
+        self.costs = costs
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._prices = {}
+        self._inputs = {}
+
+    def is_loaded(self):
+        return self._loaded
+
+    def load(self, conn):
+        rows = ProductRepository(conn).pricing_inputs()
+        costs = self.costs.costs_for([row[0] for row in rows], conn)
+        with self._lock:
+            self._prices = {}
+            self._inputs = {}
+            self._compute(rows, costs)
+            self._loaded = True
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+            self._prices = {}
+            self._inputs = {}
+
+    def _compute(self, rows, costs):
+        # rows: (ProductID, MinCostForPartner, Coefficient, RowVersion)
+        prices = partner_prices([costs[row[0]] for row in rows], [row[2] for row in rows], [row[1] for row in rows])
+        for (product_id, min_cost, coefficient, version), price in zip(rows, prices):
+            self._inputs[product_id] = (version, min_cost, coefficient, costs[product_id])
+            self._prices[product_id] = price
+        return {row[0]: self._prices[row[0]] for row in rows}
+
+    def prices_for(self, product_ids, conn):
+        with self._lock:
+            if not self._loaded:
+                self.load(conn)
+            missing = [product_id for product_id in product_ids if product_id not in self._inputs]
+            if missing:
+                self.products_changed(conn, missing)
+            costs = self.costs.costs_for(product_ids, conn)
+            moved = []
+            for product_id in product_ids:
+                inputs = self._inputs.get(product_id)
+                if inputs is not None and inputs[3] != costs[product_id]:
+                    version, min_cost, coefficient, _ = inputs
+                    moved.append((product_id, min_cost, coefficient, version))
+            self._compute(moved, costs)
+            return {product_id: self._prices.get(product_id, ZERO) for product_id in product_ids}
+
+    def products_changed(self, conn, product_ids):
+        # Re-reads the inputs of saved (or deleted) products; returns {product_id: price} for the ones still there
+        with self._lock:
+            if not self._loaded:
+                return {}
+            rows = ProductRepository(conn).pricing_inputs(product_ids)
+            for product_id in set(product_ids) - {row[0] for row in rows}:
+                self._inputs.pop(product_id, None)
+                self._prices.pop(product_id, None)
+            changed = [row for row in rows if self._inputs.get(row[0], (None,))[:3] != (row[3], row[1], row[2])]
+            self._compute(changed, self.costs.costs_for([row[0] for row in changed], conn))
+            return {row[0]: self._prices[row[0]] for row in rows}
+
+partner_price_cache = PartnerPriceCache()
+
+def with_prices(conn, rows, cache=partner_price_cache):
+    # Products tab rows get the computed cost and then the partner price appended
+    rows = with_costs(conn, rows, cache.costs)
+    prices = cache.prices_for([row[0] for row in rows], conn)
+    return [row + (prices.get(row[0], ZERO),) for row in rows]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Цены для партнеров: стоимость материалов x коэффициент типа, "
+                                                 "не ниже минимальной стоимости")
+    parser.add_argument('ids', nargs='*', type=int, help="коды продуктов (по умолчанию весь каталог)")
+    parser.add_argument('--output', help="CSV-файл для результата")
+    args = parser.parse_args(argv)
+    prices = calculate_partner_prices(args.ids or None)
+    rows = sorted(prices.items())
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(["Код", "Цена для партнера"])
+            writer.writerows(rows)
+    else:
+        for product_id, price in rows:
+            print(f"{product_id:8} {price:12.2f}")
+    print(f"Продуктов: {len(rows)}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import threading
+import time
+from db import get_connection
+from repository import ProductTypeRepository, MaterialTypeRepository, MaterialRepository
+from material_index import MaterialIndex
+
+# Seconds before a cached list is re-read; None keeps entries until they are invalidated
+REFERENCE_TTL = None
+
+class ReferenceCache:
+    # Lookup lists shared by all dialogs and combo boxes. Writers call invalidate() for what they change.
+    def __init__(self, ttl=REFERENCE_TTL):
+        self.ttl = ttl
+        self._loaders = {}
+        self._entries = {}
+        # Bumped by invalidate(): a load that was already running when its key was invalidated is not stored
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, key, loader):
+        self._loaders[key] = loader
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, loaded_at = entry
+            if self.ttl is not None and time.monotonic() - loaded_at > self.ttl:
+                del self._entries[key]
+                return None
+            self.hits += 1
+            return value
+
+    def get(self, key):
+        value = self.peek(key)
+        if value is not None:
+            return value
+        with self._lock:
+            generation = self._generations.get(key, 0)
+        value = self._loaders[key]()
+        with self._lock:
+            self.misses += 1
+            if self._generations.get(key, 0) == generation:
+                self._entries[key] = (value, time.monotonic())
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys or set(self._loaders) | set(self._entries):
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+def _names(repository):
+    def load():
+        with get_connection() as conn:
+            return repository(conn).names()
+    return load
+
+def _material_prices():
+    with get_connection() as conn:
+        return MaterialRepository(conn).prices()
+
+def _material_index():
+    types = reference_cache.get('material_types')
+    with get_connection() as conn:
+        return MaterialIndex(MaterialRepository(conn).index_rows(), types)
+
+reference_cache = ReferenceCache()
+reference_cache.register('product_types', _names(ProductTypeRepository))
+reference_cache.register('material_types', _names(MaterialTypeRepository))
+reference_cache.register('material_prices', _material_prices)
+reference_cache.register('material_index', _material_index)
@@ -0,0 +1,100 @@
+from decimal import Decimal
+from db import get_connection
+from repository import MaterialRepository
+
+# Plan row: (MaterialID, TypeName, Name, Unit, StockQuantity, MinQuantity, QuantityPerPackage, shortfall,
+#            packages, order quantity, UnitPrice, batch cost)
+COLUMNS = ('type_name', 'name', 'unit', 'stock', 'min_quantity', 'per_package', 'shortfall',
+           'packages', 'order_quantity', 'unit_price', 'batch_cost')
+COST_COLUMN = COLUMNS.index('batch_cost')
+HUNDREDTHS = (COLUMNS.index('stock'), COLUMNS.index('min_quantity'), COLUMNS.index('shortfall'),
+              COLUMNS.index('unit_price'), COLUMNS.index('batch_cost'))
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("Для планирования закупок установите пакет numpy")
+    return numpy
+
+def cents(np, values):
+    # DECIMAL(10,2) columns as exact int64 hundredths
+    return np.rint(np.array(values, dtype=np.float64) * 100).astype(np.int64)
+
+class ReplenishmentPlan:
+    # Stock of every material computed as whole columns at once. Quantities and money are kept in
+    # int64 hundredths so package rounding and the totals are exact, and a 100k warehouse is a few array passes.
+    def __init__(self, rows):
+        np = self.np = _numpy()
+        ids, type_names, names, units, stock, min_quantity, per_package, prices = zip(*rows) if rows else ((),) * 8
+        self.ids = np.array(ids, dtype=np.int64)
+        self.columns = {
+            'type_name': np.array(type_names, dtype=str),
+            'name': np.array(names, dtype=str),
+            'unit': np.array(units, dtype=str),
+            'stock': cents(np, stock),
+            'min_quantity': cents(np, min_quantity),
+            'per_package': np.array(per_package, dtype=np.int64),
+            'unit_price': cents(np, prices),
+        }
+        self.calculate()
+
+    def calculate(self):
+        np = self.np
+        c = self.columns
+        shortfall = np.maximum(c['min_quantity'] - c['stock'], 0)
+        # (difference + qty_per_pkg - 1) // qty_per_pkg on hundredths, so a fractional shortfall still orders a package
+        package = c['per_package'] * 100
+        packages = (shortfall + package - 1) // package
+        c['shortfall'] = shortfall
+        c['packages'] = packages
+        c['order_quantity'] = packages * c['per_package']
+        c['batch_cost'] = c['order_quantity'] * c['unit_price']
+        self.short = np.flatnonzero(packages > 0)
+
+    def __len__(self):
+        return len(self.short)
+
+    def totals(self):
+        c = self.columns
+        return {
+            'materials': len(self.short),
+            'packages': int(c['packages'].sum()),
+            'cost': Decimal(int(c['batch_cost'].sum())) / 100,
+        }
+
+    def order(self, query, short_only=True):
+        # Row positions for a search prefix and sort column, ties broken by id
+        np = self.np
+        positions = self.short if short_only else np.arange(len(self.ids))
+        if query.search:
+            names = np.char.lower(self.columns['name'][positions])
+            positions = positions[np.char.startswith(names, query.search.lower())]
+        positions = positions[np.argsort(self.ids[positions], kind='stable')]
+        if query.sort_column is not None:
+            values = self.columns[COLUMNS[query.sort_column]][positions]
+            positions = positions[np.argsort(values, kind='stable')]
+            if query.descending:
+                positions = positions[::-1]
+        return positions
+
+    def row(self, position):
+        values = []
+        for i, column in enumerate(COLUMNS):
+            value = self.columns[column][position].item()
+            values.append(Decimal(value) / 100 if i in HUNDREDTHS else value)
+        return (int(self.ids[position]),) + tuple(values)
+
+    def page(self, query, last_row, limit, short_only=True):
+        positions = self.order(query, short_only)
+        start = 0
+        if last_row is not None:
+            found = self.np.flatnonzero(self.ids[positions] == last_row[0])
+            start = int(found[0]) + 1 if len(found) else len(positions)
+        return [self.row(position) for position in positions[start:start + limit]]
+
+def load_plan(conn=None):
+    if conn is None:
+        with get_connection() as conn:
+            return load_plan(conn)
+    return ReplenishmentPlan(MaterialRepository(conn).stock_levels())
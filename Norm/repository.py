@@ -0,0 +1,513 @@
+# All SQL of the application. Repositories wrap a DB-API connection and know nothing about Qt,
+# so scripts, the importer/exporter and benchmarks use the same data path as the GUI.
+import uuid
+from collections import namedtuple
+
+IN_CHUNK = 1000
+# Tags ChangeLog rows written by this process so its own change feed can skip them
+INSTANCE_ID = uuid.uuid4().hex
+
+# Search text and sort order pushed down to the page queries; sort_column None means id order
+PageQuery = namedtuple('PageQuery', 'search sort_column descending')
+
+def chunks(values, size=IN_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+def prepared_cursor(conn, statement):
+    # (statement, cursor) for a write repeated on every save: a server-side prepared statement cached on the
+    # pooled connection (db.PreparedStatements). Connections without the cache get a plain cursor.
+    statements = getattr(conn, 'prepared_statements', None)
+    if statements is None:
+        return statement, conn.cursor()
+    statement, cursor = statements.cursor(statement)
+    track = getattr(conn, 'track', None)
+    return statement, (cursor if track is None else track(cursor))
+
+def page_clause(id_column, sort_columns, search_columns, query, last_row, limit):
+    # WHERE/ORDER BY/LIMIT for one keyset page: prefix search (served by the Article/Name indexes)
+    # and a (sort value, id) cursor so every page is an index range scan instead of an OFFSET
+    conditions = []
+    params = []
+    if query.search:
+        # '!' as the escape character reads the same in MySQL and SQLite string literals, unlike a backslash
+        pattern = query.search.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+        conditions.append("(" + " OR ".join(f"{column} LIKE %s ESCAPE '!'" for column in search_columns) + ")")
+        params += [pattern] * len(search_columns)
+    sort_column = sort_columns.get(query.sort_column)
+    operator = "<" if query.descending else ">"
+    direction = " DESC" if query.descending else ""
+    if last_row is not None:
+        if sort_column:
+            value = last_row[query.sort_column + 1]
+            conditions.append(f"({sort_column} {operator} %s OR ({sort_column} = %s AND {id_column} {operator} %s))")
+            params += [value, value, last_row[0]]
+        else:
+            conditions.append(f"{id_column} > %s")
+            params.append(last_row[0])
+    order = f"{sort_column}{direction}, {id_column}{direction}" if sort_column else id_column
+    clause = ("WHERE " + " AND ".join(conditions) + " " if conditions else "") + f"ORDER BY {order} LIMIT %s"
+    return clause, params + [limit]
+
+class ConflictError(Exception):
+    # Rows changed or deleted by someone else since they were read; nothing of the batch was written, the rest of
+    # the transaction is left to the caller to roll back
+    def __init__(self, table, ids):
+        super().__init__(f"Записи {table} изменены другим пользователем: {', '.join(map(str, ids))}")
+        self.table = table
+        self.ids = ids
+
+class Record:
+    __slots__ = ()
+    # Bookkeeping fields that are not written as columns
+    meta = ('id', 'version')
+
+    def __init__(self, *values, **named):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+        for field in self.__slots__[len(values):]:
+            setattr(self, field, named.get(field))
+
+    def values(self):
+        # Column values without the id and version, in INSERT order
+        return tuple(getattr(self, field) for field in self.__slots__ if field not in self.meta)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+class ProductType(Record):
+    __slots__ = ('id', 'name', 'coefficient')
+
+class MaterialType(Record):
+    __slots__ = ('id', 'name', 'defect_percentage')
+
+class Product(Record):
+    __slots__ = ('id', 'article', 'type_id', 'name', 'min_cost', 'roll_width', 'version')
+
+class Material(Record):
+    __slots__ = ('id', 'name', 'type_id', 'unit_price', 'stock_quantity', 'unit', 'quantity_per_package', 'min_quantity',
+                 'version')
+
+class ProductMaterial(Record):
+    # A bill line holds either a material or a semi-finished product (component_id) made from its own bill
+    __slots__ = ('id', 'product_id', 'material_id', 'quantity', 'component_id', 'version')
+
+class Repository:
+    record = None
+    table = None
+    id_column = None
+    columns = ()
+    # Tables edited concurrently carry a row version for optimistic locking
+    version_column = None
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _select(self):
+        version = f", {self.version_column}" if self.version_column else ""
+        return f"SELECT {self.id_column}, {', '.join(self.columns)}{version} FROM {self.table} "
+
+    def all(self):
+        cursor = self.conn.cursor()
+        cursor.execute(self._select() + f"ORDER BY {self.id_column}")
+        return [self.record(*row) for row in cursor.fetchall()]
+
+    def get(self, row_id):
+        return self.get_many([row_id]).get(row_id)
+
+    def get_many(self, ids):
+        found = {}
+        cursor = self.conn.cursor()
+        for chunk in chunks(ids):
+            cursor.execute(self._select() + f"WHERE {self.id_column} IN ({placeholders(chunk)})", chunk)
+            for row in cursor.fetchall():
+                found[row[0]] = self.record(*row)
+        return found
+
+    def insert(self, item):
+        statement, cursor = prepared_cursor(
+            self.conn, f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES ({placeholders(self.columns)})")
+        cursor.execute(statement, item.values())
+        item.id = cursor.lastrowid
+        if self.version_column:
+            item.version = 1
+        return item.id
+
+    def insert_many(self, items):
+        # mysql.connector rewrites executemany INSERTs into multi-row VALUES statements
+        cursor = self.conn.cursor()
+        cursor.executemany(f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES ({placeholders(self.columns)})",
+                           [item.values() for item in items])
+        return cursor.rowcount
+
+    def update(self, item):
+        return self.update_many([item])
+
+    def update_many(self, items):
+        # Returns {id: new row version} for the items read with a version. The items themselves are not touched:
+        # the caller owns the transaction and sets the versions once its COMMIT has gone through.
+        assignments = ", ".join(f"{column}=%s" for column in self.columns)
+        if not self.version_column:
+            statement, cursor = prepared_cursor(self.conn, f"UPDATE {self.table} SET {assignments} WHERE {self.id_column}=%s")
+            cursor.executemany(statement, [item.values() + (item.id,) for item in items])
+            return {}
+        # A row read with a version is written only if nobody has changed it since. The batch goes out as one
+        # executemany; fewer matched rows than sent means a conflict.
+        assignments += f", {self.version_column}={self.version_column}+1"
+        checked = [item for item in items if item.version is not None]
+        unchecked = [item for item in items if item.version is None]
+        if unchecked:
+            statement, cursor = prepared_cursor(self.conn, f"UPDATE {self.table} SET {assignments} WHERE {self.id_column}=%s")
+            cursor.executemany(statement, [item.values() + (item.id,) for item in unchecked])
+        if checked:
+            self.conn.cursor().execute("SAVEPOINT update_many")
+            statement, cursor = prepared_cursor(
+                self.conn, f"UPDATE {self.table} SET {assignments} WHERE {self.id_column}=%s AND {self.version_column}=%s")
+            cursor.executemany(statement, [item.values() + (item.id, item.version) for item in checked])
+            if cursor.rowcount != len(checked):
+                # Undo only the partial batch; then the rows whose version moved are exactly the stale ones
+                self.conn.cursor().execute("ROLLBACK TO SAVEPOINT update_many")
+                current = self.versions([item.id for item in checked])
+                raise ConflictError(self.table, [item.id for item in checked if current.get(item.id) != item.version])
+        return {item.id: item.version + 1 for item in checked}
+
+    def versions(self, ids):
+        found = {}
+        cursor = self.conn.cursor()
+        for chunk in chunks(ids):
+            cursor.execute(f"SELECT {self.id_column}, {self.version_column} FROM {self.table} "
+                           f"WHERE {self.id_column} IN ({placeholders(chunk)})", chunk)
+            found.update(cursor.fetchall())
+        return found
+
+    def save(self, item):
+        if item.id:
+            self.update(item)
+            return item.id
+        return self.insert(item)
+
+    def delete_many(self, items):
+        # Like update_many(): a row read with a version is deleted only if nobody has changed it since,
+        # otherwise ConflictError with nothing of the batch deleted
+        cursor = self.conn.cursor()
+        deleted = 0
+        checked = [item for item in items if self.version_column and item.version is not None]
+        unchecked = [item.id for item in items if not (self.version_column and item.version is not None)]
+        for chunk in chunks(unchecked):
+            cursor.execute(f"DELETE FROM {self.table} WHERE {self.id_column} IN ({placeholders(chunk)})", chunk)
+            deleted += cursor.rowcount
+        if checked:
+            self.conn.cursor().execute("SAVEPOINT delete_many")
+            statement, cursor = prepared_cursor(
+                self.conn, f"DELETE FROM {self.table} WHERE {self.id_column}=%s AND {self.version_column}=%s")
+            cursor.executemany(statement, [(item.id, item.version) for item in checked])
+            if cursor.rowcount != len(checked):
+                self.conn.cursor().execute("ROLLBACK TO SAVEPOINT delete_many")
+                current = self.versions([item.id for item in checked])
+                raise ConflictError(self.table, [item.id for item in checked if current.get(item.id) != item.version])
+            deleted += cursor.rowcount
+        return deleted
+
+    def names(self):
+        # (id, name) pairs for combo boxes and lookup maps
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT {self.id_column}, {self.columns[0]} FROM {self.table}")
+        return cursor.fetchall()
+
+class ProductTypeRepository(Repository):
+    record = ProductType
+    table = "ProductTypes"
+    id_column = "ProductTypeID"
+    columns = ("TypeName", "Coefficient")
+
+class MaterialTypeRepository(Repository):
+    record = MaterialType
+    table = "MaterialTypes"
+    id_column = "MaterialTypeID"
+    columns = ("TypeName", "DefectPercentage")
+
+class ProductRepository(Repository):
+    record = Product
+    table = "Products"
+    id_column = "ProductID"
+    columns = ("Article", "ProductTypeID", "Name", "MinCostForPartner", "RollWidth")
+    version_column = "RowVersion"
+    # Products tab row: (ProductID, Article, TypeName, Name, MinCostForPartner, RollWidth)
+    TAB_QUERY = ("SELECT p.ProductID, p.Article, pt.TypeName, p.Name, p.MinCostForPartner, p.RollWidth "
+                 "FROM Products p JOIN ProductTypes pt ON p.ProductTypeID = pt.ProductTypeID ")
+    SORT_COLUMNS = {0: "p.Article", 1: "pt.TypeName", 2: "p.Name", 3: "p.MinCostForPartner", 4: "p.RollWidth"}
+    SEARCH_COLUMNS = ["p.Article", "p.Name"]
+
+    def names(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT ProductID, Article FROM Products")
+        return cursor.fetchall()
+
+    def find_article(self, article):
+        # (ProductID, Article, Name) of the product with this article, or None
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT ProductID, Article, Name FROM Products WHERE Article = %s", (article,))
+        return cursor.fetchone()
+
+    def tab_rows(self, condition="", params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(self.TAB_QUERY + condition, params)
+        return cursor.fetchall()
+
+    def tab_page(self, query, last_row, limit):
+        return self.tab_rows(*page_clause("p.ProductID", self.SORT_COLUMNS, self.SEARCH_COLUMNS, query, last_row, limit))
+
+    def tab_rows_by_id(self, ids):
+        rows = []
+        for chunk in chunks(ids):
+            rows += self.tab_rows(f"WHERE p.ProductID IN ({placeholders(chunk)})", chunk)
+        return rows
+
+    def pricing_inputs(self, ids=None):
+        # (ProductID, MinCostForPartner, Coefficient, RowVersion); a product without a type has coefficient 1
+        query = ("SELECT p.ProductID, p.MinCostForPartner, COALESCE(pt.Coefficient, 1), p.RowVersion "
+                 "FROM Products p LEFT JOIN ProductTypes pt ON p.ProductTypeID = pt.ProductTypeID")
+        cursor = self.conn.cursor()
+        if ids is None:
+            cursor.execute(query)
+            return cursor.fetchall()
+        rows = []
+        for chunk in chunks(ids):
+            cursor.execute(query + f" WHERE p.ProductID IN ({placeholders(chunk)})", chunk)
+            rows += cursor.fetchall()
+        return rows
+
+    def requirement_inputs(self, ids):
+        # {ProductID: (RollWidth, Coefficient)}; a product without a type has coefficient 1
+        found = {}
+        cursor = self.conn.cursor()
+        for chunk in chunks(ids):
+            cursor.execute("SELECT p.ProductID, p.RollWidth, COALESCE(pt.Coefficient, 1) "
+                           "FROM Products p LEFT JOIN ProductTypes pt ON p.ProductTypeID = pt.ProductTypeID "
+                           f"WHERE p.ProductID IN ({placeholders(chunk)})", chunk)
+            found.update((row[0], row[1:]) for row in cursor.fetchall())
+        return found
+
+    def iter_with_costs(self, fetch_size, costs, with_id=False):
+        # Unbuffered cursor: rows come off the socket in fetch_size chunks instead of being loaded at once.
+        # The cost is summed in the same query from the material lines; costs: {ProductID: cost} rolled up
+        # beforehand for the products with semi-finished lines (costs.nested_costs) replaces it for those.
+        # with_id puts ProductID first, giving Products tab rows with the cost appended
+        cursor = self.conn.cursor(buffered=False)
+        cursor.execute("SELECT p.ProductID, p.Article, pt.TypeName, p.Name, p.MinCostForPartner, p.RollWidth, "
+                       "COALESCE(c.Cost, 0) FROM Products p JOIN ProductTypes pt ON p.ProductTypeID = pt.ProductTypeID "
+                       f"LEFT JOIN ({ProductMaterialRepository.COSTS_QUERY}GROUP BY pm.ProductID) c "
+                       "ON c.ProductID = p.ProductID ORDER BY p.ProductID")
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield (row[:-1] if with_id else row[1:-1]) + (costs.get(row[0], row[-1]),)
+
+class MaterialRepository(Repository):
+    record = Material
+    table = "Materials"
+    id_column = "MaterialID"
+    columns = ("Name", "MaterialTypeID", "UnitPrice", "StockQuantity", "Unit", "QuantityPerPackage", "MinQuantity")
+    version_column = "RowVersion"
+    # Materials tab row: (MaterialID, TypeName, Name, UnitPrice, StockQuantity, Unit, QuantityPerPackage, MinQuantity)
+    TAB_QUERY = ("SELECT m.MaterialID, mt.TypeName, m.Name, m.UnitPrice, m.StockQuantity, m.Unit, m.QuantityPerPackage, m.MinQuantity "
+                 "FROM Materials m JOIN MaterialTypes mt ON m.MaterialTypeID = mt.MaterialTypeID ")
+    SORT_COLUMNS = {0: "mt.TypeName", 1: "m.Name", 2: "m.UnitPrice", 3: "m.StockQuantity", 4: "m.Unit",
+                    5: "m.QuantityPerPackage", 6: "m.MinQuantity"}
+    SEARCH_COLUMNS = ["m.Name"]
+
+    def tab_rows(self, condition="", params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(self.TAB_QUERY + condition, params)
+        return cursor.fetchall()
+
+    def tab_page(self, query, last_row, limit):
+        return self.tab_rows(*page_clause("m.MaterialID", self.SORT_COLUMNS, self.SEARCH_COLUMNS, query, last_row, limit))
+
+    def tab_rows_by_id(self, ids):
+        rows = []
+        for chunk in chunks(ids):
+            rows += self.tab_rows(f"WHERE m.MaterialID IN ({placeholders(chunk)})", chunk)
+        return rows
+
+    def prices(self, ids=None):
+        prices = {}
+        cursor = self.conn.cursor()
+        if ids is None:
+            cursor.execute("SELECT MaterialID, UnitPrice FROM Materials")
+            return dict(cursor.fetchall())
+        for chunk in chunks(ids):
+            cursor.execute(f"SELECT MaterialID, UnitPrice FROM Materials WHERE MaterialID IN ({placeholders(chunk)})", chunk)
+            prices.update(cursor.fetchall())
+        return prices
+
+    def index_rows(self):
+        # (MaterialID, Name, MaterialTypeID) for the material search index
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT MaterialID, Name, MaterialTypeID FROM Materials")
+        return cursor.fetchall()
+
+    def requirement_inputs(self, ids):
+        # {MaterialID: (DefectPercentage, Name, Unit, StockQuantity)}; a material without a type has no defect allowance
+        found = {}
+        cursor = self.conn.cursor()
+        for chunk in chunks(ids):
+            cursor.execute("SELECT m.MaterialID, COALESCE(mt.DefectPercentage, 0), m.Name, m.Unit, m.StockQuantity "
+                           "FROM Materials m LEFT JOIN MaterialTypes mt ON m.MaterialTypeID = mt.MaterialTypeID "
+                           f"WHERE m.MaterialID IN ({placeholders(chunk)})", chunk)
+            found.update((row[0], row[1:]) for row in cursor.fetchall())
+        return found
+
+    def stock_levels(self):
+        # (MaterialID, TypeName, Name, Unit, StockQuantity, MinQuantity, QuantityPerPackage, UnitPrice) for the whole warehouse
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT m.MaterialID, mt.TypeName, m.Name, m.Unit, m.StockQuantity, m.MinQuantity, m.QuantityPerPackage, m.UnitPrice "
+                       "FROM Materials m JOIN MaterialTypes mt ON m.MaterialTypeID = mt.MaterialTypeID")
+        return cursor.fetchall()
+
+class ProductMaterialRepository(Repository):
+    record = ProductMaterial
+    table = "ProductMaterials"
+    id_column = "ProductMaterialID"
+    columns = ("ProductID", "MaterialID", "Quantity", "ComponentProductID")
+    version_column = "RowVersion"
+    # Material part of a product's cost = sum of material price x quantity over its material lines; lines with a
+    # semi-finished product are rolled up by costs.py
+    COSTS_QUERY = ("SELECT pm.ProductID, SUM(m.UnitPrice * pm.Quantity) AS Cost "
+                   "FROM ProductMaterials pm JOIN Materials m ON pm.MaterialID = m.MaterialID ")
+
+    def for_product(self, product_id):
+        # (ProductMaterialID, material name or semi-finished product article, Quantity)
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pm.ProductMaterialID, COALESCE(m.Name, c.Article), pm.Quantity "
+                       "FROM ProductMaterials pm LEFT JOIN Materials m ON pm.MaterialID = m.MaterialID "
+                       "LEFT JOIN Products c ON pm.ComponentProductID = c.ProductID "
+                       "WHERE pm.ProductID = %s", (product_id,))
+        return cursor.fetchall()
+
+    def lines_for(self, product_id):
+        cursor = self.conn.cursor()
+        cursor.execute(self._select() + f"WHERE ProductID = %s ORDER BY {self.id_column}", (product_id,))
+        return [self.record(*row) for row in cursor.fetchall()]
+
+    def cost_sums(self, product_ids=None):
+        cursor = self.conn.cursor()
+        if product_ids is None:
+            cursor.execute(self.COSTS_QUERY + "GROUP BY pm.ProductID")
+            return dict(cursor.fetchall())
+        costs = {}
+        for chunk in chunks(product_ids):
+            cursor.execute(self.COSTS_QUERY + f"WHERE pm.ProductID IN ({placeholders(chunk)}) GROUP BY pm.ProductID", chunk)
+            costs.update(cursor.fetchall())
+        return costs
+
+    def products_using(self, material_ids):
+        # ProductIDs whose own bill of materials contains any of the materials (see products_above for the rest)
+        product_ids = set()
+        cursor = self.conn.cursor()
+        for chunk in chunks(material_ids):
+            cursor.execute(f"SELECT DISTINCT ProductID FROM ProductMaterials WHERE MaterialID IN ({placeholders(chunk)})", chunk)
+            product_ids.update(row[0] for row in cursor.fetchall())
+        return product_ids
+
+    def products_above(self, product_ids):
+        # Products that contain any of the given ones as a semi-finished component, directly or further up;
+        # one query per level of nesting
+        found = set()
+        level = set(product_ids)
+        cursor = self.conn.cursor()
+        while level:
+            parents = set()
+            for chunk in chunks(level):
+                cursor.execute("SELECT DISTINCT ProductID FROM ProductMaterials "
+                               f"WHERE ComponentProductID IN ({placeholders(chunk)})", chunk)
+                parents.update(row[0] for row in cursor.fetchall())
+            level = parents - found
+            found |= parents
+        return found
+
+    def component_links(self):
+        # (ProductID, ComponentProductID) for every semi-finished line of the catalog
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT ProductID, ComponentProductID FROM ProductMaterials WHERE ComponentProductID IS NOT NULL")
+        return cursor.fetchall()
+
+    def lines_with_prices(self, product_ids=None):
+        # (ProductMaterialID, ProductID, MaterialID, ComponentProductID, Quantity, UnitPrice) for the whole catalog
+        # in one read; UnitPrice is NULL on semi-finished lines
+        cursor = self.conn.cursor()
+        query = ("SELECT pm.ProductMaterialID, pm.ProductID, pm.MaterialID, pm.ComponentProductID, pm.Quantity, m.UnitPrice "
+                 "FROM ProductMaterials pm LEFT JOIN Materials m ON pm.MaterialID = m.MaterialID")
+        if product_ids is None:
+            cursor.execute(query)
+            return cursor.fetchall()
+        rows = []
+        for chunk in chunks(product_ids):
+            cursor.execute(query + f" WHERE pm.ProductID IN ({placeholders(chunk)})", chunk)
+            rows += cursor.fetchall()
+        return rows
+
+    def lines_below(self, product_ids):
+        # lines_with_prices for the products and, level by level, for the semi-finished products in their bills:
+        # everything their costs are rolled up from, in one query per level of nesting
+        rows = []
+        seen = set()
+        level = set(product_ids)
+        while level:
+            seen |= level
+            found = self.lines_with_prices(level)
+            rows += found
+            level = {row[3] for row in found if row[3] is not None} - seen
+        return rows
+
+class ChangeLogRepository:
+    # Change feed between running instances: save paths record which rows they changed in the same
+    # transaction, other instances read everything after their high-water mark. RowID NULL means the
+    # whole table (bulk import); for ProductMaterials RowID is the ProductID whose bill changed.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def record(self, table, row_ids=None):
+        rows = [(table, None, INSTANCE_ID)] if row_ids is None else [(table, row_id, INSTANCE_ID) for row_id in row_ids]
+        cursor = self.conn.cursor()
+        cursor.executemany("INSERT INTO ChangeLog (TableName, RowID, Source) VALUES (%s, %s, %s)", rows)
+
+    def record_many(self, changes):
+        # {table: row ids} as one multi-row INSERT, for saves written together (writes.WriteQueue)
+        rows = [(table, row_id, INSTANCE_ID) for table, row_ids in changes.items() for row_id in row_ids]
+        if rows:
+            cursor = self.conn.cursor()
+            cursor.executemany("INSERT INTO ChangeLog (TableName, RowID, Source) VALUES (%s, %s, %s)", rows)
+
+    def latest(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(ChangeID), 0) FROM ChangeLog")
+        return cursor.fetchone()[0]
+
+    def earliest(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COALESCE(MIN(ChangeID), 0) FROM ChangeLog")
+        return cursor.fetchone()[0]
+
+    def since(self, change_id, limit):
+        # (ChangeID, TableName, RowID, Source) after the mark, oldest first
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT ChangeID, TableName, RowID, Source FROM ChangeLog WHERE ChangeID > %s "
+                       "ORDER BY ChangeID LIMIT %s", (change_id, limit))
+        return cursor.fetchall()
+
+    def prune(self, keep):
+        # Keep only the last `keep` entries; instances further behind reload instead
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM ChangeLog WHERE ChangeID <= %s", (self.latest() - keep,))
+        return cursor.rowcount
@@ -0,0 +1,83 @@
+-- Reference schema at the latest migration. Databases are created and upgraded with migrations.py,
+-- which also adopts a database created from this file.
+CREATE DATABASE IF NOT EXISTS MosaicDB;
+USE MosaicDB;
+
+CREATE TABLE ProductTypes (
+    ProductTypeID INT AUTO_INCREMENT PRIMARY KEY,
+    TypeName VARCHAR(255) NOT NULL,
+    Coefficient DECIMAL(10,2) NOT NULL
+);
+
+CREATE TABLE Products (
+    ProductID INT AUTO_INCREMENT PRIMARY KEY,
+    Article VARCHAR(255) NOT NULL,
+    ProductTypeID INT,
+    Name VARCHAR(255) NOT NULL,
+    MinCostForPartner DECIMAL(10,2) NOT NULL CHECK (MinCostForPartner >= 0),
+    RollWidth DECIMAL(5,2) NOT NULL CHECK (RollWidth >= 0),
+    RowVersion INT NOT NULL DEFAULT 1,
+    FOREIGN KEY (ProductTypeID) REFERENCES ProductTypes(ProductTypeID)
+);
+
+CREATE TABLE MaterialTypes (
+    MaterialTypeID INT AUTO_INCREMENT PRIMARY KEY,
+    TypeName VARCHAR(255) NOT NULL,
+    DefectPercentage DECIMAL(5,2) NOT NULL CHECK (DefectPercentage >= 0 AND DefectPercentage <= 100)
+);
+
+CREATE TABLE Materials (
+    MaterialID INT AUTO_INCREMENT PRIMARY KEY,
+    Name VARCHAR(255) NOT NULL,
+    MaterialTypeID INT,
+    UnitPrice DECIMAL(10,2) NOT NULL CHECK (UnitPrice >= 0),
+    StockQuantity DECIMAL(10,2) NOT NULL CHECK (StockQuantity >= 0),
+    Unit VARCHAR(50) NOT NULL,
+    QuantityPerPackage INT NOT NULL CHECK (QuantityPerPackage > 0),
+    MinQuantity DECIMAL(10,2) NOT NULL CHECK (MinQuantity >= 0),
+    RowVersion INT NOT NULL DEFAULT 1,
+    FOREIGN KEY (MaterialTypeID) REFERENCES MaterialTypes(MaterialTypeID)
+);
+
+CREATE TABLE ProductMaterials (
+    ProductMaterialID INT AUTO_INCREMENT PRIMARY KEY,
+    ProductID INT,
+    MaterialID INT,
+    -- A semi-finished product used as a part: Quantity units of it per unit of ProductID
+    ComponentProductID INT NULL,
+    Quantity DECIMAL(10,2) NOT NULL CHECK (Quantity >= 0),
+    RowVersion INT NOT NULL DEFAULT 1,
+    FOREIGN KEY (ProductID) REFERENCES Products(ProductID),
+    FOREIGN KEY (MaterialID) REFERENCES Materials(MaterialID),
+    CONSTRAINT FK_ProductMaterials_Component FOREIGN KEY (ComponentProductID) REFERENCES Products(ProductID),
+    CONSTRAINT CK_ProductMaterials_Line CHECK ((MaterialID IS NULL) <> (ComponentProductID IS NULL))
+);
+
+-- Change feed read by other running instances (see ChangeLogRepository)
+CREATE TABLE ChangeLog (
+    ChangeID INT AUTO_INCREMENT PRIMARY KEY,
+    TableName VARCHAR(64) NOT NULL,
+    RowID INT NULL,
+    Source CHAR(32) NOT NULL,
+    ChangedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Search and sorting on the Products and Materials tabs (prefix LIKE and keyset ORDER BY col, id)
+CREATE UNIQUE INDEX UX_Products_Article ON Products (Article);
+CREATE INDEX IX_Products_Name ON Products (Name);
+CREATE INDEX IX_Products_ProductTypeID ON Products (ProductTypeID);
+CREATE INDEX IX_Products_MinCostForPartner ON Products (MinCostForPartner);
+CREATE INDEX IX_Products_RollWidth ON Products (RollWidth);
+CREATE INDEX IX_Materials_Name ON Materials (Name);
+CREATE INDEX IX_Materials_MaterialTypeID ON Materials (MaterialTypeID);
+CREATE INDEX IX_Materials_UnitPrice ON Materials (UnitPrice);
+CREATE INDEX IX_Materials_StockQuantity ON Materials (StockQuantity);
+CREATE INDEX IX_Materials_Unit ON Materials (Unit);
+CREATE INDEX IX_Materials_QuantityPerPackage ON Materials (QuantityPerPackage);
+CREATE INDEX IX_Materials_MinQuantity ON Materials (MinQuantity);
+
+-- Bills of materials by product and products by material, answered from the index alone
+CREATE INDEX IX_ProductMaterials_Product ON ProductMaterials (ProductID, MaterialID, Quantity);
+CREATE INDEX IX_ProductMaterials_Material ON ProductMaterials (MaterialID, ProductID, Quantity);
+-- Products a semi-finished product goes into (cost roll-up to the parents)
+CREATE INDEX IX_ProductMaterials_Component ON ProductMaterials (ComponentProductID, ProductID, Quantity);
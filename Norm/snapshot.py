@@ -0,0 +1,258 @@
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+import db
+from changefeed import CHANGE_BATCH, Changes
+from costs import ZERO, calculate_product_costs, nested_costs
+from pricing import partner_prices
+from repository import (ChangeLogRepository, MaterialRepository, MaterialTypeRepository, ProductMaterialRepository,
+                        ProductRepository, ProductTypeRepository, page_clause)
+from sqlite_db import SqliteConnection
+
+SNAPSHOT_PATH = os.environ.get('MOSAIC_SNAPSHOT',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot.sqlite3'))
+# Bump when the tables below change; a snapshot in an older format is rebuilt
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_TABLES = ("SnapshotInfo", "ProductTypes", "MaterialTypes", "Products", "Materials")
+# ChangeIDs are taken at insert, not at commit: the entries this far below the mark are read again on
+# every reconcile so a transaction that committed late is not missed. Applying a row twice is harmless.
+RECONCILE_OVERLAP = 1000
+FETCH_SIZE = 5000
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS SnapshotInfo (Key TEXT PRIMARY KEY, Value TEXT)",
+    "CREATE TABLE IF NOT EXISTS ProductTypes (ProductTypeID INTEGER PRIMARY KEY, TypeName TEXT, Coefficient REAL)",
+    "CREATE TABLE IF NOT EXISTS MaterialTypes (MaterialTypeID INTEGER PRIMARY KEY, TypeName TEXT, DefectPercentage REAL)",
+    # Tab rows as the window shows them, products with the computed cost and partner price
+    "CREATE TABLE IF NOT EXISTS Products (ProductID INTEGER PRIMARY KEY, Article TEXT, TypeName TEXT, Name TEXT, "
+    "MinCostForPartner REAL, RollWidth REAL, Cost REAL, PartnerPrice REAL)",
+    "CREATE TABLE IF NOT EXISTS Materials (MaterialID INTEGER PRIMARY KEY, TypeName TEXT, Name TEXT, UnitPrice REAL, "
+    "StockQuantity REAL, Unit TEXT, QuantityPerPackage INTEGER, MinQuantity REAL)",
+]
+PRODUCTS_QUERY = ("SELECT p.ProductID, p.Article, p.TypeName, p.Name, p.MinCostForPartner, p.RollWidth, p.Cost, "
+                  "p.PartnerPrice FROM Products p ")
+PRODUCT_SORT_COLUMNS = {0: "p.Article", 1: "p.TypeName", 2: "p.Name", 3: "p.MinCostForPartner", 4: "p.RollWidth", 5: "p.Cost",
+                        6: "p.PartnerPrice"}
+# Money and quantities come back as Decimal like the MySQL rows
+PRODUCT_DECIMALS = (4, 5, 6, 7)
+MATERIALS_QUERY = ("SELECT m.MaterialID, m.TypeName, m.Name, m.UnitPrice, m.StockQuantity, m.Unit, m.QuantityPerPackage, "
+                   "m.MinQuantity FROM Materials m ")
+MATERIAL_SORT_COLUMNS = {0: "m.TypeName", 1: "m.Name", 2: "m.UnitPrice", 3: "m.StockQuantity", 4: "m.Unit",
+                         5: "m.QuantityPerPackage", 6: "m.MinQuantity"}
+MATERIAL_DECIMALS = (3, 4, 7)
+# Keyset pages sort on every tab column, so each one gets an index (SQLite appends the rowid to it)
+SCHEMA += [f"CREATE INDEX IF NOT EXISTS IX_Products_{column[2:]} ON Products ({column[2:]})"
+           for column in PRODUCT_SORT_COLUMNS.values()]
+SCHEMA += [f"CREATE INDEX IF NOT EXISTS IX_Materials_{column[2:]} ON Materials ({column[2:]})"
+           for column in MATERIAL_SORT_COLUMNS.values()]
+
+@lru_cache(maxsize=64)
+def _like_regex(pattern, escape):
+    parts = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == escape:
+            parts.append(re.escape(next(chars, "")))
+        elif char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+def _like(pattern, value, escape=None):
+    # SQLite's own LIKE folds ASCII letters only; names here are Russian
+    if pattern is None or value is None:
+        return None
+    return _like_regex(pattern, escape).fullmatch(str(value)) is not None
+
+def _decimals(row, positions):
+    return tuple(Decimal(f"{value:.2f}") if i in positions and value is not None else value for i, value in enumerate(row))
+
+def _with_prices(rows, coefficients):
+    # Tab rows with the cost appended get the partner price as well
+    prices = partner_prices([row[6] for row in rows], [coefficients.get(row[0], 1) for row in rows], [row[4] for row in rows])
+    return [row + (price,) for row, price in zip(rows, prices)]
+
+def _stored_format(cursor):
+    try:
+        cursor.execute("SELECT Value FROM SnapshotInfo WHERE Key = 'format'")
+    except sqlite3.Error:
+        return None
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def database_name():
+    config = db.DB_CONFIG
+    return f"{config['host']}:{config['port']}/{config['database']}"
+
+class Snapshot:
+    # Local SQLite copy of the Products and Materials tabs, the type lists and product costs. The window
+    # pages from it before MySQL answers and browses it read-only when MySQL does not answer at all.
+    # reconcile() brings it up to date from the ChangeLog entries after the mark stored with it.
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+
+    @contextmanager
+    def connection(self, create=False):
+        if not create and not os.path.exists(self.path):
+            raise sqlite3.OperationalError(f"Снимок данных не найден: {self.path}")
+        conn = SqliteConnection(self.path, timeout=30)
+        try:
+            conn.conn.create_function("like", 2, _like, deterministic=True)
+            conn.conn.create_function("like", 3, _like, deterministic=True)
+            if create:
+                # WAL: the window keeps reading the previous state while a reconcile writes
+                conn.conn.execute("PRAGMA journal_mode=WAL")
+                cursor = conn.cursor()
+                if _stored_format(cursor) != str(SNAPSHOT_FORMAT):
+                    # CREATE TABLE IF NOT EXISTS would keep the columns of the older format
+                    for table in SNAPSHOT_TABLES:
+                        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                for statement in SCHEMA:
+                    cursor.execute(statement)
+            yield conn
+        finally:
+            conn.close()
+
+    def info(self):
+        # {'format', 'database', 'change_id', 'saved_at'}, or None without a usable snapshot
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT Key, Value FROM SnapshotInfo")
+                info = dict(cursor.fetchall())
+        except sqlite3.Error:
+            return None
+        if info.get('format') != str(SNAPSHOT_FORMAT) or info.get('database') != database_name():
+            return None
+        return info
+
+    def products_page(self, query, last_row, limit):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            clause, params = page_clause("p.ProductID", PRODUCT_SORT_COLUMNS, ProductRepository.SEARCH_COLUMNS,
+                                         query, last_row, limit)
+            cursor.execute(PRODUCTS_QUERY + clause, params)
+            return [_decimals(row, PRODUCT_DECIMALS) for row in cursor.fetchall()]
+
+    def materials_page(self, query, last_row, limit):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            clause, params = page_clause("m.MaterialID", MATERIAL_SORT_COLUMNS, MaterialRepository.SEARCH_COLUMNS,
+                                         query, last_row, limit)
+            cursor.execute(MATERIALS_QUERY + clause, params)
+            return [_decimals(row, MATERIAL_DECIMALS) for row in cursor.fetchall()]
+
+    def reconcile(self, conn):
+        # Returns Changes for the rows built from the snapshot: the rows that changed, or reload flags after a rebuild
+        info = self.info()
+        log = ChangeLogRepository(conn)
+        try:
+            latest = log.latest()
+            earliest = log.earliest()
+        except db.Error as e:
+            # A database without ChangeLog cannot say what changed: copy everything each time
+            print(f"Ошибка чтения журнала изменений, снимок будет создан заново: {e}")
+            return self.rebuild(conn, None)
+        mark = int(info['change_id']) if info and info.get('change_id') else None
+        # Entries after the mark were pruned: the gap cannot be replayed
+        if mark is None or mark + 1 < earliest:
+            return self.rebuild(conn, latest)
+        changed = {}
+        start = max(mark - RECONCILE_OVERLAP, 0)
+        while True:
+            rows = log.since(start, CHANGE_BATCH)
+            for change_id, table, row_id, source in rows:
+                if row_id is None:
+                    # Whole-table entries below the mark were applied by the previous reconcile
+                    if change_id > mark:
+                        changed[table] = None
+                elif changed.get(table, ()) is not None:
+                    changed.setdefault(table, set()).add(row_id)
+            if len(rows) < CHANGE_BATCH:
+                break
+            start = rows[-1][0]
+        if None in changed.values():
+            return self.rebuild(conn, latest)
+        return self._apply(conn, changed, latest)
+
+    def rebuild(self, conn, mark):
+        materials = MaterialRepository(conn).tab_rows()
+        types = ProductTypeRepository(conn).all(), MaterialTypeRepository(conn).all()
+        coefficients = {row[0]: row[2] for row in ProductRepository(conn).pricing_inputs()}
+        costs = nested_costs(conn)
+        insert = "INSERT INTO Products VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+        with self.connection(create=True) as snapshot:
+            cursor = snapshot.cursor()
+            cursor.execute("DELETE FROM Products")
+            cursor.execute("DELETE FROM Materials")
+            batch = []
+            for row in ProductRepository(conn).iter_with_costs(FETCH_SIZE, costs, with_id=True):
+                batch.append(row)
+                if len(batch) >= FETCH_SIZE:
+                    cursor.executemany(insert, _with_prices(batch, coefficients))
+                    batch = []
+            cursor.executemany(insert, _with_prices(batch, coefficients))
+            cursor.executemany("INSERT INTO Materials VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", materials)
+            self._save_types(snapshot, *types)
+            self._save_info(snapshot, mark)
+            snapshot.commit()
+        # A snapshot still not usable after a rebuild would be rebuilt again on every start
+        if self.info() is None:
+            raise sqlite3.OperationalError(f"Снимок данных не удалось пересоздать: {self.path}")
+        return Changes([], [], {}, {}, True, True)
+
+    def _apply(self, conn, changed, mark):
+        product_ids = set(changed.get("Products", ())) | set(changed.get("ProductMaterials", ()))
+        material_ids = changed.get("Materials", set())
+        material_rows = MaterialRepository(conn).tab_rows_by_id(material_ids)
+        # A price change moves the cost of every product using the material; a changed bill or price also moves
+        # every product containing those products as semi-finished components
+        lines = ProductMaterialRepository(conn)
+        product_ids |= lines.products_using(material_ids)
+        product_ids |= lines.products_above(product_ids)
+        costs = calculate_product_costs(product_ids, conn)
+        products = ProductRepository(conn)
+        coefficients = {row[0]: row[2] for row in products.pricing_inputs(product_ids)}
+        product_rows = _with_prices([row + (costs.get(row[0]) or ZERO,) for row in products.tab_rows_by_id(product_ids)],
+                                    coefficients)
+        types = ProductTypeRepository(conn).all(), MaterialTypeRepository(conn).all()
+        with self.connection(create=True) as snapshot:
+            self._replace(snapshot, "Products", "ProductID", product_ids, product_rows)
+            self._replace(snapshot, "Materials", "MaterialID", material_ids, material_rows)
+            self._save_types(snapshot, *types)
+            self._save_info(snapshot, mark)
+            snapshot.commit()
+        return Changes(product_rows, material_rows, {}, {}, False, False)
+
+    def _replace(self, snapshot, table, id_column, ids, rows):
+        # Deleted rows are in ids but not in rows
+        cursor = snapshot.cursor()
+        cursor.executemany(f"DELETE FROM {table} WHERE {id_column} = %s", [(row_id,) for row_id in ids])
+        if rows:
+            cursor.executemany(f"INSERT INTO {table} VALUES ({', '.join(['%s'] * len(rows[0]))})", rows)
+
+    def _save_types(self, snapshot, product_types, material_types):
+        cursor = snapshot.cursor()
+        cursor.execute("DELETE FROM ProductTypes")
+        cursor.execute("DELETE FROM MaterialTypes")
+        cursor.executemany("INSERT INTO ProductTypes VALUES (%s, %s, %s)",
+                           [(t.id, t.name, t.coefficient) for t in product_types])
+        cursor.executemany("INSERT INTO MaterialTypes VALUES (%s, %s, %s)",
+                           [(t.id, t.name, t.defect_percentage) for t in material_types])
+
+    def _save_info(self, snapshot, mark):
+        info = {
+            'format': SNAPSHOT_FORMAT,
+            'database': database_name(),
+            'change_id': mark if mark is not None else "",
+            'saved_at': datetime.now().strftime("%d.%m.%Y %H:%M"),
+        }
+        snapshot.cursor().executemany("INSERT OR REPLACE INTO SnapshotInfo VALUES (%s, %s)",
+                                      [(key, str(value)) for key, value in info.items()])
@@ -0,0 +1,52 @@
+import sqlite3
+from decimal import Decimal
+
+sqlite3.register_adapter(Decimal, float)
+
+class SqliteConnection:
+    # Stand-in with the subset of the mysql.connector API the repositories use (%s placeholders, cursor kwargs)
+    def __init__(self, path, **kwargs):
+        self.conn = sqlite3.connect(path, **kwargs)
+
+    def cursor(self, **kwargs):
+        return SqliteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+class SqliteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace("%s", "?"), list(params))
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(query.replace("%s", "?"), rows)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
@@ -0,0 +1,136 @@
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from repository import PageQuery
+
+PAGE_SIZE = 500
+
+def format_2f(value):
+    return f"{value:.2f}"
+
+class LazyTableModel(QAbstractTableModel):
+    # Rows are plain tuples (id, col0, col1, ...); text is produced in data() only for visible cells.
+    # fetch_page(query, last_row, limit) returns the next keyset page after last_row (None for the first page).
+    # With a runner, pages are fetched on a worker thread and appended when they arrive.
+    def __init__(self, headers, fetch_page, formatters=None, page_size=PAGE_SIZE, runner=None, sortable=(), parent=None):
+        super().__init__(parent)
+        self.headers = headers
+        self.fetch_page = fetch_page
+        self.formatters = formatters or [None] * len(headers)
+        self.page_size = page_size
+        self.runner = runner
+        self.sortable = set(sortable)
+        self.query = PageQuery("", None, False)
+        self._rows = []
+        self._positions = {}
+        self._exhausted = False
+        self._loading = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            value = row[index.column() + 1]
+            if value is None:
+                return ""
+            formatter = self.formatters[index.column()]
+            return formatter(value) if formatter else str(value)
+        if role == Qt.UserRole:
+            return row[0]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._exhausted and not self._loading
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._exhausted or self._loading:
+            return
+        last_row = self._rows[-1] if self._rows else None
+        if self.runner is None:
+            self._append_page(self.fetch_page(self.query, last_row, self.page_size))
+            return
+        self._loading = True
+        self.runner.submit(self.fetch_page, self.query, last_row, self.page_size, key=id(self),
+                           on_result=self._append_page, on_error=self._fetch_failed)
+
+    def _fetch_failed(self, message):
+        self._loading = False
+        self._exhausted = True
+        print(f"Ошибка загрузки данных: {message}")
+
+    def _append_page(self, rows):
+        self._loading = False
+        if rows is None or len(rows) < self.page_size:
+            self._exhausted = True
+        if rows:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+            for i, row in enumerate(rows, first):
+                self._positions[row[0]] = i
+            self._rows.extend(rows)
+            self.endInsertRows()
+
+    def reload(self):
+        self.beginResetModel()
+        self._rows = []
+        self._positions = {}
+        self._exhausted = False
+        self._loading = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # Columns that cannot be ordered in SQL fall back to id order
+        query = self.query._replace(sort_column=column if column in self.sortable else None,
+                                    descending=order == Qt.DescendingOrder)
+        if query != self.query:
+            self.query = query
+            self.reload()
+
+    def set_search(self, text):
+        text = text.strip()
+        if text != self.query.search:
+            self.query = self.query._replace(search=text)
+            self.reload()
+
+    def row_id(self, row):
+        return self._rows[row][0]
+
+    def row(self, position):
+        return self._rows[position]
+
+    def upsert_row(self, row):
+        # An unseen id is appended only when paging is complete, otherwise a later page will bring it in.
+        # With a search or sort active it stays at the end until the next reload.
+        position = self._positions.get(row[0])
+        if position is not None:
+            self._rows[position] = row
+            self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.headers) - 1))
+        elif self._exhausted:
+            position = len(self._rows)
+            self.beginInsertRows(QModelIndex(), position, position)
+            self._positions[row[0]] = position
+            self._rows.append(row)
+            self.endInsertRows()
+
+    def update_column(self, column, values):
+        # values maps row id -> new value for one column; rows that are not loaded yet are skipped
+        changed = []
+        for row_id, value in values.items():
+            position = self._positions.get(row_id)
+            if position is not None:
+                row = self._rows[position]
+                self._rows[position] = row[:column + 1] + (value,) + row[column + 2:]
+                changed.append(position)
+        if changed:
+            self.dataChanged.emit(self.index(min(changed), column), self.index(max(changed), column))
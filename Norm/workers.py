@@ -0,0 +1,95 @@
+import itertools
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal, Slot
+from db import POOL_SIZE
+
+class TaskSignals(QObject):
+    finished = Signal(int, object)
+    failed = Signal(int, str)
+
+class DbTask(QRunnable):
+    def __init__(self, task_id, fn, args):
+        super().__init__()
+        self.task_id = task_id
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.signals = TaskSignals()
+
+    def run(self):
+        if self.cancelled:
+            self.signals.finished.emit(self.task_id, None)
+            return
+        try:
+            result = self.fn(*self.args)
+        except Exception as e:
+            self.signals.failed.emit(self.task_id, str(e))
+            return
+        self.signals.finished.emit(self.task_id, result)
+
+class TaskRunner(QObject):
+    # Runs database work on a thread pool and delivers results on the GUI thread.
+    # Submitting with a key cancels the previous task with the same key: its result is dropped.
+    # Quiet tasks (background polling) do not count towards the busy state.
+    busy_changed = Signal(bool)
+
+    def __init__(self, max_threads=POOL_SIZE, parent=None):
+        super().__init__(parent)
+        self.thread_pool = QThreadPool()
+        # Never run more queries at once than the connection pool can serve
+        self.thread_pool.setMaxThreadCount(max_threads)
+        self._ids = itertools.count(1)
+        self._tasks = {}
+        self._latest = {}
+        self._busy = 0
+
+    def submit(self, fn, *args, key=None, quiet=False, on_result=None, on_error=None):
+        if key is not None:
+            self.cancel(key)
+        task = DbTask(next(self._ids), fn, args)
+        task.signals.finished.connect(self._on_finished)
+        task.signals.failed.connect(self._on_failed)
+        self._tasks[task.task_id] = (task, key, quiet, on_result, on_error)
+        if key is not None:
+            self._latest[key] = task
+        if not quiet:
+            self._busy += 1
+            if self._busy == 1:
+                self.busy_changed.emit(True)
+        self.thread_pool.start(task)
+        return task
+
+    def cancel(self, key):
+        task = self._latest.pop(key, None)
+        if task is not None:
+            task.cancelled = True
+
+    def is_busy(self):
+        return self._busy > 0
+
+    def _pop(self, task_id):
+        task, key, quiet, on_result, on_error = self._tasks.pop(task_id)
+        if key is not None and self._latest.get(key) is task:
+            del self._latest[key]
+        if not quiet:
+            self._busy -= 1
+            if not self._busy:
+                self.busy_changed.emit(False)
+        return task, on_result, on_error
+
+    @Slot(int, object)
+    def _on_finished(self, task_id, result):
+        task, on_result, on_error = self._pop(task_id)
+        if not task.cancelled and on_result is not None:
+            on_result(result)
+
+    @Slot(int, str)
+    def _on_failed(self, task_id, message):
+        task, on_result, on_error = self._pop(task_id)
+        if task.cancelled:
+            return
+        if on_error is not None:
+            on_error(message)
+        else:
+            print(f"Ошибка фоновой операции: {message}")
+
+runner = TaskRunner()
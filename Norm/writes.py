@@ -0,0 +1,154 @@
+import threading
+import db
+from repository import ChangeLogRepository, ConflictError
+
+# Saves written in one transaction at most
+MAX_BATCH = 200
+
+class QueuedWrite:
+    # A record for Repository.save(), or a function writing with the batch's connection (it must not commit).
+    # items: the records such a function may change (ids, versions); they are put back before a retry.
+    __slots__ = ('repository', 'item', 'write', 'items', 'result', 'error', 'done')
+
+    def __init__(self, repository=None, item=None, write=None, items=()):
+        self.repository = repository
+        self.item = item
+        self.write = write
+        self.items = list(items)
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def value(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WriteQueue:
+    # Group commit for the save paths. save() and run() queue the write and return once it is committed;
+    # whichever saving thread gets to write takes everything queued so far, so saves that arrive while a
+    # transaction is being written go out together in the next one: the updates of a table as one executemany
+    # on a prepared statement (still a round trip per row), the ChangeLog rows as one multi-row INSERT and a
+    # single COMMIT. A lone save is written at once; nothing waits for a batch to fill. The dialogs are modal
+    # and wait for their own save, so from the window saves rarely overlap; batches form under bulk callers.
+    def __init__(self, connect=None, max_batch=MAX_BATCH):
+        self.connect = connect or db.get_connection
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._queue = []
+        self.transactions = 0
+        self.writes = 0
+
+    def save(self, repository, item):
+        # Returns the row id; raises ConflictError if the row was changed since it was read
+        return self.wait(self.submit(QueuedWrite(repository, item)))
+
+    def run(self, write, items=()):
+        return self.wait(self.submit(QueuedWrite(write=write, items=items)))
+
+    def submit(self, entry):
+        with self._lock:
+            self._queue.append(entry)
+        return entry
+
+    def wait(self, entry):
+        while not entry.done.is_set():
+            self.flush()
+        return entry.value()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            while batch:
+                batch, later = self._unique(batch)
+                self._write(batch)
+                batch = later
+
+    @staticmethod
+    def _unique(batch):
+        # A row saved twice in one batch would miss its own version check: the later save goes in the next
+        # transaction, against the version the first one left
+        seen = set()
+        first, later = [], []
+        for entry in batch:
+            key = (entry.repository, entry.item.id) if entry.item is not None and entry.item.id else None
+            if key is not None and key in seen:
+                later.append(entry)
+            else:
+                seen.add(key)
+                first.append(entry)
+        return first, later
+
+    def _write(self, batch):
+        # A conflicting write fails alone and the rest is written again. Any other error is retried one write
+        # per transaction, so it reaches only the save that caused it.
+        states = [(item, item.id, item.version) for entry in batch
+                  for item in ([entry.item] if entry.item is not None else entry.items)]
+        pending = batch
+        try:
+            while pending:
+                failed = self._transaction(pending)
+                if not failed:
+                    break
+                for item, item_id, version in states:
+                    item.id, item.version = item_id, version
+                for entry, error in failed:
+                    entry.error = error
+                pending = [entry for entry in pending if entry.error is None]
+        except Exception as e:
+            for item, item_id, version in states:
+                item.id, item.version = item_id, version
+            if len(pending) == 1:
+                pending[0].error = e
+            else:
+                for entry in pending:
+                    self._write([entry])
+        finally:
+            for entry in batch:
+                entry.done.set()
+
+    def _transaction(self, batch):
+        # Writes the batch and commits; returns [(entry, ConflictError)] with nothing committed on a conflict
+        with self.connect() as conn:
+            updates = {}
+            for entry in batch:
+                if entry.write is None and entry.item.id:
+                    updates.setdefault(entry.repository, []).append(entry)
+            versions = []
+            for repository, entries in updates.items():
+                try:
+                    written = repository(conn).update_many([entry.item for entry in entries])
+                except ConflictError as e:
+                    conn.rollback()
+                    failed = [entry for entry in entries if entry.item.id in e.ids]
+                    if not failed:
+                        # No stale row to blame: retried one write per transaction like any other error
+                        raise
+                    return [(entry, ConflictError(e.table, [entry.item.id])) for entry in failed]
+                versions += [(entry.item, written[entry.item.id]) for entry in entries if entry.item.id in written]
+            changes = {}
+            for entry in batch:
+                if entry.write is not None:
+                    try:
+                        entry.result = entry.write(conn)
+                    except ConflictError as e:
+                        conn.rollback()
+                        return [(entry, e)]
+                    continue
+                repository = entry.repository(conn)
+                if not entry.item.id:
+                    repository.insert(entry.item)
+                entry.result = entry.item.id
+                changes.setdefault(repository.table, []).append(entry.item.id)
+            ChangeLogRepository(conn).record_many(changes)
+            conn.commit()
+        # Only now are the new row versions really there
+        for item, version in versions:
+            item.version = version
+        self.transactions += 1
+        self.writes += len(batch)
+        return []
+
+write_queue = WriteQueue()